@@ -0,0 +1,142 @@
+"""
+Ежедневные агрегаты для экрана аналитики.
+
+Таблицы daily_stats, daily_status_transition и client_first_reply
+обновляются инкрементально в тех же транзакциях, что и запись данных
+(API n8n, смена статуса в CRM, бот), поэтому отчет читает несколько
+строк на день вместо сканирования client и message.
+
+SQL собирается здесь и используется обоими процессами: Flask передает
+именованные параметры (:name), asyncpg в боте - позиционные ($1).
+"""
+
+from collections import defaultdict
+from datetime import date, datetime
+from typing import Dict, List, Optional, Tuple
+
+DAILY_COUNTERS = [
+    'new_clients',
+    'messages_in',
+    'messages_out',
+    'voice_messages',
+    'text_messages',
+    'first_replies',
+    'first_reply_seconds'
+]
+
+VOICE_MESSAGE_PREFIX = '[Голосовое сообщение:'
+
+
+def _placeholders(names: List[str], numeric: bool) -> str:
+    if numeric:
+        return ', '.join(f'${i}' for i in range(1, len(names) + 1))
+    return ', '.join(f':{name}' for name in names)
+
+
+def daily_stats_upsert_sql(numeric: bool = False) -> str:
+    """Прибавляет счетчики к строке дня (создает ее при необходимости)"""
+    columns = ['day'] + DAILY_COUNTERS
+    updates = ', '.join(f'{name} = daily_stats.{name} + excluded.{name}' for name in DAILY_COUNTERS)
+    return (
+        f"INSERT INTO daily_stats ({', '.join(columns)}) VALUES ({_placeholders(columns, numeric)}) "
+        f"ON CONFLICT (day) DO UPDATE SET {updates}"
+    )
+
+
+def status_transition_upsert_sql(numeric: bool = False) -> str:
+    columns = ['day', 'from_status', 'to_status', 'count']
+    return (
+        f"INSERT INTO daily_status_transition ({', '.join(columns)}) VALUES ({_placeholders(columns, numeric)}) "
+        f"ON CONFLICT (day, from_status, to_status) DO UPDATE SET count = daily_status_transition.count + excluded.count"
+    )
+
+
+def first_message_insert_sql(numeric: bool = False) -> str:
+    """Запоминает время первого сообщения клиента (повторные вызовы ничего не меняют)"""
+    return (
+        f"INSERT INTO client_first_reply (client_id, first_message_at) "
+        f"VALUES ({_placeholders(['client_id', 'first_message_at'], numeric)}) "
+        f"ON CONFLICT (client_id) DO NOTHING"
+    )
+
+
+# Первый ответ бота после первого сообщения клиента: отмечаем его и сразу
+# добавляем время ответа в агрегат дня. Только PostgreSQL (используется ботом).
+FIRST_REPLY_SQL = f"""
+    WITH reply AS (
+        UPDATE client_first_reply SET first_reply_at = $2
+        WHERE client_id = $1 AND first_reply_at IS NULL AND first_message_at <= $2
+        RETURNING first_message_at
+    )
+    INSERT INTO daily_stats (day, {', '.join(DAILY_COUNTERS)})
+    SELECT $2::date, 0, 0, 0, 0, 0, 1, EXTRACT(EPOCH FROM ($2 - first_message_at)) FROM reply
+    ON CONFLICT (day) DO UPDATE SET
+        first_replies = daily_stats.first_replies + excluded.first_replies,
+        first_reply_seconds = daily_stats.first_reply_seconds + excluded.first_reply_seconds
+"""
+
+
+class DailyDelta:
+    """Накопитель приращений счетчиков по дням для пакетной записи"""
+
+    def __init__(self):
+        self._days: Dict[date, Dict[str, float]] = defaultdict(lambda: dict.fromkeys(DAILY_COUNTERS, 0))
+
+    def add(self, day, **counters) -> None:
+        if isinstance(day, datetime):
+            day = day.date()
+        row = self._days[day]
+        for name, value in counters.items():
+            row[name] += value
+
+    def add_message(self, timestamp: datetime, is_from_bot: bool, is_voice: bool = False) -> None:
+        if is_from_bot:
+            self.add(timestamp, messages_out=1)
+        else:
+            self.add(timestamp, messages_in=1, voice_messages=int(is_voice), text_messages=int(not is_voice))
+
+    def as_dicts(self) -> List[Dict]:
+        return [{'day': day, **row} for day, row in sorted(self._days.items())]
+
+    def as_tuples(self) -> List[Tuple]:
+        return [(day, *(row[name] for name in DAILY_COUNTERS)) for day, row in sorted(self._days.items())]
+
+    def __bool__(self) -> bool:
+        return bool(self._days)
+
+
+def summarize(day_rows, transition_rows) -> Dict:
+    """Ответ API аналитики из строк агрегатов (day_rows - объекты с полями DAILY_COUNTERS)"""
+    totals = dict.fromkeys(DAILY_COUNTERS, 0)
+    days = []
+    for row in day_rows:
+        day = {'day': row.day.isoformat()}
+        for name in DAILY_COUNTERS:
+            value = getattr(row, name) or 0
+            day[name] = value
+            totals[name] += value
+        days.append(day)
+
+    user_messages = totals['voice_messages'] + totals['text_messages']
+    totals['voice_share'] = round(totals['voice_messages'] / user_messages, 4) if user_messages else 0.0
+    totals['avg_first_reply_seconds'] = (
+        round(totals['first_reply_seconds'] / totals['first_replies'], 1) if totals['first_replies'] else None
+    )
+
+    transitions: Dict[Tuple[str, str], int] = defaultdict(int)
+    for row in transition_rows:
+        transitions[(row.from_status, row.to_status)] += row.count
+
+    return {
+        'totals': totals,
+        'days': days,
+        'status_transitions': [
+            {'from_status': from_status or None, 'to_status': to_status, 'count': count}
+            for (from_status, to_status), count in sorted(transitions.items(), key=lambda item: -item[1])
+        ]
+    }
+
+
+def is_voice_text(message_text: Optional[str]) -> bool:
+    """Сообщение-заглушка, которую бот сохраняет для голосовых"""
+    return bool(message_text) and message_text.startswith(VOICE_MESSAGE_PREFIX)
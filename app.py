@@ -1,12 +1,39 @@
-from flask import Flask, render_template, request, redirect, url_for, flash, jsonify, session
+from startup import StartupTimer
+
+# Раньше остальных импортов, чтобы отчет о запуске включал и их время
+startup_timer = StartupTimer('CRM')
+
+from flask import Flask, render_template, request, redirect, url_for, flash, jsonify, session, Response, stream_with_context, send_from_directory
 from flask_sqlalchemy import SQLAlchemy
 from flask_login import LoginManager, UserMixin, login_user, login_required, logout_user, current_user
+from markupsafe import Markup, escape
+from sqlalchemy import case, create_engine, or_, select, text, tuple_, update
+from sqlalchemy.exc import TimeoutError as PoolTimeoutError
+from sqlalchemy.pool import NullPool
+from sqlalchemy.orm import defer
 from werkzeug.security import generate_password_hash, check_password_hash
-from datetime import datetime
+from datetime import datetime, timedelta
+import json
 import os
+import queue
+import tempfile
+import time
 from dotenv import load_dotenv
-import re
 
+from analytics import DailyDelta, daily_stats_upsert_sql, first_message_insert_sql, status_transition_upsert_sql, summarize
+from exporter import CLIENT_FIELDS, MESSAGE_FIELDS, GroupedRows, csv_rows, iter_csv, iter_jsonl, iter_gzip, iter_records
+from fragment_cache import FragmentCache
+from idempotency import IdempotencyCache, build_key
+from message_partitions import read_archived_messages
+from message_templates import TemplateCache
+import compression
+import metrics
+import query_budget
+from replica import ReplicaRouter, RoutingSession, replica_read
+from profiling import RequestProfiler, list_profiles
+from live_events import EventBroadcaster, CHANNEL, client_event, message_event, encode_event, format_sse
+
+startup_timer.mark('imports')
 load_dotenv()
 
 app = Flask(__name__)
@@ -17,16 +44,142 @@ if database_url.startswith('postgres://'):
     database_url = database_url.replace('postgres://', 'postgresql://', 1)
 app.config['SQLALCHEMY_DATABASE_URI'] = database_url
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+# Пул соединений SQLAlchemy на worker: pool_size постоянных и max_overflow временных соединений,
+# ожидание свободного соединения, замена соединений старше DB_POOL_RECYCLE_SECONDS и проверка перед выдачей
+app.config['DB_POOL_SIZE'] = int(os.getenv('DB_POOL_SIZE', '5'))
+app.config['DB_MAX_OVERFLOW'] = int(os.getenv('DB_MAX_OVERFLOW', '5'))
+app.config['DB_POOL_TIMEOUT'] = float(os.getenv('DB_POOL_TIMEOUT', '10'))
+app.config['DB_POOL_RECYCLE_SECONDS'] = int(os.getenv('DB_POOL_RECYCLE_SECONDS', '1800'))
+app.config['DB_POOL_PRE_PING'] = os.getenv('DB_POOL_PRE_PING', 'true').lower() == 'true'
+app.config['DB_CONNECT_TIMEOUT'] = int(os.getenv('DB_CONNECT_TIMEOUT', '10'))
+# PgBouncer в режиме transaction: LISTEN для живых обновлений идет напрямую в PostgreSQL (DATABASE_LISTEN_URL)
+app.config['DB_PGBOUNCER'] = os.getenv('DB_PGBOUNCER', 'false').lower() == 'true'
+listen_url = os.getenv('DATABASE_LISTEN_URL')
+if listen_url and listen_url.startswith('postgres://'):
+    listen_url = listen_url.replace('postgres://', 'postgresql://', 1)
+app.config['DATABASE_LISTEN_URL'] = listen_url
+db_pool_max_size = None
+if database_url.startswith('postgresql'):
+    db_pool_max_size = app.config['DB_POOL_SIZE'] + app.config['DB_MAX_OVERFLOW']
+    app.config['SQLALCHEMY_ENGINE_OPTIONS'] = {
+        'pool_size': app.config['DB_POOL_SIZE'],
+        'max_overflow': app.config['DB_MAX_OVERFLOW'],
+        'pool_timeout': app.config['DB_POOL_TIMEOUT'],
+        'pool_recycle': app.config['DB_POOL_RECYCLE_SECONDS'],
+        'pool_pre_ping': app.config['DB_POOL_PRE_PING'],
+        'connect_args': {'connect_timeout': app.config['DB_CONNECT_TIMEOUT']}
+    }
+# Сколько сообщений диалога показывать сразу и подгружать за один запрос
+app.config['MESSAGES_PAGE_SIZE'] = int(os.getenv('MESSAGES_PAGE_SIZE', '50'))
+# Кэш отрендеренных фрагментов: размер в памяти (символов) и общий дисковый кэш для всех worker'ов
+app.config['FRAGMENT_CACHE_MAX_SIZE'] = int(os.getenv('FRAGMENT_CACHE_MAX_SIZE', str(32 * 1024 * 1024)))
+app.config['FRAGMENT_CACHE_DIR'] = os.getenv('FRAGMENT_CACHE_DIR')
+app.config['FRAGMENT_CACHE_DISK_MAX_BYTES'] = int(os.getenv('FRAGMENT_CACHE_DISK_MAX_BYTES', str(256 * 1024 * 1024)))
+# Каталог архива старых месяцев переписки (message_partitions.py archive)
+app.config['MESSAGE_ARCHIVE_DIR'] = os.getenv('MESSAGE_ARCHIVE_DIR', 'archive/messages')
+# Сколько строк выгрузки читать из серверного курсора за один раз
+app.config['EXPORT_BATCH_SIZE'] = int(os.getenv('EXPORT_BATCH_SIZE', '1000'))
+# Живые обновления (SSE): каждый открытый поток SSE занимает поток gunicorn (GUNICORN_THREADS на worker)
+# все время, пока открыта вкладка, поэтому по умолчанию под SSE отдается половина потоков worker'а,
+# и хотя бы один поток всегда остается для обычных запросов
+app.config['GUNICORN_THREADS'] = int(os.getenv('GUNICORN_THREADS', '8'))
+app.config['SSE_MAX_CONNECTIONS'] = int(os.getenv('SSE_MAX_CONNECTIONS', str(app.config['GUNICORN_THREADS'] // 2)))
+if app.config['SSE_MAX_CONNECTIONS'] >= app.config['GUNICORN_THREADS']:
+    app.logger.warning(f"SSE_MAX_CONNECTIONS={app.config['SSE_MAX_CONNECTIONS']} не меньше GUNICORN_THREADS="
+                       f"{app.config['GUNICORN_THREADS']}: лимит снижен до {app.config['GUNICORN_THREADS'] - 1}")
+    app.config['SSE_MAX_CONNECTIONS'] = app.config['GUNICORN_THREADS'] - 1
+app.config['SSE_HEARTBEAT_SECONDS'] = float(os.getenv('SSE_HEARTBEAT_SECONDS', '15'))
+app.config['SSE_QUEUE_SIZE'] = int(os.getenv('SSE_QUEUE_SIZE', '100'))
+# Идемпотентность приема сообщений: сколько хранить ключи и сколько их держать в БД и в памяти процесса
+app.config['IDEMPOTENCY_TTL_SECONDS'] = int(os.getenv('IDEMPOTENCY_TTL_SECONDS', str(24 * 3600)))
+app.config['IDEMPOTENCY_MAX_KEYS'] = int(os.getenv('IDEMPOTENCY_MAX_KEYS', '200000'))
+app.config['IDEMPOTENCY_CACHE_SIZE'] = int(os.getenv('IDEMPOTENCY_CACHE_SIZE', '10000'))
+app.config['IDEMPOTENCY_EVICT_INTERVAL_SECONDS'] = int(os.getenv('IDEMPOTENCY_EVICT_INTERVAL_SECONDS', '300'))
+# Учет SQL-запросов на запрос: предупреждение в логе при превышении и при повторах одного запроса (N+1)
+app.config['QUERY_BUDGET_WARN'] = int(os.getenv('QUERY_BUDGET_WARN', '20'))
+app.config['QUERY_REPEAT_WARN'] = int(os.getenv('QUERY_REPEAT_WARN', '5'))
+app.config['QUERY_TIMING_HEADER'] = os.getenv('QUERY_TIMING_HEADER', 'true').lower() == 'true'
+# Сжатие ответов (gzip/brotli по Accept-Encoding) начиная с COMPRESS_MIN_SIZE байт
+app.config['COMPRESS_RESPONSES'] = os.getenv('COMPRESS_RESPONSES', 'true').lower() == 'true'
+app.config['COMPRESS_MIN_SIZE'] = int(os.getenv('COMPRESS_MIN_SIZE', '1024'))
+app.config['COMPRESS_LEVEL'] = int(os.getenv('COMPRESS_LEVEL', '6'))
+# Предел размера распакованного тела запроса с Content-Encoding: gzip
+app.config['MAX_DECOMPRESSED_REQUEST_BYTES'] = int(os.getenv('MAX_DECOMPRESSED_REQUEST_BYTES', str(32 * 1024 * 1024)))
+# Метрики Prometheus на /metrics: только с METRICS_TOKEN (опрос с заголовком Authorization: Bearer <токен>)
+app.config['METRICS_ENABLED'] = os.getenv('METRICS_ENABLED', 'true').lower() == 'true'
+app.config['METRICS_TOKEN'] = os.getenv('METRICS_TOKEN')
+# Профилирование по запросу: доля профилируемых запросов (меняется на /admin/profiling без перезапуска),
+# заголовок принудительного профилирования и его токен, каталог профилей (folded stacks для flamegraph)
+app.config['PROFILE_SAMPLE_RATE'] = float(os.getenv('PROFILE_SAMPLE_RATE', '0'))
+app.config['PROFILE_HEADER'] = os.getenv('PROFILE_HEADER', 'X-Profile')
+app.config['PROFILE_TOKEN'] = os.getenv('PROFILE_TOKEN')
+app.config['PROFILE_DIR'] = os.getenv('PROFILE_DIR', os.path.join(tempfile.gettempdir(), 'clienterra_profiles'))
+app.config['PROFILE_INTERVAL_MS'] = float(os.getenv('PROFILE_INTERVAL_MS', '5'))
+app.config['PROFILE_MAX_FILES'] = int(os.getenv('PROFILE_MAX_FILES', '200'))
+# Реплика для чтения CRM (replica.py): без DATABASE_REPLICA_URL все запросы идут в основную базу
+replica_url = os.getenv('DATABASE_REPLICA_URL')
+if replica_url and replica_url.startswith('postgres://'):
+    replica_url = replica_url.replace('postgres://', 'postgresql://', 1)
+app.config['DATABASE_REPLICA_URL'] = replica_url
+app.config['REPLICA_MAX_LAG_SECONDS'] = float(os.getenv('REPLICA_MAX_LAG_SECONDS', '5'))
+app.config['REPLICA_LAG_CHECK_SECONDS'] = float(os.getenv('REPLICA_LAG_CHECK_SECONDS', '1'))
+app.config['REPLICA_PIN_SECONDS'] = float(os.getenv('REPLICA_PIN_SECONDS', '10'))
 
-db = SQLAlchemy(app)
+db = SQLAlchemy(app, session_options={'class_': RoutingSession})
+replica_router = None
+if app.config['DATABASE_REPLICA_URL']:
+    replica_router = ReplicaRouter(
+        app.config['DATABASE_REPLICA_URL'],
+        max_lag=app.config['REPLICA_MAX_LAG_SECONDS'],
+        check_interval=app.config['REPLICA_LAG_CHECK_SECONDS'],
+        pin_seconds=app.config['REPLICA_PIN_SECONDS'],
+        engine_options=app.config['SQLALCHEMY_ENGINE_OPTIONS']
+    )
+request_profiler = RequestProfiler(
+    app.config['PROFILE_DIR'],
+    sample_rate=app.config['PROFILE_SAMPLE_RATE'],
+    interval=app.config['PROFILE_INTERVAL_MS'] / 1000,
+    header=app.config['PROFILE_HEADER'],
+    token=app.config['PROFILE_TOKEN'],
+    max_files=app.config['PROFILE_MAX_FILES']
+)
+# Первыми: время запроса в метриках и профиль включают сжатие и учет SQL-запросов
+metrics.init_app(app, stats_sources={
+    'db_pool': lambda: metrics.sqlalchemy_pool_stats(db.engine, max_size=db_pool_max_size),
+    'fragment_cache': lambda: fragment_cache.get_stats(),
+    'idempotency_cache': lambda: idempotency_cache.get_stats(),
+    'live_events': lambda: event_broadcaster.get_stats(),
+    'profiler': request_profiler.get_stats,
+    'startup': startup_timer.get_stats,
+    **({'replica': replica_router.get_stats} if replica_router else {})
+})
+request_profiler.init_app(app)
+compression.init_app(app)
+query_budget.init_app(app)
+if replica_router:
+    replica_router.init_app(app)
 login_manager = LoginManager()
 login_manager.init_app(app)
 login_manager.login_view = 'login'
 
-# Добавляем фильтр для переносов строк
+fragment_cache = FragmentCache(
+    app.config['FRAGMENT_CACHE_MAX_SIZE'],
+    directory=app.config['FRAGMENT_CACHE_DIR'],
+    max_disk_bytes=app.config['FRAGMENT_CACHE_DISK_MAX_BYTES']
+)
+
+idempotency_cache = IdempotencyCache(app.config['IDEMPOTENCY_CACHE_SIZE'], app.config['IDEMPOTENCY_TTL_SECONDS'])
+_idempotency_evicted_at = 0.0
+
+event_broadcaster = EventBroadcaster(
+    max_subscribers=app.config['SSE_MAX_CONNECTIONS'],
+    max_queue=app.config['SSE_QUEUE_SIZE']
+)
+
+# Добавляем фильтр для переносов строк (без регулярных выражений, текст экранируется)
 @app.template_filter('nl2br')
 def nl2br(value):
-    return re.sub(r'\n', '<br>', str(value))
+    return Markup(str(escape(value)).replace('\n', '<br>'))
 
 # Модели базы данных
 class User(UserMixin, db.Model):
@@ -51,18 +204,248 @@ class Client(db.Model):
     messages = db.relationship('Message', backref='client', lazy=True, cascade='all, delete-orphan')
 
 class Message(db.Model):
+    # Индекс под keyset-пагинацию диалога: (client_id, timestamp, id)
+    __table_args__ = (
+        db.Index('ix_message_client_timestamp_id', 'client_id', 'timestamp', 'id'),
+    )
+    
     id = db.Column(db.Integer, primary_key=True)
     client_id = db.Column(db.Integer, db.ForeignKey('client.id'), nullable=False)
     message_text = db.Column(db.Text, nullable=False)
     is_from_bot = db.Column(db.Boolean, default=False)
     timestamp = db.Column(db.DateTime, default=datetime.utcnow)
     attachment_path = db.Column(db.String(500))
+    transcript = db.Column(db.Text)  # Расшифровка голосового сообщения (заполняется ботом в фоне)
+    # Сообщение бота из шаблона: message_text пустой, текст собирается при чтении (message_templates.py)
+    template_id = db.Column(db.Integer, db.ForeignKey('message_template.id'))
+    template_params = db.Column(db.Text)
+    
+    @property
+    def display_text(self):
+        if self.template_id is None:
+            return self.message_text
+        return message_templates.expand(self.template_id, self.template_params)
+
+class MessageTemplate(db.Model):
+    __tablename__ = 'message_template'
+    
+    id = db.Column(db.Integer, primary_key=True)
+    text_hash = db.Column(db.String(64), unique=True, nullable=False)
+    text = db.Column(db.Text, nullable=False)
+
+class MessageArchiveSegment(db.Model):
+    """Сообщения клиента за месяц, вынесенные из БД в архивный файл (см. message_partitions.py)"""
+    __tablename__ = 'message_archive_segment'
+    
+    client_id = db.Column(db.Integer, db.ForeignKey('client.id', ondelete='CASCADE'), primary_key=True)
+    month = db.Column(db.Date, primary_key=True)
+    file_name = db.Column(db.String(255), nullable=False)
+    byte_offset = db.Column(db.BigInteger, nullable=False)
+    byte_length = db.Column(db.Integer, nullable=False)
+    message_count = db.Column(db.Integer, nullable=False)
+
+def load_message_templates(template_ids):
+    return dict(db.session.query(MessageTemplate.id, MessageTemplate.text).filter(MessageTemplate.id.in_(template_ids)))
+
+# Шаблоны не меняются, поэтому кэшируются на все время жизни процесса
+message_templates = TemplateCache(load_message_templates)
+
+# Ежедневные агрегаты для аналитики (обновляются при записи данных, см. analytics.py)
+class DailyStats(db.Model):
+    __tablename__ = 'daily_stats'
+    
+    day = db.Column(db.Date, primary_key=True)
+    new_clients = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+    messages_in = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+    messages_out = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+    voice_messages = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+    text_messages = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+    first_replies = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+    first_reply_seconds = db.Column(db.Float, nullable=False, default=0, server_default='0')
+
+class DailyStatusTransition(db.Model):
+    __tablename__ = 'daily_status_transition'
+    
+    day = db.Column(db.Date, primary_key=True)
+    from_status = db.Column(db.String(50), primary_key=True)  # '' - статус не был задан
+    to_status = db.Column(db.String(50), primary_key=True)
+    count = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+
+class ClientFirstReply(db.Model):
+    """Первое сообщение клиента и первый ответ на него - для времени до первого ответа"""
+    __tablename__ = 'client_first_reply'
+    
+    client_id = db.Column(db.Integer, db.ForeignKey('client.id', ondelete='CASCADE'), primary_key=True)
+    first_message_at = db.Column(db.DateTime, nullable=False)
+    first_reply_at = db.Column(db.DateTime)
+
+class IngestIdempotencyKey(db.Model):
+    """Обработанные запросы приема сообщений и их ответы (см. idempotency.py)"""
+    __tablename__ = 'ingest_idempotency'
+    
+    key = db.Column(db.String(200), primary_key=True)
+    response = db.Column(db.Text)  # JSON ответа, заполняется в той же транзакции
+    status_code = db.Column(db.Integer)
+    created_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow, index=True)
 
 class BotSettings(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     welcome_message = db.Column(db.Text, default="Привет! Я помогу вам создать идеального Telegram-бота для вашего бизнеса. Расскажите, что вас интересует?")
     updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
 
+def record_ingest_stats(client, timestamp, is_new_client, is_voice=False):
+    """Обновляет агрегаты аналитики для входящего сообщения (в текущей транзакции)"""
+    delta = DailyDelta()
+    delta.add_message(timestamp, is_from_bot=False, is_voice=is_voice)
+    if is_new_client:
+        delta.add(timestamp, new_clients=1)
+    for row in delta.as_dicts():
+        db.session.execute(text(daily_stats_upsert_sql()), row)
+    db.session.execute(text(first_message_insert_sql()), {'client_id': client.id, 'first_message_at': timestamp})
+
+def record_status_transition(from_status, to_status):
+    """Учитывает смену статуса клиента в агрегатах (в текущей транзакции)"""
+    if from_status == to_status:
+        return
+    db.session.execute(text(status_transition_upsert_sql()), {
+        'day': datetime.utcnow().date(),
+        'from_status': from_status or '',
+        'to_status': to_status,
+        'count': 1
+    })
+
+def _insert_statement(model):
+    dialect = db.engine.dialect.name
+    if dialect == 'postgresql':
+        from sqlalchemy.dialects.postgresql import insert
+    elif dialect == 'sqlite':
+        from sqlalchemy.dialects.sqlite import insert
+    else:
+        raise RuntimeError(f'Unsupported database dialect: {dialect}')
+    return insert(model)
+
+def request_idempotency_key(scope, telegram_id, message_id):
+    explicit_key = request.headers.get('Idempotency-Key') or (request.get_json(silent=True) or {}).get('idempotency_key')
+    return build_key(scope, explicit_key, telegram_id, message_id)
+
+def idempotent_replay(body, status_code):
+    response = jsonify(body)
+    response.status_code = status_code
+    response.headers['Idempotent-Replay'] = 'true'
+    return response
+
+def claim_idempotency_key(key):
+    """Занимает ключ в текущей транзакции. Возвращает ответ-повтор или None, если запрос новый.
+    
+    Если тот же ключ сейчас обрабатывает параллельный запрос, INSERT ждет
+    его commit (уникальный индекс) и затем читает сохраненный ответ.
+    """
+    cached = idempotency_cache.get(key)
+    if cached is not None:
+        return idempotent_replay(*cached)
+    
+    statement = _insert_statement(IngestIdempotencyKey) \
+        .values(key=key, created_at=datetime.utcnow()) \
+        .on_conflict_do_nothing(index_elements=['key']).returning(IngestIdempotencyKey.key)
+    if db.session.execute(statement).scalar() is not None:
+        return None
+    
+    stored = db.session.query(IngestIdempotencyKey.response, IngestIdempotencyKey.status_code) \
+        .filter(IngestIdempotencyKey.key == key).one()
+    db.session.rollback()
+    if stored.response is None:
+        return jsonify({'error': 'Request with this idempotency key is in progress'}), 409
+    body = json.loads(stored.response)
+    idempotency_cache.set(key, body, stored.status_code)
+    return idempotent_replay(body, stored.status_code)
+
+def store_idempotent_response(key, body, status_code=200):
+    """Сохраняет ответ в строке ключа (до commit основной транзакции)"""
+    db.session.query(IngestIdempotencyKey).filter(IngestIdempotencyKey.key == key).update(
+        {'response': json.dumps(body, ensure_ascii=False), 'status_code': status_code},
+        synchronize_session=False
+    )
+
+def finish_idempotent_request(key, body, status_code=200):
+    """После commit: ответ в кэш процесса и периодическая очистка старых ключей"""
+    global _idempotency_evicted_at
+    idempotency_cache.set(key, body, status_code)
+    
+    now = time.monotonic()
+    if now - _idempotency_evicted_at < app.config['IDEMPOTENCY_EVICT_INTERVAL_SECONDS']:
+        return
+    _idempotency_evicted_at = now
+    try:
+        cutoff = datetime.utcnow() - timedelta(seconds=app.config['IDEMPOTENCY_TTL_SECONDS'])
+        IngestIdempotencyKey.query.filter(IngestIdempotencyKey.created_at < cutoff).delete(synchronize_session=False)
+        # Ограничение по числу ключей: удаляем самые старые сверх лимита
+        newest = db.session.query(IngestIdempotencyKey.created_at) \
+            .order_by(IngestIdempotencyKey.created_at.desc()) \
+            .offset(app.config['IDEMPOTENCY_MAX_KEYS']).limit(1).scalar()
+        if newest is not None:
+            IngestIdempotencyKey.query.filter(IngestIdempotencyKey.created_at <= newest).delete(synchronize_session=False)
+        db.session.commit()
+    except Exception as e:
+        db.session.rollback()
+        app.logger.warning(f"Ошибка очистки ключей идемпотентности: {e}")
+
+def lock_or_create_client(telegram_id, **values):
+    """Возвращает (клиент, создан ли он сейчас), строка клиента заблокирована до конца транзакции.
+    
+    INSERT ... ON CONFLICT DO NOTHING не падает на уникальном telegram_id,
+    когда параллельный запрос создает того же клиента, а SELECT ... FOR UPDATE
+    выстраивает запросы одного клиента в очередь. Бриф не загружается.
+    """
+    statement = _insert_statement(Client).values(telegram_id=telegram_id, **values) \
+        .on_conflict_do_nothing(index_elements=['telegram_id']).returning(Client.id)
+    created = db.session.execute(statement).scalar() is not None
+    client = Client.query.options(defer(Client.user_brief)) \
+        .filter_by(telegram_id=telegram_id).with_for_update().one()
+    return client, created
+
+def append_user_brief(client, text):
+    """Дописывает текст к брифу на стороне БД, не читая сам бриф"""
+    separator = "\n\n--- Новое сообщение ---\n"
+    db.session.execute(
+        update(Client).where(Client.id == client.id).values(
+            user_brief=case(
+                (or_(Client.user_brief.is_(None), Client.user_brief == ''), text),
+                else_=Client.user_brief + separator + text
+            )
+        ).execution_options(synchronize_session=False)
+    )
+    # Отложенный атрибут перечитается из БД при следующем обращении
+    db.session.expire(client, ['user_brief'])
+
+def emit_event(event_type, data):
+    """Публикует событие для открытых дашбордов.
+    
+    В PostgreSQL это NOTIFY в текущей транзакции: событие получат все
+    worker'ы и только после commit. В остальных БД - только подписчики
+    этого процесса.
+    """
+    if db.engine.dialect.name == 'postgresql':
+        db.session.execute(text("SELECT pg_notify(:channel, :payload)"),
+                           {'channel': CHANNEL, 'payload': encode_event(event_type, data)})
+    else:
+        event_broadcaster.publish(event_type, data)
+
+def emit_client_event(client, previous_status=None, created=False):
+    emit_event('client', client_event(
+        client.id, client.telegram_id, client.name, client.organization, client.status,
+        client.created_at, client.updated_at, previous_status=previous_status, created=created
+    ))
+
+def pin_client_reads(client):
+    """Только что записанные данные клиента ближайшее время читаются из основной базы"""
+    if replica_router:
+        replica_router.pin('telegram_id', client.telegram_id)
+        replica_router.pin('client_id', client.id)
+
+def emit_message_event(client, message):
+    emit_event('message', message_event(client.id, message.id, message.message_text, message.is_from_bot,
+                                        message.timestamp, message.transcript))
+
 @login_manager.user_loader
 def load_user(user_id):
     return User.query.get(int(user_id))
@@ -91,16 +474,124 @@ def logout():
 
 @app.route('/')
 @login_required
+@replica_read()
 def dashboard():
     clients = Client.query.order_by(Client.created_at.desc()).all()
     return render_template('dashboard.html', clients=clients)
 
+def get_archived_messages(client_id):
+    """Сообщения клиента из архива (message_partitions.py) в хронологическом порядке"""
+    segments = MessageArchiveSegment.query.filter_by(client_id=client_id).all()
+    if not segments:
+        return []
+    return read_archived_messages(app.config['MESSAGE_ARCHIVE_DIR'], segments)
+
+def count_messages(client_id):
+    """Число сообщений клиента в БД и в архиве одним запросом"""
+    stored = select(db.func.count(Message.id)).where(Message.client_id == client_id).scalar_subquery()
+    archived = select(db.func.coalesce(db.func.sum(MessageArchiveSegment.message_count), 0)) \
+        .where(MessageArchiveSegment.client_id == client_id).scalar_subquery()
+    return db.session.execute(select(stored + archived)).scalar()
+
+def get_messages_page(client_id, limit, before_timestamp=None, before_id=None):
+    """Страница сообщений клиента перед курсором (timestamp, id), в хронологическом порядке"""
+    query = Message.query.filter(Message.client_id == client_id)
+    if before_timestamp is not None:
+        query = query.filter(tuple_(Message.timestamp, Message.id) < (before_timestamp, before_id))
+    
+    # Берем на одно сообщение больше, чтобы понять, есть ли еще более ранние
+    page = query.order_by(Message.timestamp.desc(), Message.id.desc()).limit(limit + 1).all()
+    # В БД сообщения кончились - более ранние могут быть в архиве старых месяцев
+    if len(page) <= limit:
+        archived = [msg for msg in get_archived_messages(client_id)
+                    if before_timestamp is None or (msg.timestamp, msg.id) < (before_timestamp, before_id)]
+        page.extend(reversed(archived[-(limit + 1 - len(page)):]))
+    has_more = len(page) > limit
+    page = page[:limit]
+    page.reverse()
+    return page, has_more
+
+def message_to_dict(msg):
+    return {
+        'id': msg.id,
+        'text': msg.display_text,
+        'is_from_bot': msg.is_from_bot,
+        'timestamp': msg.timestamp.isoformat() if msg.timestamp else None,
+        'timestamp_display': msg.timestamp.strftime('%d.%m.%Y %H:%M:%S') if msg.timestamp else '',
+        'attachment_path': msg.attachment_path,
+        'transcript': msg.transcript
+    }
+
 @app.route('/client/<int:client_id>')
 @login_required
+@replica_read('client_id')
 def client_detail(client_id):
-    client = Client.query.get_or_404(client_id)
-    messages = Message.query.filter_by(client_id=client_id).order_by(Message.timestamp.asc()).all()
-    return render_template('client_detail.html', client=client, messages=messages)
+    # Бриф не загружаем: он подгружается по кнопке через client_brief
+    client = Client.query.options(defer(Client.user_brief)).get_or_404(client_id)
+    brief_length = db.session.query(db.func.length(Client.user_brief)).filter(Client.id == client_id).scalar() or 0
+    page_size = app.config['MESSAGES_PAGE_SIZE']
+    
+    # Версия ленты: последнее сообщение и время изменения клиента (имя, расшифровки)
+    newest = db.session.query(Message.id).filter(Message.client_id == client_id) \
+        .order_by(Message.timestamp.desc(), Message.id.desc()).first()
+    version = f"{client_id}:{newest.id if newest else 0}:{client.updated_at.isoformat() if client.updated_at else ''}"
+    
+    def render_messages():
+        messages, has_more = get_messages_page(client_id, page_size)
+        return render_template('_messages.html', client=client, messages=messages, has_more=has_more)
+    
+    messages_html = fragment_cache.get_or_render(f"messages:{version}:{page_size}", render_messages)
+    messages_count = int(fragment_cache.get_or_render(
+        f"messages_count:{version}",
+        lambda: str(count_messages(client_id))
+    ))
+    return render_template(
+        'client_detail.html',
+        client=client,
+        messages_html=messages_html,
+        messages_count=messages_count,
+        brief_length=brief_length
+    )
+
+@app.route('/client/<int:client_id>/messages')
+@login_required
+@replica_read('client_id')
+def client_messages(client_id):
+    """Более ранние сообщения клиента для бесконечной прокрутки вверх"""
+    limit = min(request.args.get('limit', app.config['MESSAGES_PAGE_SIZE'], type=int), 200)
+    before_timestamp = request.args.get('before_timestamp')
+    before_id = request.args.get('before_id', type=int)
+    
+    if before_timestamp and before_id is not None:
+        try:
+            before_timestamp = datetime.fromisoformat(before_timestamp)
+        except ValueError:
+            return jsonify({'error': 'Invalid before_timestamp'}), 400
+    else:
+        before_timestamp = before_id = None
+    
+    messages, has_more = get_messages_page(client_id, limit, before_timestamp, before_id)
+    return jsonify({
+        'messages': [message_to_dict(msg) for msg in messages],
+        'has_more': has_more
+    })
+
+@app.route('/client/<int:client_id>/brief')
+@login_required
+@replica_read('client_id')
+def client_brief(client_id):
+    """Отрендеренный бриф клиента (на странице клиента он свернут)"""
+    row = db.session.query(Client.updated_at).filter(Client.id == client_id).first()
+    if row is None:
+        return jsonify({'error': 'Client not found'}), 404
+    
+    # Сам бриф читаем из БД только при промахе кэша
+    def render_brief():
+        user_brief = db.session.query(Client.user_brief).filter(Client.id == client_id).scalar()
+        return str(nl2br(user_brief or ''))
+    
+    version = row.updated_at.isoformat() if row.updated_at else ''
+    return jsonify({'html': fragment_cache.get_or_render(f"brief:{client_id}:{version}", render_brief)})
 
 @app.route('/update_client_status', methods=['POST'])
 @login_required
@@ -108,10 +599,14 @@ def update_client_status():
     client_id = request.json.get('client_id')
     new_status = request.json.get('status')
     
-    client = Client.query.get(client_id)
+    # Блокировка строки: параллельные смены статуса учитываются в аналитике по очереди
+    client = Client.query.options(defer(Client.user_brief)).filter_by(id=client_id).with_for_update().first()
     if client:
+        previous_status = client.status
+        record_status_transition(previous_status, new_status)
         client.status = new_status
         client.updated_at = datetime.utcnow()
+        emit_client_event(client, previous_status=previous_status)
         db.session.commit()
         return jsonify({'success': True})
     
@@ -124,6 +619,7 @@ def save_final_message():
         data = request.get_json()
         
         if not data:
+            metrics.INGEST_MESSAGES.labels('save_final_message', 'rejected').inc()
             return jsonify({'error': 'No data provided'}), 400
         
         # Извлекаем данные из запроса
@@ -136,28 +632,28 @@ def save_final_message():
         is_first_message = metadata.get('is_first_message', False)
         
         if not telegram_id or not message_text:
+            metrics.INGEST_MESSAGES.labels('save_final_message', 'rejected').inc()
             return jsonify({'error': 'Missing required fields: telegram_id or message text'}), 400
         
-        # Ищем или создаем клиента
-        client = Client.query.filter_by(telegram_id=telegram_id).first()
+        # Повтор доставки (n8n, Telegram) получает исходный ответ, клиент не меняется
+        idempotency_key = request_idempotency_key('save_final_message', telegram_id, message_data.get('message_id'))
+        if idempotency_key:
+            replay = claim_idempotency_key(idempotency_key)
+            if replay is not None:
+                metrics.INGEST_MESSAGES.labels('save_final_message', 'replayed').inc()
+                return replay
         
-        if not client:
-            # Создаем нового клиента
-            client = Client(
-                telegram_id=telegram_id,
-                name=f"{user_data.get('first_name', '')} {user_data.get('last_name', '')}".strip(),
-                status='новый'
-            )
-            db.session.add(client)
-            db.session.flush()  # Получаем ID клиента
+        # Клиент создается атомарно, строка блокируется до commit: параллельные
+        # запросы того же пользователя выполняются по очереди и не теряют бриф
+        client, is_new_client = lock_or_create_client(
+            telegram_id,
+            name=f"{user_data.get('first_name', '')} {user_data.get('last_name', '')}".strip(),
+            status='новый'
+        )
+        previous_status = None if is_new_client else client.status
         
         # Дополняем user_brief каждым новым сообщением
-        if client.user_brief:
-            # Если уже есть данные, добавляем новое сообщение с разделителем
-            client.user_brief += f"\n\n--- Новое сообщение ---\n{message_text}"
-        else:
-            # Если это первое сообщение, создаем новый бриф
-            client.user_brief = message_text
+        append_user_brief(client, message_text)
         
         client.updated_at = datetime.utcnow()
         
@@ -172,21 +668,153 @@ def save_final_message():
         
         # Обновляем статус клиента если это первое сообщение
         if is_first_message:
+            record_status_transition(client.status, 'в работе')
             client.status = 'в работе'
         
-        db.session.commit()
+        record_ingest_stats(
+            client,
+            message.timestamp,
+            is_new_client,
+            is_voice=message_data.get('message_type') == 'voice'
+        )
+        
+        db.session.flush()
+        if is_new_client or client.status != previous_status:
+            emit_client_event(client, previous_status=previous_status, created=is_new_client)
+        emit_message_event(client, message)
         
-        return jsonify({
+        result = {
             'success': True,
             'client_id': client.id,
             'message_id': message.id,
             'is_first_message': is_first_message
-        })
+        }
+        if idempotency_key:
+            store_idempotent_response(idempotency_key, result)
+        
+        db.session.commit()
+        if idempotency_key:
+            finish_idempotent_request(idempotency_key, result)
+        pin_client_reads(client)
+        metrics.INGEST_MESSAGES.labels('save_final_message', 'stored').inc()
+        if is_new_client:
+            metrics.INGEST_CLIENTS_CREATED.labels('save_final_message').inc()
+        
+        return jsonify(result)
         
     except Exception as e:
         db.session.rollback()
+        metrics.INGEST_MESSAGES.labels('save_final_message', 'failed').inc()
+        if isinstance(e, PoolTimeoutError):
+            # 503 + Retry-After из обработчика db_pool_timeout: n8n повторит запрос
+            raise
         return jsonify({'error': str(e)}), 500
 
+def parse_export_date(value, end_of_day=False):
+    """Дата фильтра выгрузки: YYYY-MM-DD или ISO; конец периода для даты без времени - следующий день"""
+    if not value:
+        return None
+    parsed = datetime.fromisoformat(value)
+    if end_of_day and len(value) == 10:
+        parsed += timedelta(days=1)
+    return parsed
+
+@app.route('/export/clients')
+@login_required
+@replica_read()
+def export_clients():
+    """Потоковая выгрузка клиентов (и их сообщений) в CSV или JSONL"""
+    export_format = request.args.get('format', 'csv')
+    if export_format not in ('csv', 'jsonl'):
+        return jsonify({'error': 'Unsupported format, use csv or jsonl'}), 400
+    
+    with_messages = request.args.get('include_messages', '').lower() in ('1', 'true')
+    use_gzip = request.args.get('gzip', '').lower() in ('1', 'true')
+    status = request.args.get('status')
+    try:
+        date_from = parse_export_date(request.args.get('date_from'))
+        date_to = parse_export_date(request.args.get('date_to'), end_of_day=True)
+    except ValueError:
+        return jsonify({'error': 'Invalid date_from or date_to'}), 400
+    
+    filters = []
+    if status:
+        filters.append(Client.status == status)
+    if date_from:
+        filters.append(Client.created_at >= date_from)
+    if date_to:
+        filters.append(Client.created_at < date_to)
+    
+    # yield_per включает серверный курсор: строки читаются пачками, а не целиком
+    batch_size = app.config['EXPORT_BATCH_SIZE']
+    clients_query = select(
+        Client.id, Client.telegram_id, Client.name, Client.organization, Client.status, Client.traffic_source,
+        Client.project_description, Client.required_functions, Client.user_brief, Client.created_at, Client.updated_at
+    ).where(*filters).order_by(Client.id).execution_options(yield_per=batch_size)
+    # Сообщения - отдельным курсором в том же порядке клиентов: колонки клиента не повторяются в каждой строке
+    messages_query = select(
+        Message.client_id, Message.id, Message.message_text, Message.is_from_bot, Message.timestamp,
+        Message.transcript, Message.template_id, Message.template_params
+    ).join(Client, Message.client_id == Client.id).where(*filters) \
+        .order_by(Message.client_id, Message.timestamp, Message.id).execution_options(yield_per=batch_size)
+    # Месяцы, вынесенные в архив (message_partitions.py), идут перед сообщениями из БД
+    segments_query = select(
+        MessageArchiveSegment.client_id, MessageArchiveSegment.file_name,
+        MessageArchiveSegment.byte_offset, MessageArchiveSegment.byte_length
+    ).join(Client, MessageArchiveSegment.client_id == Client.id).where(*filters) \
+        .order_by(MessageArchiveSegment.client_id).execution_options(yield_per=batch_size)
+    
+    def generate():
+        messages = None
+        if with_messages:
+            # Шаблонов мало: загружаем все заранее, чтобы не делать запросов во время чтения курсора
+            message_templates.load(template_id for template_id, in db.session.query(MessageTemplate.id))
+            messages = export_messages(db.session.execute(messages_query), db.session.execute(segments_query))
+        records = iter_records(db.session.execute(clients_query), messages)
+        if export_format == 'csv':
+            if with_messages:
+                chunks = iter_csv(csv_rows(records), CLIENT_FIELDS + MESSAGE_FIELDS)
+            else:
+                chunks = iter_csv((record[1] for record in records), CLIENT_FIELDS)
+        else:
+            chunks = iter_jsonl(records)
+        
+        if use_gzip:
+            yield from iter_gzip(chunks)
+        else:
+            for chunk in chunks:
+                yield chunk.encode('utf-8')
+    
+    filename = f"clients_{datetime.utcnow().strftime('%Y%m%d_%H%M%S')}.{export_format}"
+    mimetype = 'text/csv' if export_format == 'csv' else 'application/x-ndjson'
+    if use_gzip:
+        filename += '.gz'
+        mimetype = 'application/gzip'
+    
+    response = Response(stream_with_context(generate()), mimetype=mimetype)
+    response.headers['Content-Disposition'] = f'attachment; filename="{filename}"'
+    # Отключаем буферизацию ответа на прокси, чтобы выгрузка шла сразу
+    response.headers['X-Accel-Buffering'] = 'no'
+    return response
+
+def export_messages(rows, segment_rows):
+    """Сообщения выгрузки по клиентам: строки MESSAGE_FIELDS, сначала архивные месяцы,
+    затем сообщения из БД; текст из шаблона вместо пустого message_text"""
+    grouped = GroupedRows(rows)
+    segments = GroupedRows(segment_rows)
+    
+    def messages(client_id):
+        client_segments = list(segments.take(client_id))
+        if client_segments:
+            for msg in read_archived_messages(app.config['MESSAGE_ARCHIVE_DIR'], client_segments):
+                yield msg.id, msg.message_text, msg.is_from_bot, msg.timestamp, msg.transcript
+        for _, message_id, message_text, is_from_bot, timestamp, transcript, template_id, template_params \
+                in grouped.take(client_id):
+            if template_id is not None:
+                message_text = message_templates.expand(template_id, template_params)
+            yield message_id, message_text, is_from_bot, timestamp, transcript
+    return messages
+
 @app.route('/settings', methods=['GET', 'POST'])
 @login_required
 def settings():
@@ -211,34 +839,31 @@ def add_brief():
         data = request.get_json()
         
         if not data:
+            metrics.INGEST_MESSAGES.labels('add_brief', 'rejected').inc()
             return jsonify({'error': 'No data provided'}), 400
         
         telegram_id = data.get('telegram_id')
         text = data.get('text')
         
         if not telegram_id or not text:
+            metrics.INGEST_MESSAGES.labels('add_brief', 'rejected').inc()
             return jsonify({'error': 'Missing required fields: telegram_id or text'}), 400
         
-        # Ищем или создаем клиента
-        client = Client.query.filter_by(telegram_id=telegram_id).first()
+        idempotency_key = request_idempotency_key('add_brief', telegram_id, data.get('message_id'))
+        if idempotency_key:
+            replay = claim_idempotency_key(idempotency_key)
+            if replay is not None:
+                metrics.INGEST_MESSAGES.labels('add_brief', 'replayed').inc()
+                return replay
         
-        if not client:
-            # Создаем нового клиента
-            client = Client(
-                telegram_id=telegram_id,
-                name="Пользователь",
-                status='новый'
-            )
-            db.session.add(client)
-            db.session.flush()
+        client, is_new_client = lock_or_create_client(telegram_id, name="Пользователь", status='новый')
+        previous_status = None if is_new_client else client.status
         
         # Дополняем user_brief
-        if client.user_brief:
-            client.user_brief += f"\n\n--- Новое сообщение ---\n{text}"
-        else:
-            client.user_brief = text
+        append_user_brief(client, text)
         
         client.updated_at = datetime.utcnow()
+        record_status_transition(client.status, 'в работе')
         client.status = 'в работе'
         
         # Сохраняем сообщение в таблицу messages
@@ -249,20 +874,142 @@ def add_brief():
             timestamp=datetime.utcnow()
         )
         db.session.add(message)
+        record_ingest_stats(client, message.timestamp, is_new_client)
         
-        db.session.commit()
+        db.session.flush()
+        if is_new_client or client.status != previous_status:
+            emit_client_event(client, previous_status=previous_status, created=is_new_client)
+        emit_message_event(client, message)
         
-        return jsonify({
+        result = {
             'success': True,
             'client_id': client.id,
             'message_id': message.id
-        })
+        }
+        if idempotency_key:
+            store_idempotent_response(idempotency_key, result)
+        
+        db.session.commit()
+        if idempotency_key:
+            finish_idempotent_request(idempotency_key, result)
+        pin_client_reads(client)
+        metrics.INGEST_MESSAGES.labels('add_brief', 'stored').inc()
+        if is_new_client:
+            metrics.INGEST_CLIENTS_CREATED.labels('add_brief').inc()
+        
+        return jsonify(result)
         
     except Exception as e:
         db.session.rollback()
+        metrics.INGEST_MESSAGES.labels('add_brief', 'failed').inc()
+        if isinstance(e, PoolTimeoutError):
+            # 503 + Retry-After из обработчика db_pool_timeout: n8n повторит запрос
+            raise
         return jsonify({'error': str(e)}), 500
 
+@app.route('/api/analytics', methods=['GET'])
+@login_required
+@replica_read()
+def analytics_summary():
+    """Аналитика по ежедневным агрегатам: ?days=30 или ?date_from=...&date_to=..."""
+    try:
+        date_to = parse_export_date(request.args.get('date_to')) or datetime.utcnow()
+        date_from = parse_export_date(request.args.get('date_from'))
+    except ValueError:
+        return jsonify({'error': 'Invalid date_from or date_to'}), 400
+    if date_from is None:
+        date_from = date_to - timedelta(days=request.args.get('days', 30, type=int) - 1)
+    
+    day_rows = DailyStats.query.filter(DailyStats.day.between(date_from.date(), date_to.date())) \
+        .order_by(DailyStats.day).all()
+    transition_rows = DailyStatusTransition.query \
+        .filter(DailyStatusTransition.day.between(date_from.date(), date_to.date())).all()
+    
+    result = summarize(day_rows, transition_rows)
+    result['date_from'] = date_from.date().isoformat()
+    result['date_to'] = date_to.date().isoformat()
+    return jsonify(result)
+
+# Отдельное подключение для LISTEN в обход PgBouncer (без пула: соединение одно на процесс)
+listen_engine = create_engine(app.config['DATABASE_LISTEN_URL'], poolclass=NullPool) \
+    if app.config['DATABASE_LISTEN_URL'] else None
+if app.config['DB_PGBOUNCER'] and not listen_engine:
+    app.logger.warning("DB_PGBOUNCER без DATABASE_LISTEN_URL: LISTEN через PgBouncer не работает, живые обновления CRM не придут")
+
+def connect_event_listener(engine):
+    """Отдельное соединение psycopg2 для LISTEN (изымается из пула SQLAlchemy)"""
+    connection = engine.raw_connection()
+    # После detach() обертка пула уже не знает драйверное соединение - берем его до этого
+    driver_connection = connection.driver_connection
+    connection.detach()
+    return driver_connection
+
+@app.route('/events')
+@login_required
+def events():
+    """Поток Server-Sent Events: изменения клиентов и новые сообщения (?client_id= - одного клиента)"""
+    client_id = request.args.get('client_id', type=int)
+    if db.engine.dialect.name == 'postgresql':
+        engine = listen_engine or db.engine
+        event_broadcaster.ensure_listener(lambda: connect_event_listener(engine))
+    
+    subscription = event_broadcaster.subscribe(client_id)
+    if subscription is None:
+        return jsonify({'error': 'Too many live connections'}), 503
+    heartbeat = app.config['SSE_HEARTBEAT_SECONDS']
+    
+    # Без stream_with_context: поток не должен держать контекст запроса и соединение с БД
+    def generate():
+        try:
+            yield 'retry: 5000\n\n'
+            while True:
+                try:
+                    event = subscription.queue.get(timeout=heartbeat)
+                except queue.Empty:
+                    # Комментарий SSE не дает прокси закрыть простаивающее соединение
+                    yield ': ping\n\n'
+                    continue
+                if event is None:
+                    yield format_sse('resync', {})
+                    return
+                yield format_sse(*event)
+        finally:
+            event_broadcaster.unsubscribe(subscription)
+    
+    response = Response(generate(), mimetype='text/event-stream')
+    response.headers['Cache-Control'] = 'no-cache'
+    response.headers['X-Accel-Buffering'] = 'no'
+    return response
+
+@app.route('/admin/profiling', methods=['GET', 'POST'])
+@login_required
+def profiling_settings():
+    """Профилирование запросов: GET - состояние и последние профили, POST {"sample_rate": 0.05} - новая доля"""
+    if request.method == 'POST':
+        data = request.get_json(silent=True) or {}
+        try:
+            sample_rate = float(data.get('sample_rate'))
+        except (TypeError, ValueError):
+            sample_rate = -1
+        if not 0 <= sample_rate <= 1:
+            return jsonify({'error': 'sample_rate must be a number from 0 to 1'}), 400
+        request_profiler.set_sample_rate(sample_rate)
+    
+    return jsonify({
+        'sample_rate': request_profiler.sample_rate,
+        'header': app.config['PROFILE_HEADER'],
+        'stats': request_profiler.get_stats(),
+        'profiles': list_profiles(app.config['PROFILE_DIR'])[:50]
+    })
+
+@app.route('/admin/profiling/<name>')
+@login_required
+def download_profile(name):
+    """Профиль в формате folded stacks (flamegraph.pl, speedscope)"""
+    return send_from_directory(app.config['PROFILE_DIR'], name, mimetype='text/plain', as_attachment=True)
+
 @app.route('/api/get_brief/<int:telegram_id>', methods=['GET'])
+@replica_read('telegram_id')
 def get_brief_by_telegram_id(telegram_id):
     """API endpoint для получения полного брифа по Telegram ID"""
     try:
@@ -272,8 +1019,9 @@ def get_brief_by_telegram_id(telegram_id):
         if not client:
             return jsonify({'error': 'Client not found'}), 404
         
-        # Получаем все сообщения клиента
-        messages = Message.query.filter_by(client_id=client.id).order_by(Message.timestamp.asc()).all()
+        # Получаем все сообщения клиента, начиная с вынесенных в архив
+        messages = get_archived_messages(client.id) + \
+            Message.query.filter_by(client_id=client.id).order_by(Message.timestamp.asc()).all()
         
         # Формируем полный бриф
         full_brief = {
@@ -293,10 +1041,11 @@ def get_brief_by_telegram_id(telegram_id):
             'messages': [
                 {
                     'id': msg.id,
-                    'text': msg.message_text,
+                    'text': msg.display_text,
                     'is_from_bot': msg.is_from_bot,
                     'timestamp': msg.timestamp.isoformat() if msg.timestamp else None,
-                    'attachment_path': msg.attachment_path
+                    'attachment_path': msg.attachment_path,
+                    'transcript': msg.transcript
                 }
                 for msg in messages
             ]
@@ -307,6 +1056,16 @@ def get_brief_by_telegram_id(telegram_id):
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
+@app.errorhandler(PoolTimeoutError)
+def db_pool_timeout(e):
+    """Все соединения пула заняты дольше DB_POOL_TIMEOUT: 503, чтобы клиент повторил запрос позже"""
+    db.session.rollback()
+    metrics.DB_POOL_TIMEOUTS.inc()
+    response = jsonify({'error': 'Database is busy, retry later'})
+    response.status_code = 503
+    response.headers['Retry-After'] = '1'
+    return response
+
 def create_admin_user():
     """Создает администратора по умолчанию если его нет"""
     if not User.query.first():
@@ -318,10 +1077,33 @@ def create_admin_user():
         db.session.commit()
         print("Создан пользователь admin с паролем admin123")
 
+def create_app():
+    """Фабрика для gunicorn: gunicorn 'app:create_app()' (настройки - gunicorn.conf.py).
+
+    Приложение настраивается при импорте модуля - скрипты и миграции берут
+    app и db напрямую. С preload_app импорт выполняется один раз в
+    master-процессе, worker'ы получают готовое приложение через fork и делят
+    его память (copy-on-write). Таблицы и администратор здесь не создаются -
+    это делает init_db.py.
+    """
+    if startup_timer.ready_seconds is None:
+        startup_timer.mark('configure')
+        print(startup_timer.ready(), flush=True)
+    return app
+
+def reset_after_fork():
+    """Вызывается в worker'е сразу после fork: соединения, открытые в master-процессе, не переиспользуются"""
+    with app.app_context():
+        db.engine.dispose(close=False)
+    if replica_router:
+        replica_router.engine.dispose(close=False)
+
 if __name__ == '__main__':
     with app.app_context():
         db.create_all()
         create_admin_user()
+    startup_timer.mark('init_db')
+    create_app()
     
     port = int(os.environ.get('PORT', 5000))
     app.run(host='0.0.0.0', port=port, debug=True) 
\ No newline at end of file
@@ -0,0 +1,81 @@
+#!/usr/bin/env python3
+"""
+Пересчет агрегатов аналитики (daily_stats, client_first_reply) по таблицам
+client и message. Нужен один раз после появления аналитики или если
+агрегаты разошлись с данными. История смен статуса не хранится, поэтому
+daily_status_transition не пересчитывается и копится только с момента
+включения аналитики.
+"""
+
+from datetime import date
+from sqlalchemy import case, func, text
+from app import app, db, Client, Message, DailyStats, ClientFirstReply
+from analytics import DailyDelta, VOICE_MESSAGE_PREFIX, daily_stats_upsert_sql
+
+def _day(value):
+    # SQLite возвращает date() строкой
+    return date.fromisoformat(value) if isinstance(value, str) else value
+
+def backfill_analytics():
+    """Пересчитывает агрегаты в одной транзакции"""
+    with app.app_context():
+        db.create_all()
+        delta = DailyDelta()
+
+        print("Подсчет новых клиентов...")
+        created_day = func.date(Client.created_at)
+        for day, count in db.session.query(created_day, func.count(Client.id)).group_by(created_day):
+            delta.add(_day(day), new_clients=count)
+
+        print("Подсчет сообщений...")
+        message_day = func.date(Message.timestamp)
+        is_voice = Message.message_text.like(VOICE_MESSAGE_PREFIX + '%')
+        rows = db.session.query(
+            message_day,
+            func.sum(case((Message.is_from_bot.is_(False), 1), else_=0)),
+            func.sum(case((Message.is_from_bot.is_(True), 1), else_=0)),
+            func.sum(case(((Message.is_from_bot.is_(False)) & is_voice, 1), else_=0))
+        ).group_by(message_day)
+        for day, messages_in, messages_out, voice in rows:
+            messages_in = messages_in or 0
+            voice = voice or 0
+            delta.add(_day(day), messages_in=messages_in, messages_out=messages_out or 0,
+                      voice_messages=voice, text_messages=messages_in - voice)
+
+        print("Подсчет времени до первого ответа...")
+        first_messages = db.session.query(
+            Message.client_id, func.min(Message.timestamp).label('first_message_at')
+        ).filter(Message.is_from_bot.is_(False)).group_by(Message.client_id).subquery()
+        first_replies = db.session.query(
+            first_messages.c.client_id,
+            first_messages.c.first_message_at,
+            db.session.query(func.min(Message.timestamp)).filter(
+                Message.client_id == first_messages.c.client_id,
+                Message.is_from_bot.is_(True),
+                Message.timestamp >= first_messages.c.first_message_at
+            ).scalar_subquery()
+        )
+
+        db.session.query(ClientFirstReply).delete()
+        db.session.query(DailyStats).delete()
+
+        clients = 0
+        for client_id, first_message_at, first_reply_at in first_replies.yield_per(1000):
+            db.session.add(ClientFirstReply(
+                client_id=client_id,
+                first_message_at=first_message_at,
+                first_reply_at=first_reply_at
+            ))
+            if first_reply_at:
+                delta.add(first_reply_at, first_replies=1,
+                          first_reply_seconds=(first_reply_at - first_message_at).total_seconds())
+            clients += 1
+
+        for row in delta.as_dicts():
+            db.session.execute(text(daily_stats_upsert_sql()), row)
+
+        db.session.commit()
+        print(f"Готово: дней {len(delta.as_dicts())}, клиентов с первым сообщением {clients}")
+
+if __name__ == '__main__':
+    backfill_analytics()
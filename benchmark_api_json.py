@@ -0,0 +1,122 @@
+#!/usr/bin/env python3
+"""
+Бенчмарк ответов /api/get_brief: размер на проводе и время сериализации.
+
+Сравнивает стандартный JSON-провайдер Flask (json, ensure_ascii) с
+OrjsonProvider и сжатие gzip / brotli на синтетических брифах разного
+размера (русский текст, как у реальных клиентов). БД не нужна.
+
+Запуск:
+    python benchmark_api_json.py
+    python benchmark_api_json.py --sizes 4,64,512,2048 --repeat 50
+"""
+
+import argparse
+import random
+import time
+from datetime import datetime, timedelta
+
+from flask import Flask
+from flask.json.provider import DefaultJSONProvider
+
+from compression import OrjsonProvider, brotli, compress, orjson
+
+WORDS = (
+    'бот клиент заявка интеграция оплата каталог доставка менеджер рассылка CRM '
+    'магазин запись услуга консультация вопрос ответ бюджет сроки функция уведомление'
+).split()
+
+
+def make_text(size_bytes: int, rnd: random.Random) -> str:
+    words = []
+    size = 0
+    while size < size_bytes:
+        word = rnd.choice(WORDS)
+        words.append(word)
+        size += len(word.encode('utf-8')) + 1
+    return ' '.join(words)
+
+
+def make_brief(brief_kb: int, rnd: random.Random) -> dict:
+    """Ответ get_brief_by_telegram_id: бриф ~brief_kb КБ и переписка того же объема"""
+    started = datetime(2025, 1, 1)
+    messages_count = max(4, brief_kb // 2)
+    message_size = brief_kb * 1024 // messages_count
+    return {
+        'client_info': {
+            'id': 1,
+            'telegram_id': 123456789,
+            'name': 'Иван Петров',
+            'organization': 'ООО Ромашка',
+            'status': 'в работе',
+            'created_at': started.isoformat(),
+            'updated_at': started.isoformat()
+        },
+        'user_brief': make_text(brief_kb * 1024, rnd),
+        'project_description': make_text(512, rnd),
+        'required_functions': make_text(256, rnd),
+        'traffic_source': 'telegram',
+        'messages': [
+            {
+                'id': i,
+                'text': make_text(message_size, rnd),
+                'is_from_bot': i % 2 == 1,
+                'timestamp': (started + timedelta(minutes=i)).isoformat(),
+                'transcript': None
+            }
+            for i in range(messages_count)
+        ]
+    }
+
+
+def measure(func, repeat: int) -> float:
+    """Медианное время одного вызова, мс"""
+    timings = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        func()
+        timings.append(time.perf_counter() - started)
+    timings.sort()
+    return timings[len(timings) // 2] * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Бенчмарк сериализации и сжатия ответов API')
+    parser.add_argument('--sizes', default='4,64,512,2048', help='Размеры брифа в КБ через запятую')
+    parser.add_argument('--repeat', type=int, default=20, help='Повторов на измерение')
+    parser.add_argument('--level', type=int, default=6, help='Уровень сжатия (COMPRESS_LEVEL)')
+    args = parser.parse_args()
+
+    app = Flask(__name__)
+    default_provider = DefaultJSONProvider(app)
+    fast_provider = OrjsonProvider(app)
+    rnd = random.Random(42)
+
+    print(f"orjson: {'да' if orjson else 'нет'}, brotli: {'да' if brotli else 'нет'}, уровень сжатия {args.level}")
+    header = (f"{'бриф':>7} | {'json, мс':>9} | {'orjson, мс':>10} | {'json, байт':>11} | {'utf-8, байт':>11} | "
+              f"{'gzip, байт':>10} | {'gzip, мс':>8} | {'br, байт':>9} | {'br, мс':>7}")
+    print(header)
+    print('-' * len(header))
+
+    for size_kb in (int(value) for value in args.sizes.split(',')):
+        brief = make_brief(size_kb, rnd)
+        with app.app_context():
+            default_ms = measure(lambda: default_provider.dumps(brief), args.repeat)
+            fast_ms = measure(lambda: fast_provider.dumps(brief), args.repeat)
+            default_bytes = default_provider.dumps(brief).encode('utf-8')
+            fast_bytes = fast_provider.dumps(brief).encode('utf-8')
+
+        gzip_bytes = compress(fast_bytes, 'gzip', args.level)
+        gzip_ms = measure(lambda: compress(fast_bytes, 'gzip', args.level), args.repeat)
+        if brotli:
+            br_size = str(len(compress(fast_bytes, 'br', args.level)))
+            br_ms = f"{measure(lambda: compress(fast_bytes, 'br', args.level), args.repeat):.2f}"
+        else:
+            br_size = br_ms = '-'
+
+        print(f"{size_kb:>5}КБ | {default_ms:>9.2f} | {fast_ms:>10.2f} | {len(default_bytes):>11} | "
+              f"{len(fast_bytes):>11} | {len(gzip_bytes):>10} | {gzip_ms:>8.2f} | {br_size:>9} | {br_ms:>7}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,407 @@
+#!/usr/bin/env python3
+"""
+Офлайн-бенчмарк обработчиков Telegram-бота.
+
+Прогоняет синтетические update (/start, текст, голосовые, нажатия кнопок)
+через обработчики, зарегистрированные build_application(), без Telegram,
+n8n и OpenAI:
+- Bot API подменяется FakeBotApi (ответы формируются локально, с задержкой);
+- n8n, OpenAI (расшифровка, эмбеддинги, чат), Qdrant и скачивание файлов
+  Telegram обслуживает локальный aiohttp-сервер с настраиваемой задержкой;
+- БД - настоящий PostgreSQL (--database-url), без него шаги с БД пропускаются.
+
+Update обрабатываются так же, как в боте: по очереди (или по
+--concurrent-updates одновременно). Для каждого типа update выводятся
+задержка от поступления до конца обработки (p50/p95/p99), время самой
+обработки, SQL-запросы к БД на update, вызовы Bot API и общая
+пропускная способность при --users одновременных пользователях.
+
+Запуск:
+    python benchmark_bot.py --users 50 --messages 5
+    python benchmark_bot.py --database-url postgresql://localhost/clienterra_bench --voice-ratio 0.2
+    python benchmark_bot.py --users 200 --telegram-latency 80 --n8n-latency 300 --concurrent-updates 16
+"""
+
+import argparse
+import asyncio
+import itertools
+import json
+import logging
+import math
+import random
+import time
+from collections import Counter, defaultdict
+from contextvars import ContextVar
+from datetime import datetime
+from typing import Optional
+
+import openai
+from aiohttp import web
+from telegram import Update
+from telegram.request import BaseRequest
+
+import telegram_bot
+from metrics import record_await
+
+HARNESS_TOKEN = '123456:harness'
+
+# Счетчик SQL-запросов обрабатываемого update (колбэк логгера asyncpg выполняется в его контексте)
+_db_queries: ContextVar[Optional[list]] = ContextVar('harness_db_queries', default=None)
+
+
+class FakeBotApi(BaseRequest):
+    """Bot API без сети: отвечает как Telegram на используемые ботом методы"""
+
+    def __init__(self, latency: float):
+        self.latency = latency
+        self.calls = Counter()
+        self._message_ids = itertools.count(1_000_000)
+
+    async def initialize(self) -> None:
+        pass
+
+    async def shutdown(self) -> None:
+        pass
+
+    async def do_request(self, url, method, request_data=None, read_timeout=None, write_timeout=None,
+                         connect_timeout=None, pool_timeout=None):
+        endpoint = url.rsplit('/', 1)[-1]
+        self.calls[endpoint] += 1
+        started = time.perf_counter()
+        await asyncio.sleep(self.latency)
+        record_await('telegram', time.perf_counter() - started)
+        parameters = request_data.parameters if request_data else {}
+        return 200, json.dumps({'ok': True, 'result': self.result(endpoint, parameters)}).encode()
+
+    def result(self, endpoint: str, parameters: dict):
+        if endpoint == 'getMe':
+            return {'id': 1, 'is_bot': True, 'first_name': 'Harness', 'username': 'harness_bot'}
+        if endpoint == 'sendMessage':
+            return {
+                'message_id': next(self._message_ids),
+                'date': int(time.time()),
+                'chat': {'id': int(parameters['chat_id']), 'type': 'private'},
+                'from': {'id': 1, 'is_bot': True, 'first_name': 'Harness'},
+                'text': parameters.get('text', '')
+            }
+        if endpoint == 'getFile':
+            file_id = parameters['file_id']
+            return {'file_id': file_id, 'file_unique_id': file_id, 'file_size': 16000,
+                    'file_path': f'voice/{file_id}.oga'}
+        return True
+
+
+class StubServices:
+    """Локальные заглушки n8n, OpenAI, Qdrant и файлов Telegram с задержкой ответа"""
+
+    def __init__(self, n8n_latency: float, openai_latency: float, qdrant_latency: float):
+        self.n8n_latency = n8n_latency
+        self.openai_latency = openai_latency
+        self.qdrant_latency = qdrant_latency
+        self.calls = Counter()
+        self.runner = None
+        self.url = None
+
+    def handler(self, name: str, latency: float, body):
+        async def handle(request):
+            self.calls[name] += 1
+            await request.read()
+            await asyncio.sleep(latency)
+            if isinstance(body, bytes):
+                return web.Response(body=body, content_type='application/octet-stream')
+            return web.json_response(body)
+        return handle
+
+    async def start(self) -> str:
+        application = web.Application(client_max_size=64 * 1024 * 1024)
+        application.router.add_post('/n8n', self.handler('n8n', self.n8n_latency, {'ok': True}))
+        application.router.add_post('/v1/audio/transcriptions', self.handler(
+            'openai_transcription', self.openai_latency, {'text': 'Расшифровка голосового сообщения'}))
+        application.router.add_post('/v1/embeddings', self.handler(
+            'openai_embedding', self.openai_latency,
+            {'object': 'list', 'data': [{'object': 'embedding', 'index': 0, 'embedding': [0.0] * 1536}]}))
+        application.router.add_post('/v1/chat/completions', self.handler(
+            'openai_chat', self.openai_latency,
+            {'object': 'chat.completion', 'choices': [
+                {'index': 0, 'finish_reason': 'stop', 'message': {'role': 'assistant', 'content': 'Ответ'}}]}))
+        application.router.add_post('/collections/{name}/points/search', self.handler(
+            'qdrant_search', self.qdrant_latency,
+            {'status': 'ok', 'time': 0.001, 'result': [
+                {'id': 1, 'version': 0, 'score': 0.9, 'payload': {'text': 'Знание из базы'}}]}))
+        application.router.add_get('/file/{tail:.*}', self.handler('telegram_file', 0, b'\0' * 16000))
+
+        self.runner = web.AppRunner(application, access_log=None)
+        await self.runner.setup()
+        site = web.TCPSite(self.runner, '127.0.0.1', 0)
+        await site.start()
+        port = site._server.sockets[0].getsockname()[1]
+        self.url = f'http://127.0.0.1:{port}'
+        return self.url
+
+    async def stop(self) -> None:
+        if self.runner:
+            await self.runner.cleanup()
+
+
+class UpdateFactory:
+    """Синтетические update в формате Bot API"""
+
+    def __init__(self, bot):
+        self.bot = bot
+        self._update_ids = itertools.count(1)
+        self._message_ids = itertools.count(1)
+
+    def _user(self, user_id: int) -> dict:
+        return {'id': user_id, 'is_bot': False, 'first_name': f'Пользователь {user_id}', 'language_code': 'ru'}
+
+    def _message(self, user_id: int, **fields) -> dict:
+        message = {
+            'message_id': next(self._message_ids),
+            'date': int(time.time()),
+            'chat': {'id': user_id, 'type': 'private'},
+            'from': self._user(user_id)
+        }
+        message.update(fields)
+        return message
+
+    def start(self, user_id: int) -> Update:
+        return Update.de_json({'update_id': next(self._update_ids), 'message': self._message(
+            user_id, text='/start', entities=[{'type': 'bot_command', 'offset': 0, 'length': 6}])}, self.bot)
+
+    def text(self, user_id: int, text: str) -> Update:
+        return Update.de_json({'update_id': next(self._update_ids), 'message': self._message(user_id, text=text)},
+                              self.bot)
+
+    def voice(self, user_id: int, duration: int) -> Update:
+        file_id = f'voice-{user_id}-{next(self._message_ids)}'
+        return Update.de_json({'update_id': next(self._update_ids), 'message': self._message(user_id, voice={
+            'file_id': file_id, 'file_unique_id': file_id, 'duration': duration,
+            'mime_type': 'audio/ogg', 'file_size': 16000})}, self.bot)
+
+    def callback(self, user_id: int, data: str) -> Update:
+        return Update.de_json({'update_id': next(self._update_ids), 'callback_query': {
+            'id': f'cb-{user_id}-{next(self._message_ids)}',
+            'from': self._user(user_id),
+            'chat_instance': str(user_id),
+            'data': data,
+            'message': self._message(user_id, text='🤔 Есть ли у вас что-то еще рассказать?')
+        }}, self.bot)
+
+
+def update_kind(update: Update) -> str:
+    if update.callback_query:
+        return 'callback_query'
+    if update.message.voice:
+        return 'voice'
+    if update.message.text == '/start':
+        return 'start'
+    return 'text'
+
+
+def percentile(sorted_values, fraction: float) -> float:
+    if not sorted_values:
+        return 0.0
+    rank = math.ceil(fraction * len(sorted_values))
+    return sorted_values[min(len(sorted_values), max(1, rank)) - 1]
+
+
+async def simulate_user(user_id: int, args, factory: UpdateFactory, queue: asyncio.Queue, rnd: random.Random):
+    """Пользователь: /start, серия сообщений с паузами, нажатие кнопки"""
+    updates = [factory.start(user_id)]
+    for i in range(args.messages):
+        if rnd.random() < args.voice_ratio:
+            updates.append(factory.voice(user_id, rnd.randint(2, 30)))
+        else:
+            updates.append(factory.text(user_id, f'Сообщение {i + 1}: нужен бот для записи клиентов и оплаты'))
+    if args.callbacks:
+        updates.append(factory.callback(user_id, rnd.choice(['more_info', 'ready_for_proposal'])))
+
+    for update in updates:
+        await queue.put((time.perf_counter(), update))
+        await asyncio.sleep(rnd.uniform(0, 2 * args.think_ms / 1000))
+
+
+async def consume(application, queue: asyncio.Queue, results: dict) -> None:
+    """Обработка update, как в Application: process_update по одному"""
+    while True:
+        enqueued, update = await queue.get()
+        counter = [0]
+        token = _db_queries.set(counter)
+        started = time.perf_counter()
+        try:
+            await application.process_update(update)
+        finally:
+            finished = time.perf_counter()
+            _db_queries.reset(token)
+            # Колбэки логгера запросов asyncpg выполняются через call_soon
+            await asyncio.sleep(0)
+            kind = update_kind(update)
+            results[kind].append((finished - enqueued, finished - started, counter[0]))
+            queue.task_done()
+
+
+def count_query(record) -> None:
+    counter = _db_queries.get()
+    if counter is not None:
+        counter[0] += 1
+
+
+async def add_query_logger(connection) -> None:
+    connection.add_query_logger(count_query)
+
+
+async def run(args) -> dict:
+    stubs = StubServices(args.n8n_latency / 1000, args.openai_latency / 1000, args.qdrant_latency / 1000)
+    stub_url = await stubs.start()
+
+    # Внешние сервисы бота - локальные заглушки
+    telegram_bot.N8N_WEBHOOK_URL = f'{stub_url}/n8n'
+    telegram_bot.OPENAI_API_KEY = openai.api_key = 'harness'
+    openai.api_base = f'{stub_url}/v1'
+    telegram_bot.DATABASE_URL = args.database_url
+    if not args.rate_limit:
+        telegram_bot.RATE_LIMIT_ENABLED = False
+
+    bot = telegram_bot.bot_instance = telegram_bot.TelegramBot()
+    bot.debouncer.window = args.debounce_ms / 1000
+    bot.debouncer.max_window = max(bot.debouncer.max_window, bot.debouncer.window)
+    if telegram_bot.QDRANT_AVAILABLE:
+        bot.qdrant_client = telegram_bot.create_qdrant_client(stub_url)
+
+    fake_api = FakeBotApi(args.telegram_latency / 1000)
+    application = telegram_bot.build_application(HARNESS_TOKEN, fake_api, base_file_url=f'{stub_url}/file/bot')
+
+    if args.database_url:
+        await bot.init_db_pool(init=add_query_logger)
+    if bot.deferred_queue:
+        bot.deferred_queue.start()
+    if bot.voice_pipeline and bot.db_pool:
+        bot.voice_pipeline.start()
+    await application.initialize()
+
+    factory = UpdateFactory(application.bot)
+    queue: asyncio.Queue = asyncio.Queue()
+    results = defaultdict(list)
+    consumers = [asyncio.create_task(consume(application, queue, results)) for _ in range(args.concurrent_updates)]
+    rnd = random.Random(args.seed)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(
+        simulate_user(args.first_user_id + i, args, factory, queue, random.Random(rnd.random()))
+        for i in range(args.users)
+    ))
+    await queue.join()
+    handlers_done = time.perf_counter()
+    # Серии сообщений, отложенные отправки и расшифровки доделываются после обработчиков
+    await bot.debouncer.flush_all()
+    if bot.deferred_queue:
+        await bot.deferred_queue.close()
+    if bot.voice_pipeline and bot.db_pool:
+        await bot.voice_pipeline.close()
+    finished = time.perf_counter()
+
+    for consumer in consumers:
+        consumer.cancel()
+    await application.shutdown()
+    await bot.close_db_pool()
+    await stubs.stop()
+
+    return {
+        'results': results,
+        'handlers_seconds': handlers_done - started,
+        'total_seconds': finished - started,
+        'telegram_calls': dict(fake_api.calls),
+        'stub_calls': dict(stubs.calls),
+        'debouncer': bot.debouncer.get_stats(),
+        'rate_limit': bot.get_rate_limit_stats(),
+        'voice': bot.voice_pipeline.get_stats() if bot.voice_pipeline else {}
+    }
+
+
+def report(args, run_result: dict) -> dict:
+    results = run_result['results']
+    total_updates = sum(len(items) for items in results.values())
+    summary = {
+        'users': args.users,
+        'updates': total_updates,
+        'updates_per_second': round(total_updates / run_result['handlers_seconds'], 1),
+        'total_seconds': round(run_result['total_seconds'], 2),
+        'by_type': {}
+    }
+
+    print(f"Пользователей: {args.users}, update: {total_updates}, обработка по {args.concurrent_updates}, "
+          f"БД: {'PostgreSQL' if args.database_url else 'нет'}")
+    header = (f"{'тип update':<15} | {'шт':>5} | {'p50, мс':>8} | {'p95, мс':>8} | {'p99, мс':>8} | "
+              f"{'обработка p50':>13} | {'обработка p95':>13} | {'SQL на update':>13}")
+    print(header)
+    print('-' * len(header))
+    for kind in ('start', 'text', 'voice', 'callback_query'):
+        items = results.get(kind)
+        if not items:
+            continue
+        latencies = sorted(item[0] * 1000 for item in items)
+        processing = sorted(item[1] * 1000 for item in items)
+        queries = [item[2] for item in items]
+        row = {
+            'count': len(items),
+            'p50_ms': round(percentile(latencies, 0.5), 2),
+            'p95_ms': round(percentile(latencies, 0.95), 2),
+            'p99_ms': round(percentile(latencies, 0.99), 2),
+            'processing_p50_ms': round(percentile(processing, 0.5), 2),
+            'processing_p95_ms': round(percentile(processing, 0.95), 2),
+            'db_queries_avg': round(sum(queries) / len(queries), 2),
+            'db_queries_max': max(queries)
+        }
+        summary['by_type'][kind] = row
+        print(f"{kind:<15} | {row['count']:>5} | {row['p50_ms']:>8} | {row['p95_ms']:>8} | {row['p99_ms']:>8} | "
+              f"{row['processing_p50_ms']:>13} | {row['processing_p95_ms']:>13} | "
+              f"{row['db_queries_avg']:>8} (макс {row['db_queries_max']})")
+
+    print(f"\nПропускная способность: {summary['updates_per_second']} update/с "
+          f"(с досылкой серий и расшифровкой - {summary['total_seconds']} с всего)")
+    print(f"Вызовы Bot API: {run_result['telegram_calls']}")
+    print(f"Вызовы заглушек: {run_result['stub_calls']}")
+    print(f"Склейка сообщений: {run_result['debouncer']}")
+    if run_result['rate_limit']:
+        print(f"Лимиты сообщений: {run_result['rate_limit']}")
+    if run_result['voice']:
+        print(f"Голосовые: {run_result['voice']}")
+
+    summary.update({key: run_result[key] for key in ('telegram_calls', 'stub_calls', 'debouncer')})
+    return summary
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Офлайн-бенчмарк обработчиков Telegram-бота')
+    parser.add_argument('--users', type=int, default=20, help='Одновременных пользователей')
+    parser.add_argument('--messages', type=int, default=5, help='Сообщений от каждого пользователя после /start')
+    parser.add_argument('--voice-ratio', type=float, default=0.1, help='Доля голосовых сообщений')
+    parser.add_argument('--no-callbacks', dest='callbacks', action='store_false', help='Без нажатия кнопки в конце')
+    parser.add_argument('--think-ms', type=float, default=200, help='Средняя пауза пользователя между сообщениями')
+    parser.add_argument('--concurrent-updates', type=int, default=1,
+                        help='Сколько update обрабатывать одновременно (в боте - 1)')
+    parser.add_argument('--telegram-latency', type=float, default=50, help='Задержка Bot API, мс')
+    parser.add_argument('--n8n-latency', type=float, default=200, help='Задержка webhook n8n, мс')
+    parser.add_argument('--openai-latency', type=float, default=800, help='Задержка OpenAI, мс')
+    parser.add_argument('--qdrant-latency', type=float, default=30, help='Задержка Qdrant, мс')
+    parser.add_argument('--debounce-ms', type=float, default=300, help='Окно склейки сообщений (в боте - 3000)')
+    parser.add_argument('--no-rate-limit', dest='rate_limit', action='store_false', help='Отключить лимиты сообщений')
+    parser.add_argument('--database-url', help='PostgreSQL со схемой CRM (init_db.py); без него БД не используется')
+    parser.add_argument('--first-user-id', type=int, default=int(datetime.utcnow().timestamp()) * 1000,
+                        help='telegram_id первого пользователя (по умолчанию новые на каждый запуск)')
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--json', help='Сохранить результаты в файл')
+    parser.add_argument('--verbose', action='store_true', help='Показывать INFO-логи бота')
+    args = parser.parse_args()
+
+    if not args.verbose:
+        logging.getLogger().setLevel(logging.WARNING)
+
+    summary = report(args, asyncio.run(run(args)))
+    if args.json:
+        with open(args.json, 'w', encoding='utf-8') as f:
+            json.dump(summary, f, ensure_ascii=False, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,362 @@
+#!/usr/bin/env python3
+"""
+Нагрузочный бенчмарк API приема сообщений и выдачи брифа.
+
+Заполняет базу клиентами с длинными брифами и перепиской, запускает
+приложение отдельным процессом (werkzeug или gunicorn) и нагружает
+/api/save_final_message, /api/add_brief и /api/get_brief/<telegram_id>
+заданным числом параллельных клиентов. Для каждого профиля данных
+(размер брифа и число сообщений) и маршрута выводит запросы в секунду и
+задержку p50/p95/p99, а также рост p95 от малого профиля к большому.
+
+Результаты можно сохранить как базовые (--save-baseline) и сравнивать с
+ними в CI (--check-baseline): код выхода 1, если p95 вырос или RPS упал
+больше допуска. Базовые значения хранятся отдельно для SQLite и
+PostgreSQL и имеют смысл только на той же машине.
+
+Запуск:
+    python benchmark_ingest.py                       # SQLite во временном каталоге, быстро
+    python benchmark_ingest.py --database-url postgresql://localhost/clienterra_bench --reset-database
+    python benchmark_ingest.py --server gunicorn --workers 2 --threads 4 --concurrency 16
+    python benchmark_ingest.py --save-baseline
+    python benchmark_ingest.py --check-baseline --tolerance 0.3
+"""
+
+import argparse
+import json
+import math
+import os
+import random
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from datetime import datetime, timedelta
+
+import requests
+
+BASE_TELEGRAM_ID = 9_000_000_000
+BASELINE_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'benchmark_ingest_baseline.json')
+
+# Профили данных: название -> (клиентов, размер брифа в КБ, сообщений на клиента)
+PROFILES = {
+    'small': (200, 2, 10),
+    'large': (200, 128, 300),
+}
+SCENARIOS = ('save_final_message', 'add_brief', 'get_brief')
+
+WORDS = (
+    'бот клиент заявка интеграция оплата каталог доставка менеджер рассылка CRM '
+    'магазин запись услуга консультация вопрос ответ бюджет сроки функция уведомление'
+).split()
+
+
+def make_corpus(size_bytes: int, rnd: random.Random) -> str:
+    """Текст, из которого вырезаются брифы и сообщения (генерировать каждый отдельно слишком долго)"""
+    words = []
+    size = 0
+    while size < size_bytes:
+        word = rnd.choice(WORDS)
+        words.append(word)
+        size += len(word) + 1
+    return ' '.join(words)
+
+
+def cut(corpus: str, length: int, rnd: random.Random) -> str:
+    start = rnd.randrange(0, max(1, len(corpus) - length))
+    return corpus[start:start + length]
+
+
+def seed(app, db, clients: int, brief_kb: int, messages: int, rnd: random.Random) -> None:
+    """Пересоздает таблицы и заполняет их клиентами и перепиской"""
+    from sqlalchemy import insert
+    from app import Client, Message
+
+    corpus = make_corpus(max(brief_kb * 1024 * 2, 1024 * 1024), rnd)
+    now = datetime.utcnow()
+    with app.app_context():
+        db.drop_all()
+        db.create_all()
+        db.session.execute(insert(Client), [
+            {
+                'telegram_id': BASE_TELEGRAM_ID + i,
+                'name': f'Клиент {i}',
+                'organization': f'Компания {i}',
+                'status': 'в работе',
+                'user_brief': cut(corpus, brief_kb * 1024, rnd),
+                'created_at': now - timedelta(days=30),
+                'updated_at': now
+            }
+            for i in range(clients)
+        ])
+        client_ids = [row.id for row in db.session.query(Client.id)]
+        batch = []
+        for client_id in client_ids:
+            started = now - timedelta(days=30)
+            for j in range(messages):
+                batch.append({
+                    'client_id': client_id,
+                    'message_text': cut(corpus, rnd.randint(50, 600), rnd),
+                    'is_from_bot': j % 2 == 1,
+                    'timestamp': started + timedelta(minutes=j)
+                })
+                if len(batch) >= 10000:
+                    db.session.execute(insert(Message), batch)
+                    batch = []
+        if batch:
+            db.session.execute(insert(Message), batch)
+        db.session.commit()
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def serve(port: int) -> None:
+    """Режим дочернего процесса: приложение на werkzeug без журнала запросов"""
+    from werkzeug.serving import WSGIRequestHandler, make_server
+    from app import app
+
+    class QuietHandler(WSGIRequestHandler):
+        # keep-alive, как у gunicorn за прокси
+        protocol_version = 'HTTP/1.1'
+
+        def log_request(self, *args, **kwargs):
+            pass
+
+    make_server('127.0.0.1', port, app, threaded=True, request_handler=QuietHandler).serve_forever()
+
+
+def start_server(args, database_url: str):
+    port = free_port()
+    env = dict(os.environ, DATABASE_URL=database_url, GUNICORN_THREADS=str(args.threads))
+    if args.server == 'gunicorn':
+        command = [sys.executable, '-m', 'gunicorn', 'app:create_app()', '--bind', f'127.0.0.1:{port}',
+                   '--workers', str(args.workers), '--log-level', 'warning']
+    else:
+        command = [sys.executable, os.path.abspath(__file__), '--serve', str(port)]
+    process = subprocess.Popen(command, env=env, cwd=os.path.dirname(os.path.abspath(__file__)))
+
+    url = f'http://127.0.0.1:{port}'
+    deadline = time.monotonic() + 30
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f'Сервер завершился с кодом {process.returncode}')
+        try:
+            requests.get(f'{url}/login', timeout=1)
+            return process, url
+        except requests.ConnectionError:
+            time.sleep(0.2)
+    process.kill()
+    raise RuntimeError('Сервер не запустился за 30 секунд')
+
+
+class LoadRunner:
+    """Параллельные клиенты requests.Session, каждый шлет запросы подряд до конца отведенного времени"""
+
+    def __init__(self, url: str, clients: int, concurrency: int, seed_value: int):
+        self.url = url
+        self.clients = clients
+        self.concurrency = concurrency
+        self.seed_value = seed_value
+        self._message_id = 0
+        self._lock = threading.Lock()
+
+    def next_message_id(self) -> int:
+        with self._lock:
+            self._message_id += 1
+            return self._message_id
+
+    def request(self, session: requests.Session, scenario: str, rnd: random.Random) -> requests.Response:
+        telegram_id = BASE_TELEGRAM_ID + rnd.randrange(self.clients)
+        text = ' '.join(rnd.choice(WORDS) for _ in range(rnd.randint(10, 80)))
+        if scenario == 'save_final_message':
+            return session.post(f'{self.url}/api/save_final_message', json={
+                'user': {'telegram_id': telegram_id, 'first_name': 'Нагрузка', 'last_name': 'Тест'},
+                'message': {'text': text, 'message_type': 'text', 'message_id': self.next_message_id()},
+                'metadata': {'is_first_message': False}
+            })
+        if scenario == 'add_brief':
+            return session.post(f'{self.url}/api/add_brief', json={'telegram_id': telegram_id, 'text': text})
+        return session.get(f'{self.url}/api/get_brief/{telegram_id}')
+
+    def run(self, scenario: str, duration: float, warmup: float) -> dict:
+        latencies = []
+        errors = []
+        started_at = time.monotonic()
+        measure_from = started_at + warmup
+        stop_at = measure_from + duration
+
+        def worker(index: int):
+            rnd = random.Random(self.seed_value * 1000 + index)
+            with requests.Session() as session:
+                while True:
+                    started = time.monotonic()
+                    if started >= stop_at:
+                        return
+                    try:
+                        response = self.request(session, scenario, rnd)
+                        failed = response.status_code != 200
+                    except requests.RequestException:
+                        failed = True
+                    finished = time.monotonic()
+                    if started >= measure_from:
+                        latencies.append(finished - started)
+                        if failed:
+                            errors.append(1)
+
+        threads = [threading.Thread(target=worker, args=(i,)) for i in range(self.concurrency)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return summarize(latencies, len(errors), duration)
+
+
+def percentile(sorted_values, fraction: float) -> float:
+    """Перцентиль по ближайшему рангу"""
+    if not sorted_values:
+        return 0.0
+    rank = math.ceil(fraction * len(sorted_values))
+    return sorted_values[min(len(sorted_values), max(1, rank)) - 1]
+
+
+def summarize(latencies, errors: int, duration: float) -> dict:
+    latencies = sorted(latencies)
+    return {
+        'requests': len(latencies),
+        'errors': errors,
+        'rps': round(len(latencies) / duration, 1),
+        'p50_ms': round(percentile(latencies, 0.50) * 1000, 2),
+        'p95_ms': round(percentile(latencies, 0.95) * 1000, 2),
+        'p99_ms': round(percentile(latencies, 0.99) * 1000, 2),
+    }
+
+
+def compare(results: dict, baseline: dict, tolerance: float) -> list:
+    """Регрессии относительно базовых значений: рост p95 или падение RPS больше допуска"""
+    regressions = []
+    for key, result in results.items():
+        base = baseline.get(key)
+        if not base:
+            continue
+        if result['p95_ms'] > base['p95_ms'] * (1 + tolerance):
+            regressions.append(f"{key}: p95 {result['p95_ms']} мс, базовое {base['p95_ms']} мс")
+        if result['rps'] < base['rps'] * (1 - tolerance):
+            regressions.append(f"{key}: {result['rps']} запросов/с, базовое {base['rps']}")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Нагрузочный бенчмарк API приема сообщений')
+    parser.add_argument('--database-url', default=os.getenv('BENCH_DATABASE_URL'),
+                        help='PostgreSQL для бенчмарка (по умолчанию временная SQLite)')
+    parser.add_argument('--reset-database', action='store_true',
+                        help='Разрешить пересоздание таблиц в --database-url (все данные базы удаляются)')
+    parser.add_argument('--profiles', default=','.join(PROFILES), help='Профили данных через запятую')
+    parser.add_argument('--scenarios', default=','.join(SCENARIOS), help='Маршруты через запятую')
+    parser.add_argument('--clients', type=int, help='Число клиентов вместо значения профиля')
+    parser.add_argument('--concurrency', type=int, default=8, help='Параллельных клиентов нагрузки')
+    parser.add_argument('--duration', type=float, default=10, help='Секунд измерения на маршрут')
+    parser.add_argument('--warmup', type=float, default=2, help='Секунд прогрева перед измерением')
+    parser.add_argument('--server', choices=('werkzeug', 'gunicorn'), default='werkzeug')
+    parser.add_argument('--workers', type=int, default=2, help='Worker\'ов gunicorn')
+    parser.add_argument('--threads', type=int, default=4, help='Потоков на worker gunicorn')
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--baseline-file', default=BASELINE_FILE)
+    parser.add_argument('--save-baseline', action='store_true', help='Сохранить результаты как базовые')
+    parser.add_argument('--check-baseline', action='store_true', help='Код выхода 1 при регрессии')
+    parser.add_argument('--tolerance', type=float, default=0.3, help='Допустимое ухудшение (0.3 = 30%%)')
+    parser.add_argument('--json', help='Сохранить результаты прогона в файл')
+    parser.add_argument('--serve', type=int, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.serve:
+        serve(args.serve)
+        return
+
+    if args.database_url:
+        if not args.reset_database:
+            parser.error('бенчмарк пересоздает таблицы: укажите --reset-database для базы, которую можно очистить')
+        database_url = args.database_url
+        mode = 'postgresql'
+    else:
+        database_url = f"sqlite:///{os.path.join(tempfile.mkdtemp(prefix='ingest_bench_'), 'bench.db')}"
+        mode = 'sqlite'
+    # База задается до импорта приложения
+    os.environ['DATABASE_URL'] = database_url
+    from app import app, db
+
+    rnd = random.Random(args.seed)
+    results = {}
+    print(f"База: {mode}, сервер: {args.server}, параллельных клиентов: {args.concurrency}, "
+          f"{args.duration:g} с на маршрут")
+    header = (f"{'профиль':<8} | {'маршрут':<20} | {'запросов/с':>10} | {'p50, мс':>8} | {'p95, мс':>8} | "
+              f"{'p99, мс':>8} | {'ошибок':>6}")
+    print(header)
+    print('-' * len(header))
+
+    for profile in args.profiles.split(','):
+        clients, brief_kb, messages = PROFILES[profile]
+        clients = args.clients or clients
+        seed(app, db, clients, brief_kb, messages, rnd)
+        process, url = start_server(args, database_url)
+        try:
+            runner = LoadRunner(url, clients, args.concurrency, args.seed)
+            for scenario in args.scenarios.split(','):
+                result = runner.run(scenario, args.duration, args.warmup)
+                results[f'{profile}/{scenario}'] = result
+                print(f"{profile:<8} | {scenario:<20} | {result['rps']:>10} | {result['p50_ms']:>8} | "
+                      f"{result['p95_ms']:>8} | {result['p99_ms']:>8} | {result['errors']:>6}")
+        finally:
+            process.terminate()
+            process.wait(timeout=10)
+
+    # Как растет задержка с размером брифа и истории
+    profiles = args.profiles.split(',')
+    if len(profiles) > 1:
+        for scenario in args.scenarios.split(','):
+            first, last = results.get(f'{profiles[0]}/{scenario}'), results.get(f'{profiles[-1]}/{scenario}')
+            if first and last and first['p95_ms']:
+                print(f"{scenario}: p95 {profiles[-1]}/{profiles[0]} = x{last['p95_ms'] / first['p95_ms']:.1f}")
+
+    if args.json:
+        with open(args.json, 'w', encoding='utf-8') as f:
+            json.dump({'mode': mode, 'results': results}, f, ensure_ascii=False, indent=2)
+
+    baselines = {}
+    if os.path.exists(args.baseline_file):
+        with open(args.baseline_file, encoding='utf-8') as f:
+            baselines = json.load(f)
+
+    failed = any(result['errors'] for result in results.values())
+    if failed:
+        print("❌ Есть ошибочные ответы")
+
+    if args.check_baseline:
+        if mode not in baselines:
+            print(f"⚠️ Нет базовых значений для {mode} в {args.baseline_file}")
+        else:
+            regressions = compare(results, baselines[mode], args.tolerance)
+            for regression in regressions:
+                print(f"❌ Регрессия {regression}")
+            failed = failed or bool(regressions)
+            if not regressions:
+                print(f"✅ Нет регрессий относительно базовых значений (допуск {args.tolerance:.0%})")
+
+    if args.save_baseline:
+        baselines[mode] = results
+        with open(args.baseline_file, 'w', encoding='utf-8') as f:
+            json.dump(baselines, f, ensure_ascii=False, indent=2, sort_keys=True)
+        print(f"Базовые значения {mode} сохранены в {args.baseline_file}")
+
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
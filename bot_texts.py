@@ -0,0 +1,18 @@
+"""
+Служебные тексты бота, которые сохраняются в переписку клиента.
+
+Они одинаковы для всех клиентов и пишутся в message ссылкой на шаблон
+(message_templates.py). Задача очистки (retention.py) находит их по точному
+совпадению текста шаблона или самого сообщения (записанные до шаблонов) -
+при изменении текста старые формулировки нужно оставить в BOILERPLATE_TEXTS.
+"""
+
+FOLLOW_UP_QUESTION = "🤔 Есть ли у вас что-то еще рассказать, или можно формировать итоговое предложение?"
+
+CHOICE_REPLIES = {
+    "more_info": "👍 Отлично! Расскажите подробнее о ваших потребностях. Это поможет нам создать более точное предложение.",
+    "ready_for_proposal": "🎯 Понятно! Сейчас мы проанализируем всю информацию и подготовим для вас персональное предложение. Это займет несколько минут."
+}
+CHOICE_ERROR_REPLY = "Извините, произошла ошибка. Попробуйте еще раз."
+
+BOILERPLATE_TEXTS = (FOLLOW_UP_QUESTION, CHOICE_ERROR_REPLY) + tuple(CHOICE_REPLIES.values())
@@ -0,0 +1,128 @@
+#!/usr/bin/env python3
+"""
+Проверка бюджета SQL-запросов основных страниц и API.
+
+Создает временную SQLite-базу с клиентами и перепиской, выполняет запросы
+через тестовый клиент Flask и проверяет, что число SQL-запросов не
+превышает бюджет и не растет вместе с объемом данных (N+1). Код выхода 1
+при нарушении - скрипт можно запускать в CI.
+
+Запуск:
+    python check_query_budgets.py
+    python check_query_budgets.py --clients 200 --messages 100
+"""
+
+import argparse
+import os
+import sys
+import tempfile
+
+# База задается до импорта приложения
+_db_dir = tempfile.mkdtemp(prefix='query_budget_')
+os.environ['DATABASE_URL'] = f"sqlite:///{os.path.join(_db_dir, 'budget.db')}"
+
+from datetime import datetime, timedelta
+from app import app, db, Client, Message, User
+from query_budget import assert_max_queries
+from werkzeug.security import generate_password_hash
+
+# (название, метод, путь, тело JSON, максимум запросов, максимум повторов одного запроса)
+BUDGETS = [
+    ('dashboard', 'GET', '/', None, 4, 1),
+    ('client_detail', 'GET', '/client/{client_id}', None, 8, 2),
+    ('client_messages', 'GET', '/client/{client_id}/messages', None, 4, 1),
+    ('client_brief', 'GET', '/client/{client_id}/brief', None, 4, 1),
+    ('get_brief', 'GET', '/api/get_brief/{telegram_id}', None, 3, 1),
+    ('analytics', 'GET', '/api/analytics', None, 4, 1),
+    ('save_final_message', 'POST', '/api/save_final_message', {
+        'user': {'telegram_id': '{telegram_id}', 'first_name': 'Бюджет'},
+        'message': {'text': 'Проверка бюджета запросов', 'message_type': 'text', 'message_id': '{seq}'},
+        'metadata': {'is_first_message': False}
+    }, 14, 2),
+    ('add_brief', 'POST', '/api/add_brief', {
+        'telegram_id': '{telegram_id}', 'text': 'Проверка бюджета запросов', 'message_id': '{seq}'
+    }, 14, 2),
+]
+
+
+def seed(clients: int, messages: int) -> None:
+    started = datetime.utcnow() - timedelta(days=1)
+    with app.app_context():
+        db.drop_all()
+        db.create_all()
+        db.session.add(User(username='admin', password_hash=generate_password_hash('admin123')))
+        for i in range(clients):
+            client = Client(telegram_id=1000 + i, name=f'Клиент {i}', status='новый', user_brief='Бриф ' * 50)
+            db.session.add(client)
+            db.session.flush()
+            db.session.add_all([
+                Message(client_id=client.id, message_text=f'Сообщение {j}', is_from_bot=j % 2 == 1,
+                        timestamp=started + timedelta(seconds=j))
+                for j in range(messages)
+            ])
+        db.session.commit()
+
+
+def fill(value, params):
+    if isinstance(value, dict):
+        return {key: fill(item, params) for key, item in value.items()}
+    if isinstance(value, str):
+        filled = value.format(**params)
+        return int(filled) if value.startswith('{') and filled.isdigit() else filled
+    return value
+
+
+def run(clients: int, messages: int, run_id: int) -> dict:
+    """Число запросов по каждому маршруту при заданном объеме данных"""
+    seed(clients, messages)
+    http = app.test_client()
+    http.post('/login', data={'username': 'admin', 'password': 'admin123'})
+
+    counts = {}
+    failures = []
+    for seq, (name, method, path, body, max_count, max_repeats) in enumerate(BUDGETS, start=1):
+        # Свой message_id на каждый прогон, иначе второй прогон получит ответы-повторы идемпотентности
+        params = {'client_id': 1, 'telegram_id': 1000, 'seq': run_id * 1000 + seq}
+        try:
+            with assert_max_queries(max_count, max_repeats) as stats:
+                response = http.open(path.format(**params), method=method, json=fill(body, params))
+            if response.status_code >= 400:
+                failures.append(f"{name}: HTTP {response.status_code}")
+        except AssertionError as e:
+            failures.append(f"{name}: {e}")
+        counts[name] = stats.count
+    return {'counts': counts, 'failures': failures}
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Проверка бюджета SQL-запросов')
+    parser.add_argument('--clients', type=int, default=50)
+    parser.add_argument('--messages', type=int, default=60)
+    args = parser.parse_args()
+
+    small = run(2, 3, run_id=1)
+    large = run(args.clients, args.messages, run_id=2)
+
+    failed = False
+    print(f"{'маршрут':<20} | {'мало данных':>11} | {'много данных':>12} | бюджет")
+    for name, _, _, _, max_count, _ in BUDGETS:
+        small_count = small['counts'].get(name)
+        large_count = large['counts'].get(name)
+        marker = ''
+        # Число запросов не должно расти с объемом данных
+        if large_count > small_count:
+            marker = '  <- растет с объемом данных'
+            failed = True
+        print(f"{name:<20} | {small_count:>11} | {large_count:>12} | {max_count}{marker}")
+
+    for failure in small['failures'] + large['failures']:
+        print(f"❌ {failure}")
+        failed = True
+
+    if failed:
+        sys.exit(1)
+    print("✅ Все маршруты укладываются в бюджет запросов")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,175 @@
+"""
+Сжатие HTTP-ответов, распаковка сжатых запросов и быстрый JSON для Flask.
+
+- OrjsonProvider: сериализация через orjson (если установлен) с тем же
+  результатом, что у стандартного провайдера Flask (сортировка ключей,
+  формат дат), только без экранирования кириллицы в \\uXXXX.
+- compress_response: gzip или brotli по Accept-Encoding для ответов
+  больше порога. Потоковые ответы (выгрузка, SSE) не трогаются.
+- decompress_request: тело запроса с Content-Encoding: gzip (большие
+  брифы из n8n) распаковывается до того, как его прочитает request.get_json().
+  Тела brotli не принимаются (415): у brotli.Decompressor нет предела
+  выхода, а один байт входа разворачивается в мегабайты.
+"""
+
+import gzip
+import io
+import zlib
+from typing import Optional
+
+from flask import Flask, Request, Response, request
+from flask.json.provider import DefaultJSONProvider
+
+try:
+    import orjson
+except ImportError:  # pragma: no cover - orjson необязателен
+    orjson = None
+
+try:
+    import brotli
+except ImportError:  # pragma: no cover - brotli необязателен
+    brotli = None
+
+DEFAULT_MIMETYPES = ('application/json', 'text/html', 'text/css', 'application/javascript')
+
+
+class OrjsonProvider(DefaultJSONProvider):
+    """JSON-провайдер Flask на orjson; без orjson работает как стандартный"""
+
+    def dumps(self, obj, **kwargs) -> str:
+        if orjson is None or kwargs:
+            return super().dumps(obj, **kwargs)
+        return self._orjson_dumps(obj).decode('utf-8')
+
+    def loads(self, s, **kwargs):
+        if orjson is None or kwargs:
+            return super().loads(s, **kwargs)
+        return orjson.loads(s)
+
+    def response(self, *args, **kwargs) -> Response:
+        if orjson is None or self.compact is False or (self.compact is None and self._app.debug):
+            return super().response(*args, **kwargs)
+        obj = self._prepare_response_obj(args, kwargs)
+        return self._app.response_class(self._orjson_dumps(obj), mimetype=self.mimetype)
+
+    def _orjson_dumps(self, obj) -> bytes:
+        # Даты отдаем стандартному default Flask, чтобы формат ответа API не изменился
+        option = orjson.OPT_PASSTHROUGH_DATETIME | orjson.OPT_NON_STR_KEYS
+        if self.sort_keys:
+            option |= orjson.OPT_SORT_KEYS
+        return orjson.dumps(obj, default=self.default, option=option)
+
+
+def _accepted_encodings(header: str) -> dict:
+    encodings = {}
+    for part in header.split(','):
+        name, _, params = part.strip().partition(';')
+        quality = 1.0
+        params = params.strip()
+        if params.startswith('q='):
+            try:
+                quality = float(params[2:])
+            except ValueError:
+                quality = 0.0
+        if name:
+            encodings[name.lower()] = quality
+    return encodings
+
+
+def choose_encoding(accept_encoding: str) -> Optional[str]:
+    """br, если клиент его принимает и модуль brotli установлен, иначе gzip"""
+    encodings = _accepted_encodings(accept_encoding or '')
+    if brotli is not None and encodings.get('br', 0) > 0:
+        return 'br'
+    if encodings.get('gzip', 0) > 0:
+        return 'gzip'
+    return None
+
+
+def compress(data: bytes, encoding: str, level: int) -> bytes:
+    if encoding == 'br':
+        # Шкала уровней brotli 0-11, у gzip 1-9: один и тот же уровень дает сопоставимую скорость
+        return brotli.compress(data, quality=min(level, 11))
+    return gzip.compress(data, compresslevel=min(level, 9), mtime=0)
+
+
+def compress_response(response: Response, min_size: int, level: int, mimetypes=DEFAULT_MIMETYPES) -> Response:
+    if (response.direct_passthrough or response.is_streamed
+            or response.status_code < 200 or response.status_code >= 300
+            or 'Content-Encoding' in response.headers
+            or response.mimetype not in mimetypes):
+        return response
+
+    response.vary.add('Accept-Encoding')
+    encoding = choose_encoding(request.headers.get('Accept-Encoding', ''))
+    if encoding is None:
+        return response
+
+    data = response.get_data()
+    if len(data) < min_size:
+        return response
+
+    response.set_data(compress(data, encoding, level))
+    response.headers['Content-Encoding'] = encoding
+    return response
+
+
+class RequestDecompressionError(Exception):
+    def __init__(self, message: str, status: int = 400):
+        super().__init__(message)
+        self.status = status
+
+
+def decompress_request(req: Request, max_bytes: int) -> None:
+    """Распаковывает тело запроса с Content-Encoding: gzip на месте.
+
+    Распаковка останавливается на max_bytes, чтобы маленький сжатый запрос
+    не развернулся в гигабайты памяти. Остальные кодировки, включая br, -
+    ошибка со статусом 415.
+    """
+    encoding = req.headers.get('Content-Encoding', '').strip().lower()
+    if not encoding or encoding == 'identity':
+        return
+
+    if encoding != 'gzip':
+        raise RequestDecompressionError(f'Unsupported Content-Encoding: {encoding}, use gzip', status=415)
+
+    body = req.get_data(cache=False)
+    try:
+        decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        data = decompressor.decompress(body, max_bytes + 1)
+        if decompressor.unconsumed_tail:
+            raise RequestDecompressionError(f'Decompressed body exceeds {max_bytes} bytes')
+    except (zlib.error, OSError) as e:
+        raise RequestDecompressionError(f'Invalid {encoding} body: {e}')
+
+    if len(data) > max_bytes:
+        raise RequestDecompressionError(f'Decompressed body exceeds {max_bytes} bytes')
+
+    environ = req.environ
+    environ['wsgi.input'] = io.BytesIO(data)
+    environ['CONTENT_LENGTH'] = str(len(data))
+    environ.pop('HTTP_CONTENT_ENCODING', None)
+    # Сбрасываем закэшированные werkzeug значения, вычисленные по сжатому телу
+    for attr in ('stream', '_cached_data', 'content_length'):
+        req.__dict__.pop(attr, None)
+
+
+def init_app(app: Flask) -> None:
+    """Подключает orjson, сжатие ответов и распаковку запросов к приложению"""
+    app.json = OrjsonProvider(app)
+    min_size = app.config.get('COMPRESS_MIN_SIZE', 1024)
+    level = app.config.get('COMPRESS_LEVEL', 6)
+    max_request_bytes = app.config.get('MAX_DECOMPRESSED_REQUEST_BYTES', 32 * 1024 * 1024)
+
+    @app.before_request
+    def _decompress_request():
+        try:
+            decompress_request(request, max_request_bytes)
+        except RequestDecompressionError as e:
+            return app.json.response({'error': str(e)}), e.status
+
+    if app.config.get('COMPRESS_RESPONSES', True):
+        @app.after_request
+        def _compress_response(response):
+            return compress_response(response, min_size, level)
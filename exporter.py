@@ -0,0 +1,126 @@
+"""
+Потоковый экспорт клиентов и переписки в CSV / JSONL.
+
+Генераторы принимают итератор строк из серверного курсора и отдают
+готовые куски ответа, поэтому память не зависит от объема выгрузки.
+
+Клиенты и сообщения читаются отдельными курсорами (оба упорядочены по
+client_id) и сводятся в записи ('client', строка) и ('message', client_id,
+строка): колонки клиента, включая большой бриф, читаются и пишутся один
+раз на клиента, а не на каждое его сообщение. В CSV с сообщениями строка
+клиента идет с пустыми колонками сообщения, строки сообщений - только с
+client_id из колонок клиента.
+"""
+
+import csv
+import io
+import json
+import zlib
+from datetime import datetime
+from typing import Any, Callable, Iterable, Iterator, Optional, Sequence, Tuple
+
+CLIENT_FIELDS = [
+    'client_id', 'telegram_id', 'name', 'organization', 'status', 'traffic_source',
+    'project_description', 'required_functions', 'user_brief', 'created_at', 'updated_at'
+]
+MESSAGE_FIELDS = ['message_id', 'message_text', 'is_from_bot', 'timestamp', 'transcript']
+
+# Размер куска ответа: меньше - лишние системные вызовы, больше - дольше ждать первый байт
+CHUNK_SIZE = 64 * 1024
+
+
+def _value(value: Any) -> Any:
+    if isinstance(value, datetime):
+        return value.isoformat()
+    return value
+
+
+class GroupedRows:
+    """Строки, упорядоченные по client_id (первая колонка), по очереди клиентов"""
+
+    def __init__(self, rows: Iterable[Sequence[Any]]):
+        self._rows = iter(rows)
+        self._next = next(self._rows, None)
+
+    def take(self, client_id: int) -> Iterator[Sequence[Any]]:
+        """Строки клиента; строки клиентов, которых нет в выгрузке (созданы после ее начала), пропускаются"""
+        while self._next is not None and self._next[0] < client_id:
+            self._next = next(self._rows, None)
+        while self._next is not None and self._next[0] == client_id:
+            row = self._next
+            self._next = next(self._rows, None)
+            yield row
+
+
+def iter_records(clients: Iterable[Sequence[Any]],
+                 messages: Optional[Callable[[int], Iterable[Sequence[Any]]]] = None) -> Iterator[Tuple]:
+    """Записи выгрузки: клиент, за ним его сообщения (messages(client_id) - строки MESSAGE_FIELDS)"""
+    for client in clients:
+        yield ('client', tuple(client))
+        if messages:
+            for message in messages(client[0]):
+                yield ('message', client[0], tuple(message))
+
+
+def csv_rows(records: Iterable[Tuple]) -> Iterator[Sequence[Any]]:
+    """Строки CSV с колонками CLIENT_FIELDS + MESSAGE_FIELDS"""
+    client_blank = (None,) * (len(CLIENT_FIELDS) - 1)
+    message_blank = (None,) * len(MESSAGE_FIELDS)
+    for record in records:
+        if record[0] == 'client':
+            yield record[1] + message_blank
+        else:
+            yield (record[1],) + client_blank + record[2]
+
+
+def iter_csv(rows: Iterable[Sequence[Any]], fields: Sequence[str]) -> Iterator[str]:
+    """CSV с заголовком; строки row совпадают по порядку с fields"""
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(fields)
+    for row in rows:
+        writer.writerow([_value(value) for value in row])
+        if buffer.tell() >= CHUNK_SIZE:
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+    yield buffer.getvalue()
+
+
+def iter_jsonl(records: Iterable[Tuple]) -> Iterator[str]:
+    """JSONL: запись клиента, за ней записи его сообщений (записи iter_records).
+
+    Сообщения не группируются в памяти, поэтому длинная переписка не
+    увеличивает расход памяти.
+    """
+    parts = []
+    size = 0
+
+    for record in records:
+        if record[0] == 'client':
+            data = {field: _value(value) for field, value in zip(CLIENT_FIELDS, record[1])}
+            data['type'] = 'client'
+        else:
+            data = {field: _value(value) for field, value in zip(MESSAGE_FIELDS, record[2])}
+            data['type'] = 'message'
+            data['client_id'] = record[1]
+
+        line = json.dumps(data, ensure_ascii=False) + '\n'
+        parts.append(line)
+        size += len(line)
+        if size >= CHUNK_SIZE:
+            yield ''.join(parts)
+            parts = []
+            size = 0
+
+    yield ''.join(parts)
+
+
+def iter_gzip(chunks: Iterable[str]) -> Iterator[bytes]:
+    """Потоковое gzip-сжатие текстовых кусков"""
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 31)
+    for chunk in chunks:
+        data = compressor.compress(chunk.encode('utf-8'))
+        if data:
+            yield data
+    yield compressor.flush()
@@ -0,0 +1,157 @@
+"""
+Кэш отрендеренных HTML-фрагментов CRM (бриф и ленты сообщений клиента).
+
+Ключ фрагмента включает версию данных (updated_at клиента, id последнего
+сообщения), поэтому инвалидация не нужна: изменившиеся данные дают новый
+ключ, а старые записи вытесняются по LRU.
+
+Уровень в памяти ограничен по размеру и свой у каждого процесса. Дисковый
+уровень (FRAGMENT_CACHE_DIR) общий для всех worker'ов gunicorn.
+"""
+
+import hashlib
+import os
+import tempfile
+import threading
+from collections import OrderedDict
+from typing import Callable, Dict, Optional
+
+
+class MemoryFragmentCache:
+    """LRU-кэш строк с ограничением суммарного размера в символах"""
+
+    def __init__(self, max_size: int):
+        self.max_size = max_size
+        self._items: "OrderedDict[str, str]" = OrderedDict()
+        self._size = 0
+        self._lock = threading.Lock()
+
+    def get(self, key: str) -> Optional[str]:
+        with self._lock:
+            value = self._items.get(key)
+            if value is not None:
+                self._items.move_to_end(key)
+            return value
+
+    def set(self, key: str, value: str) -> None:
+        # Фрагмент больше всего кэша не кладем, чтобы не вытеснить все остальное
+        if len(value) > self.max_size:
+            return
+        with self._lock:
+            old = self._items.pop(key, None)
+            if old is not None:
+                self._size -= len(old)
+            self._items[key] = value
+            self._size += len(value)
+            while self._size > self.max_size:
+                _, evicted = self._items.popitem(last=False)
+                self._size -= len(evicted)
+
+    def __len__(self) -> int:
+        return len(self._items)
+
+    @property
+    def size(self) -> int:
+        return self._size
+
+
+class DiskFragmentCache:
+    """Общий для процессов кэш: один файл на фрагмент, вытеснение самых старых по atime/mtime"""
+
+    def __init__(self, directory: str, max_bytes: int, check_every: int = 100):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.check_every = check_every
+        self._writes = 0
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.directory, hashlib.sha1(key.encode('utf-8')).hexdigest() + '.html')
+
+    def get(self, key: str) -> Optional[str]:
+        path = self._path(key)
+        try:
+            with open(path, 'r', encoding='utf-8') as f:
+                value = f.read()
+            # Отмечаем использование для LRU-вытеснения
+            os.utime(path)
+            return value
+        except OSError:
+            return None
+
+    def set(self, key: str, value: str) -> None:
+        # Атомарная запись: читатели из других процессов не увидят половину файла
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'w', encoding='utf-8') as f:
+                f.write(value)
+            os.replace(tmp_path, self._path(key))
+        except OSError:
+            try:
+                os.unlink(tmp_path)
+            except OSError:
+                pass
+            return
+
+        self._writes += 1
+        if self._writes % self.check_every == 0:
+            self.evict()
+
+    def evict(self) -> None:
+        """Удаляет давно не использованные файлы, пока кэш не уложится в max_bytes"""
+        entries = []
+        total = 0
+        for entry in os.scandir(self.directory):
+            if not entry.name.endswith('.html'):
+                continue
+            try:
+                stat = entry.stat()
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, entry.path))
+            total += stat.st_size
+
+        entries.sort()
+        for _, size, path in entries:
+            if total <= self.max_bytes:
+                break
+            try:
+                os.unlink(path)
+                total -= size
+            except OSError:
+                pass
+
+
+class FragmentCache:
+    """Двухуровневый кэш фрагментов: память процесса, затем (опционально) диск"""
+
+    def __init__(self, max_memory_size: int, directory: Optional[str] = None, max_disk_bytes: int = 0):
+        self.memory = MemoryFragmentCache(max_memory_size)
+        self.disk = DiskFragmentCache(directory, max_disk_bytes) if directory else None
+        self.stats = {'hits': 0, 'disk_hits': 0, 'misses': 0}
+
+    def get_or_render(self, key: str, render: Callable[[], str]) -> str:
+        value = self.memory.get(key)
+        if value is not None:
+            self.stats['hits'] += 1
+            return value
+
+        if self.disk:
+            value = self.disk.get(key)
+            if value is not None:
+                self.stats['disk_hits'] += 1
+                self.memory.set(key, value)
+                return value
+
+        self.stats['misses'] += 1
+        value = render()
+        self.memory.set(key, value)
+        if self.disk:
+            self.disk.set(key, value)
+        return value
+
+    def get_stats(self) -> Dict[str, int]:
+        stats = dict(self.stats)
+        stats['memory_items'] = len(self.memory)
+        stats['memory_size'] = self.memory.size
+        return stats
@@ -0,0 +1,40 @@
+"""
+Настройки gunicorn для веб-приложения (файл читается автоматически из
+каталога запуска): gunicorn 'app:create_app()'.
+
+С preload_app модуль app (Flask, SQLAlchemy, шаблоны, маршруты) загружается
+один раз в master-процессе, worker'ы создаются через fork и делят его память
+(copy-on-write); перезапуск worker'а не повторяет импорт. Соединения с БД
+после fork открываются заново (app.reset_after_fork), потоки live_events и
+профилировщика каждый worker запускает сам.
+
+Число потоков worker'а (GUNICORN_THREADS) читает и app.py: от него зависит
+лимит одновременных потоков SSE (SSE_MAX_CONNECTIONS), поэтому потоки
+задаются здесь, а не флагом --threads.
+"""
+
+import gc
+import os
+
+preload_app = os.getenv('GUNICORN_PRELOAD', 'true').lower() == 'true'
+worker_class = 'gthread'
+threads = int(os.getenv('GUNICORN_THREADS', '8'))
+
+
+def when_ready(server):
+    # Объекты, загруженные в master-процессе, переводятся в постоянное поколение: сборщик
+    # мусора worker'а не обходит их и не копирует страницы памяти, меняя служебные поля объектов
+    gc.freeze()
+
+
+def post_fork(server, worker):
+    if preload_app:
+        from app import reset_after_fork
+        reset_after_fork()
+
+
+def child_exit(server, worker):
+    # Счетчики завершившегося worker'а больше не учитываются в /metrics (prometheus_client multiprocess)
+    if os.getenv('PROMETHEUS_MULTIPROC_DIR'):
+        from prometheus_client import multiprocess
+        multiprocess.mark_process_dead(worker.pid)
@@ -0,0 +1,70 @@
+"""
+Идемпотентность API приема сообщений (повторы доставки n8n и Telegram).
+
+Ключ запроса - заголовок Idempotency-Key, поле idempotency_key в теле или,
+по умолчанию, telegram_id + message_id сообщения Telegram (message_id 0 -
+событие без своего сообщения, например выбор кнопки: ключа нет). Первый запрос с
+ключом занимает строку в таблице ingest_idempotency в своей транзакции и
+сохраняет туда ответ; повтор получает сохраненный ответ, не трогая клиента.
+
+Перед таблицей стоит кэш в памяти процесса, поэтому частые повторы не
+доходят до БД. Таблица ограничена по времени жизни и числу ключей.
+"""
+
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Dict, Optional, Tuple
+
+MAX_KEY_LENGTH = 200
+
+
+def build_key(scope: str, explicit_key: Optional[str], telegram_id: Any, message_id: Any) -> Optional[str]:
+    """Ключ идемпотентности; None - ключа нет, запрос выполняется как обычно"""
+    if explicit_key:
+        key = f"{scope}:key:{explicit_key}"
+    elif telegram_id and str(message_id or '').strip() not in ('', '0'):
+        key = f"{scope}:{telegram_id}:{message_id}"
+    else:
+        return None
+    return key[:MAX_KEY_LENGTH]
+
+
+class IdempotencyCache:
+    """LRU-кэш завершенных ответов с временем жизни, общий для потоков процесса"""
+
+    def __init__(self, max_size: int, ttl: float):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._items: "OrderedDict[str, Tuple[float, Any, int]]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.stats = {'hits': 0, 'misses': 0}
+
+    def get(self, key: str) -> Optional[Tuple[Any, int]]:
+        with self._lock:
+            item = self._items.get(key)
+            if item is None or item[0] < time.monotonic():
+                if item is not None:
+                    del self._items[key]
+                self.stats['misses'] += 1
+                return None
+            self._items.move_to_end(key)
+            self.stats['hits'] += 1
+            return item[1], item[2]
+
+    def set(self, key: str, body: Any, status: int) -> None:
+        if self.max_size <= 0:
+            return
+        with self._lock:
+            self._items[key] = (time.monotonic() + self.ttl, body, status)
+            self._items.move_to_end(key)
+            while len(self._items) > self.max_size:
+                self._items.popitem(last=False)
+
+    def get_stats(self) -> Dict[str, int]:
+        stats = dict(self.stats)
+        stats['items'] = len(self._items)
+        return stats
+
+    def __len__(self) -> int:
+        return len(self._items)
@@ -7,6 +7,7 @@
 import os
 from app import app, db, User, BotSettings
 from werkzeug.security import generate_password_hash
+from message_partitions import partition_message_table
 
 def init_database():
     """Инициализация базы данных"""
@@ -14,6 +15,12 @@ def init_database():
         print("Создание таблиц...")
         db.create_all()
         
+        # Сообщения в PostgreSQL хранятся в помесячных секциях (message_partitions.py)
+        if db.engine.dialect.name == 'postgresql':
+            with db.engine.begin() as conn:
+                if partition_message_table(conn):
+                    print("Таблица message секционирована по месяцам")
+        
         # Создание админ-пользователя
         if not User.query.first():
             admin = User(
@@ -2,6 +2,10 @@
 """
 Скрипт для управления базой знаний в Qdrant
 Позволяет добавлять, обновлять и удалять информацию о услугах
+
+sync приводит коллекцию к файлу (knowledge_sync.py): эмбеддинги
+запрашиваются только для новых и измененных элементов, удаленные из файла
+элементы удаляются из коллекции.
 """
 
 import os
@@ -12,6 +16,8 @@ from qdrant_client import QdrantClient
 from qdrant_client.models import Distance, VectorParams, PointStruct
 from dotenv import load_dotenv
 
+from knowledge_sync import load_items, openai_embedder, sync_collection
+
 load_dotenv()
 
 # Конфигурация
@@ -168,6 +174,28 @@ class KnowledgeManager:
         except Exception as e:
             print(f"Ошибка загрузки из файла: {e}")
     
+    def sync_file(self, filename, dry_run=False):
+        """Синхронизация коллекции с JSON файлом"""
+        try:
+            self.create_collection()
+            report = sync_collection(
+                self.client, COLLECTION_NAME, load_items(filename),
+                openai_embedder(openai) if OPENAI_API_KEY else None,
+                dry_run=dry_run
+            )
+            
+            stats = report.as_dict()
+            print(f"{'Будет' if dry_run else 'Выполнено'}: добавлено {stats['added']}, изменено {stats['changed']}, "
+                  f"обновлен payload {stats['payload_updated']}, удалено {stats['deleted']}, "
+                  f"без изменений {stats['unchanged']}")
+            print(f"Эмбеддинги: {stats['embedded']} из {stats['total']} "
+                  f"({stats['embedding_requests']} запросов к OpenAI), сэкономлено {stats['embeddings_saved']}")
+            return report
+            
+        except Exception as e:
+            print(f"Ошибка синхронизации с файлом: {e}")
+            return None
+    
     def export_to_file(self, filename):
         """Экспорт всех знаний в JSON файл"""
         try:
@@ -190,6 +218,7 @@ def main():
         print("  python knowledge_manager.py list")
         print("  python knowledge_manager.py delete <id>")
         print("  python knowledge_manager.py load <filename.json>")
+        print("  python knowledge_manager.py sync [knowledge_base.json] [--dry-run]")
         print("  python knowledge_manager.py export <filename.json>")
         return
     
@@ -231,6 +260,10 @@ def main():
         filename = sys.argv[2]
         manager.load_from_file(filename)
         
+    elif command == "sync":
+        args = [arg for arg in sys.argv[2:] if arg != "--dry-run"]
+        manager.sync_file(args[0] if args else "knowledge_base.json", dry_run="--dry-run" in sys.argv)
+        
     elif command == "export" and len(sys.argv) >= 3:
         filename = sys.argv[2]
         manager.export_to_file(filename)
@@ -0,0 +1,158 @@
+"""
+Синхронизация коллекции Qdrant с файлом базы знаний (knowledge_base.json).
+
+Файл - источник истины: в payload каждой точки хранится хэш текста вместе
+с моделью эмбеддингов, и при синхронизации эмбеддинги запрашиваются только
+для новых элементов и элементов с измененным текстом (пачками, одним
+запросом к OpenAI на пачку). Если изменилась только категория, обновляется
+payload без эмбеддинга; точки, которых нет в файле, удаляются.
+
+Используется командой python knowledge_manager.py sync и ботом (при запуске
+и при изменении файла, KNOWLEDGE_BASE_WATCH). Вызовы синхронные - в боте
+выполняются в отдельном потоке.
+"""
+
+import hashlib
+import json
+from typing import Any, Callable, Dict, List, Optional
+
+EMBEDDING_MODEL = "text-embedding-ada-002"
+EMBEDDING_BATCH_SIZE = 100
+SCROLL_PAGE_SIZE = 256
+
+
+def load_items(path: str) -> List[Dict[str, Any]]:
+    """Элементы базы знаний из файла; id обязателен и уникален - по нему элемент сопоставляется с точкой"""
+    with open(path, 'r', encoding='utf-8') as f:
+        items = json.load(f)
+    seen = set()
+    for item in items:
+        if 'id' not in item or not item.get('text'):
+            raise ValueError(f"Элемент базы знаний без id или текста: {item}")
+        if item['id'] in seen:
+            raise ValueError(f"Повторяющийся id в базе знаний: {item['id']}")
+        seen.add(item['id'])
+    return items
+
+
+def content_hash(text: str, model: str = EMBEDDING_MODEL) -> str:
+    """Хэш того, от чего зависит вектор: текст и модель эмбеддингов"""
+    return hashlib.sha256(f"{model}\n{text}".encode('utf-8')).hexdigest()
+
+
+def item_payload(item: Dict[str, Any], model: str = EMBEDDING_MODEL) -> Dict[str, Any]:
+    return {
+        "text": item["text"],
+        "category": item.get("category", ""),
+        "content_hash": content_hash(item["text"], model)
+    }
+
+
+def openai_embedder(openai_module, model: str = EMBEDDING_MODEL) -> Callable[[List[str]], List[List[float]]]:
+    """Эмбеддинги пачки текстов одним запросом (старый API openai 0.28), в порядке текстов"""
+    def embed(texts: List[str]) -> List[List[float]]:
+        response = openai_module.Embedding.create(input=texts, model=model)
+        return [row['embedding'] for row in sorted(response['data'], key=lambda row: row['index'])]
+    return embed
+
+
+class SyncReport:
+    """Итог синхронизации: что изменилось и сколько запросов эмбеддингов понадобилось"""
+
+    def __init__(self, total: int):
+        self.total = total
+        self.added = 0
+        self.changed = 0
+        self.payload_updated = 0
+        self.deleted = 0
+        self.unchanged = 0
+        self.embedded = 0
+        self.embedding_requests = 0
+
+    @property
+    def embeddings_saved(self) -> int:
+        """Эмбеддинги, которые не пришлось запрашивать по сравнению с полной загрузкой файла"""
+        return self.total - self.embedded
+
+    def as_dict(self) -> Dict[str, int]:
+        return {
+            "total": self.total,
+            "added": self.added,
+            "changed": self.changed,
+            "payload_updated": self.payload_updated,
+            "deleted": self.deleted,
+            "unchanged": self.unchanged,
+            "embedded": self.embedded,
+            "embedding_requests": self.embedding_requests,
+            "embeddings_saved": self.embeddings_saved
+        }
+
+
+def stored_payloads(client, collection: str) -> Dict[Any, Dict[str, Any]]:
+    """payload всех точек коллекции по id (без векторов)"""
+    payloads = {}
+    offset = None
+    while True:
+        points, offset = client.scroll(
+            collection_name=collection,
+            limit=SCROLL_PAGE_SIZE,
+            offset=offset,
+            with_payload=True,
+            with_vectors=False
+        )
+        for point in points:
+            payloads[point.id] = point.payload or {}
+        if offset is None:
+            return payloads
+
+
+def sync_collection(client, collection: str, items: List[Dict[str, Any]],
+                    embed: Optional[Callable[[List[str]], List[List[float]]]],
+                    model: str = EMBEDDING_MODEL, batch_size: int = EMBEDDING_BATCH_SIZE,
+                    dry_run: bool = False) -> SyncReport:
+    """Приводит коллекцию к списку items; embed - эмбеддинги пачки текстов (openai_embedder)"""
+    from qdrant_client.models import PointStruct
+
+    report = SyncReport(len(items))
+    stored = stored_payloads(client, collection)
+
+    to_embed = []
+    for item in items:
+        payload = item_payload(item, model)
+        current = stored.get(item["id"])
+        if current is None:
+            report.added += 1
+            to_embed.append((item, payload))
+        elif current.get("content_hash") != payload["content_hash"]:
+            report.changed += 1
+            to_embed.append((item, payload))
+        elif current.get("category") != payload["category"] or current.get("text") != payload["text"]:
+            report.payload_updated += 1
+            if not dry_run:
+                client.set_payload(collection_name=collection, payload=payload, points=[item["id"]])
+        else:
+            report.unchanged += 1
+
+    removed = list(stored.keys() - {item["id"] for item in items})
+    report.deleted = len(removed)
+
+    report.embedded = len(to_embed)
+    report.embedding_requests = (len(to_embed) + batch_size - 1) // batch_size
+    if dry_run:
+        return report
+    if to_embed and embed is None:
+        raise RuntimeError("Для новых и измененных элементов нужны эмбеддинги, а OpenAI не настроен")
+
+    for start in range(0, len(to_embed), batch_size):
+        batch = to_embed[start:start + batch_size]
+        vectors = embed([payload["text"] for _, payload in batch])
+        client.upsert(
+            collection_name=collection,
+            points=[
+                PointStruct(id=item["id"], vector=vector, payload=payload)
+                for (item, payload), vector in zip(batch, vectors)
+            ]
+        )
+    if removed:
+        client.delete(collection_name=collection, points_selector=removed)
+    return report
@@ -0,0 +1,229 @@
+"""
+Живые обновления CRM через Server-Sent Events.
+
+Источники изменений (API n8n, смена статуса в CRM, бот) отправляют
+NOTIFY в канал crm_events в той же транзакции, что и запись, поэтому
+событие уходит только после commit. В каждом worker'е Flask один поток
+держит LISTEN-соединение и раздает события всем открытым потокам SSE
+этого процесса. Без PostgreSQL (SQLite в разработке) события раздаются
+только внутри процесса, который их создал.
+
+В событиях только измененные строки: клиент (при создании и смене
+статуса) и новое сообщение. Счетчики на странице браузер пересчитывает
+сам по этим событиям.
+"""
+
+import json
+import logging
+import os
+import queue
+import select
+import threading
+import time
+from datetime import datetime
+from typing import Any, Callable, Dict, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+CHANNEL = 'crm_events'
+# Лимит payload у NOTIFY - 8000 байт, длинные тексты обрезаются
+MAX_PAYLOAD_BYTES = 7500
+MAX_TEXT_CHARS = 1000
+
+NOTIFY_SQL = "SELECT pg_notify($1, $2)"
+
+
+def _iso(value: Optional[datetime]) -> Optional[str]:
+    return value.isoformat() if value else None
+
+
+def _display(value: Optional[datetime], fmt: str) -> str:
+    return value.strftime(fmt) if value else ''
+
+
+def _truncate(value: Optional[str]) -> Tuple[Optional[str], bool]:
+    if value is not None and len(value) > MAX_TEXT_CHARS:
+        return value[:MAX_TEXT_CHARS], True
+    return value, False
+
+
+def client_event(client_id: int, telegram_id: int, name: Optional[str], organization: Optional[str],
+                 status: Optional[str], created_at: Optional[datetime], updated_at: Optional[datetime],
+                 previous_status: Optional[str] = None, created: bool = False) -> Dict[str, Any]:
+    """Строка клиента для дашборда; previous_status и created нужны для пересчета счетчиков"""
+    return {
+        'id': client_id,
+        'telegram_id': telegram_id,
+        'name': name,
+        'organization': organization,
+        'status': status,
+        'previous_status': previous_status,
+        'created': created,
+        'created_at_display': _display(created_at, '%d.%m.%Y %H:%M'),
+        'updated_at': _iso(updated_at),
+        'updated_at_display': _display(updated_at, '%d.%m.%Y %H:%M')
+    }
+
+
+def message_event(client_id: int, message_id: Optional[int], text: str, is_from_bot: bool,
+                  timestamp: Optional[datetime], transcript: Optional[str] = None) -> Dict[str, Any]:
+    """Новое сообщение в формате message_to_dict (id может быть None для пакетной записи бота)"""
+    text, truncated = _truncate(text)
+    transcript, transcript_truncated = _truncate(transcript)
+    return {
+        'client_id': client_id,
+        'id': message_id,
+        'text': text,
+        'is_from_bot': is_from_bot,
+        'timestamp': _iso(timestamp),
+        'timestamp_display': _display(timestamp, '%d.%m.%Y %H:%M:%S'),
+        'transcript': transcript,
+        'truncated': truncated or transcript_truncated
+    }
+
+
+def transcript_event(client_id: int, message_id: int, transcript: str) -> Dict[str, Any]:
+    """Расшифровка голосового сообщения, уже показанного на странице"""
+    transcript, truncated = _truncate(transcript)
+    return {'client_id': client_id, 'id': message_id, 'transcript': transcript, 'truncated': truncated}
+
+
+def encode_event(event_type: str, data: Dict[str, Any]) -> str:
+    payload = json.dumps({'type': event_type, 'data': data}, ensure_ascii=False, separators=(',', ':'))
+    if len(payload.encode('utf-8')) > MAX_PAYLOAD_BYTES:
+        # Даже после обрезки не влезло (например, длинное имя) - браузер перезагрузит данные сам
+        payload = json.dumps({'type': 'resync', 'data': {'client_id': data.get('client_id', data.get('id'))}})
+    return payload
+
+
+def decode_event(payload: str) -> Tuple[str, Dict[str, Any]]:
+    event = json.loads(payload)
+    return event['type'], event['data']
+
+
+def format_sse(event_type: str, data: Dict[str, Any]) -> str:
+    return f"event: {event_type}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+
+class Subscription:
+    """Очередь событий одного открытого потока SSE"""
+
+    def __init__(self, client_id: Optional[int], max_queue: int):
+        self.client_id = client_id
+        self.queue: "queue.Queue[Optional[Tuple[str, Dict]]]" = queue.Queue(maxsize=max_queue)
+        self.overflowed = False
+
+    def wants(self, event_type: str, data: Dict[str, Any]) -> bool:
+        if self.client_id is None:
+            return True
+        return data.get('client_id', data.get('id')) == self.client_id
+
+    def offer(self, event: Tuple[str, Dict[str, Any]]) -> None:
+        if self.overflowed:
+            return
+        try:
+            self.queue.put_nowait(event)
+        except queue.Full:
+            # Браузер не успевает читать: вместо потери событий просим его перезагрузить страницу
+            self.overflowed = True
+            self.queue.queue.clear()
+            self.queue.put_nowait(None)
+
+
+class EventBroadcaster:
+    """Раздача событий подписчикам процесса и LISTEN-поток (один на worker)"""
+
+    def __init__(self, max_subscribers: int = 100, max_queue: int = 100, reconnect_seconds: float = 5.0,
+                 poll_seconds: float = 5.0):
+        self.max_subscribers = max_subscribers
+        self.max_queue = max_queue
+        self.reconnect_seconds = reconnect_seconds
+        self.poll_seconds = poll_seconds
+        self._subscribers = set()
+        self._lock = threading.Lock()
+        self._listener: Optional[threading.Thread] = None
+        self._listener_pid: Optional[int] = None
+        self.stats = {'events_received': 0, 'events_delivered': 0, 'overflows': 0, 'rejected': 0,
+                      'listener_reconnects': 0}
+
+    def subscribe(self, client_id: Optional[int] = None) -> Optional[Subscription]:
+        """Новая подписка; None - достигнут лимит одновременных потоков"""
+        with self._lock:
+            if len(self._subscribers) >= self.max_subscribers:
+                self.stats['rejected'] += 1
+                return None
+            subscription = Subscription(client_id, self.max_queue)
+            self._subscribers.add(subscription)
+            return subscription
+
+    def unsubscribe(self, subscription: Subscription) -> None:
+        with self._lock:
+            self._subscribers.discard(subscription)
+            if subscription.overflowed:
+                self.stats['overflows'] += 1
+
+    def publish(self, event_type: str, data: Dict[str, Any]) -> None:
+        """Передает событие всем подходящим подписчикам процесса"""
+        self.stats['events_received'] += 1
+        with self._lock:
+            subscribers = list(self._subscribers)
+        for subscription in subscribers:
+            if subscription.wants(event_type, data):
+                subscription.offer((event_type, data))
+                self.stats['events_delivered'] += 1
+
+    def ensure_listener(self, connect: Callable[[], Any]) -> None:
+        """Запускает LISTEN-поток, если его еще нет в этом процессе.
+
+        Поток запускается лениво, при первом подключении браузера, поэтому
+        каждый worker gunicorn (в том числе после fork с --preload) получает
+        свой поток. connect() возвращает новое соединение psycopg2.
+        """
+        with self._lock:
+            if self._listener is not None and self._listener_pid == os.getpid() and self._listener.is_alive():
+                return
+            self._listener_pid = os.getpid()
+            self._listener = threading.Thread(target=self._listen, args=(connect,), name='crm-events-listener',
+                                              daemon=True)
+            self._listener.start()
+
+    def _listen(self, connect: Callable[[], Any]) -> None:
+        while True:
+            conn = None
+            try:
+                conn = connect()
+                conn.autocommit = True
+                with conn.cursor() as cursor:
+                    cursor.execute(f"LISTEN {CHANNEL}")
+                logger.info(f"Подписка на события {CHANNEL} (pid {os.getpid()})")
+
+                while True:
+                    # Таймаут select нужен, чтобы замечать обрыв соединения
+                    if select.select([conn], [], [], self.poll_seconds) == ([], [], []):
+                        with conn.cursor() as cursor:
+                            cursor.execute("SELECT 1")
+                        continue
+                    conn.poll()
+                    while conn.notifies:
+                        notify = conn.notifies.pop(0)
+                        try:
+                            self.publish(*decode_event(notify.payload))
+                        except (ValueError, KeyError) as e:
+                            logger.error(f"Некорректное событие {CHANNEL}: {e}")
+            except Exception as e:
+                self.stats['listener_reconnects'] += 1
+                logger.error(f"Ошибка LISTEN {CHANNEL}, переподключение через {self.reconnect_seconds} с: {e}")
+            finally:
+                if conn is not None:
+                    try:
+                        conn.close()
+                    except Exception:
+                        pass
+            time.sleep(self.reconnect_seconds)
+
+    def get_stats(self) -> Dict[str, Any]:
+        stats = dict(self.stats)
+        with self._lock:
+            stats['subscribers'] = len(self._subscribers)
+        stats['listener_alive'] = bool(self._listener and self._listener.is_alive())
+        return stats
@@ -0,0 +1,373 @@
+#!/usr/bin/env python3
+"""
+Помесячное секционирование таблицы message и архив старых месяцев.
+
+В PostgreSQL таблица message секционирована по timestamp (PARTITION BY
+RANGE, секция на месяц - message_yYYYYmMM, плюс message_default для строк
+вне созданных секций). Старые месяцы выгружаются в сжатые файлы JSONL
+(MESSAGE_ARCHIVE_DIR, файл на месяц) и удаляются из БД вместе с секцией.
+Внутри файла сообщения каждого клиента - отдельный gzip-член, его смещение
+и длина хранятся в message_archive_segment, поэтому переписку одного
+клиента CRM читает из архива без распаковки всего месяца.
+
+Запуск:
+    python message_partitions.py status
+    python message_partitions.py ensure --months-ahead 3
+    python message_partitions.py archive --older-than-months 12
+    python message_partitions.py archive --month 2024-01
+"""
+
+import argparse
+import gzip
+import json
+import os
+import time
+from datetime import date, datetime
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+from sqlalchemy import bindparam, text
+
+from message_templates import ensure_schema as ensure_template_schema, render
+
+DEFAULT_PARTITION = 'message_default'
+ARCHIVE_FIELDS = ['id', 'client_id', 'message_text', 'is_from_bot', 'timestamp', 'attachment_path', 'transcript']
+ARCHIVE_COLUMNS = ', '.join(f'm."{field}"' for field in ARCHIVE_FIELDS)
+
+
+def month_start(value) -> date:
+    return date(value.year, value.month, 1)
+
+
+def add_months(month: date, months: int) -> date:
+    index = month.year * 12 + month.month - 1 + months
+    return date(index // 12, index % 12 + 1, 1)
+
+
+def partition_name(month: date) -> str:
+    return f"message_y{month.year:04d}m{month.month:02d}"
+
+
+def archive_file_name(month: date, revision: int = 0) -> str:
+    """Файл архива месяца; revision - версия файла, переписанного после удаления клиентов"""
+    suffix = f".{revision}" if revision else ''
+    return f"messages-{month.year:04d}-{month.month:02d}{suffix}.jsonl.gz"
+
+
+def is_partitioned(conn) -> bool:
+    relkind = conn.execute(text("SELECT relkind FROM pg_class WHERE oid = to_regclass('message')")).scalar()
+    return relkind == 'p'
+
+
+def list_partitions(conn) -> List[Tuple[str, Optional[date], int]]:
+    """Секции message: (имя, месяц или None для секции по умолчанию, примерное число строк)"""
+    rows = conn.execute(text("""
+        SELECT c.relname, c.reltuples::bigint
+        FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid
+        WHERE i.inhparent = to_regclass('message')
+        ORDER BY c.relname
+    """))
+    partitions = []
+    for name, estimate in rows:
+        month = None
+        if name != DEFAULT_PARTITION:
+            month = date(int(name[9:13]), int(name[14:16]), 1)
+        partitions.append((name, month, max(estimate, 0)))
+    return partitions
+
+
+def create_partition(conn, month: date) -> bool:
+    """Создает секцию месяца, если ее нет. Строки этого месяца из секции по умолчанию переносятся в нее"""
+    name = partition_name(month)
+    if conn.execute(text("SELECT to_regclass(:name)"), {'name': name}).scalar():
+        return False
+    bounds = {'start': month, 'end': add_months(month, 1)}
+    # ATTACH проверяет, что в секции по умолчанию нет строк нового диапазона
+    conn.execute(text(f"CREATE TABLE {name} (LIKE message INCLUDING DEFAULTS)"))
+    conn.execute(text(f"""
+        WITH moved AS (
+            DELETE FROM {DEFAULT_PARTITION} WHERE "timestamp" >= :start AND "timestamp" < :end RETURNING *
+        )
+        INSERT INTO {name} SELECT * FROM moved
+    """), bounds)
+    conn.execute(text(
+        f"ALTER TABLE message ATTACH PARTITION {name} FOR VALUES FROM ('{bounds['start']}') TO ('{bounds['end']}')"
+    ))
+    return True
+
+
+def partition_message_table(conn, months_ahead: int = 3) -> bool:
+    """Переводит message в секционированную таблицу (в одной транзакции). False - уже секционирована"""
+    if is_partitioned(conn):
+        return False
+
+    # Колонки шаблонов нужны и старой таблице - ее строки копируются целиком
+    ensure_template_schema(conn)
+    conn.execute(text("LOCK TABLE message IN ACCESS EXCLUSIVE MODE"))
+    conn.execute(text("ALTER TABLE message RENAME TO message_unpartitioned"))
+    conn.execute(text("ALTER TABLE message_unpartitioned RENAME CONSTRAINT message_pkey TO message_unpartitioned_pkey"))
+    conn.execute(text("DROP INDEX IF EXISTS ix_message_client_timestamp_id"))
+
+    # Первичный ключ секционированной таблицы обязан включать ключ секционирования
+    conn.execute(text("""
+        CREATE TABLE message (
+            id INTEGER NOT NULL DEFAULT nextval('message_id_seq'),
+            client_id INTEGER NOT NULL REFERENCES client (id),
+            message_text TEXT NOT NULL,
+            is_from_bot BOOLEAN,
+            "timestamp" TIMESTAMP WITHOUT TIME ZONE NOT NULL DEFAULT (now() AT TIME ZONE 'utc'),
+            attachment_path VARCHAR(500),
+            transcript TEXT,
+            template_id INTEGER REFERENCES message_template (id),
+            template_params TEXT,
+            PRIMARY KEY (id, "timestamp")
+        ) PARTITION BY RANGE ("timestamp")
+    """))
+    conn.execute(text('CREATE INDEX ix_message_client_timestamp_id ON message (client_id, "timestamp", id)'))
+    conn.execute(text(f"CREATE TABLE {DEFAULT_PARTITION} PARTITION OF message DEFAULT"))
+
+    oldest = conn.execute(text('SELECT min("timestamp") FROM message_unpartitioned')).scalar()
+    month = month_start(oldest or datetime.utcnow())
+    last = add_months(month_start(datetime.utcnow()), months_ahead)
+    while month <= last:
+        create_partition(conn, month)
+        month = add_months(month, 1)
+
+    conn.execute(text("""
+        INSERT INTO message (id, client_id, message_text, is_from_bot, "timestamp", attachment_path, transcript,
+                             template_id, template_params)
+        SELECT id, client_id, message_text, is_from_bot, COALESCE("timestamp", now() AT TIME ZONE 'utc'),
+               attachment_path, transcript, template_id, template_params
+        FROM message_unpartitioned
+    """))
+    conn.execute(text("ALTER SEQUENCE message_id_seq OWNED BY message.id"))
+    conn.execute(text("DROP TABLE message_unpartitioned"))
+    return True
+
+
+def ensure_partitions(conn, months_ahead: int = 3) -> List[str]:
+    """Создает секции с текущего месяца на months_ahead вперед"""
+    created = []
+    month = month_start(datetime.utcnow())
+    for _ in range(months_ahead + 1):
+        if create_partition(conn, month):
+            created.append(partition_name(month))
+        month = add_months(month, 1)
+    return created
+
+
+def _record(row) -> Dict[str, Any]:
+    record = dict(zip(ARCHIVE_FIELDS, row))
+    # Сообщения из шаблонов (message_templates.py) попадают в архив готовым текстом
+    template = row[len(ARCHIVE_FIELDS):]
+    if template and template[0] is not None:
+        record['message_text'] = render(template[0], json.loads(template[1]) if template[1] else None)
+    record['timestamp'] = record['timestamp'].isoformat() if record['timestamp'] else None
+    return record
+
+
+def write_archive(path: str, rows: Iterable[Tuple]) -> List[Dict[str, int]]:
+    """Пишет строки (отсортированные по client_id) в файл, отдельный gzip-член на клиента.
+    Возвращает сегменты: client_id, byte_offset, byte_length, message_count"""
+    segments = []
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, 'wb') as out:
+        client_id, lines = None, []
+
+        def flush():
+            if lines:
+                offset = out.tell()
+                out.write(gzip.compress(''.join(lines).encode('utf-8')))
+                segments.append({'client_id': client_id, 'byte_offset': offset,
+                                 'byte_length': out.tell() - offset, 'message_count': len(lines)})
+
+        for row in rows:
+            record = _record(row)
+            if record['client_id'] != client_id:
+                flush()
+                client_id, lines = record['client_id'], []
+            lines.append(json.dumps(record, ensure_ascii=False) + '\n')
+        flush()
+        out.flush()
+        os.fsync(out.fileno())
+    os.replace(tmp_path, path)
+    return segments
+
+
+def archive_month(conn, month: date, directory: str, batch_size: int = 1000) -> Optional[Dict[str, int]]:
+    """Выгружает секцию месяца в архив и удаляет ее из БД. None - секции нет"""
+    name = partition_name(month)
+    if not conn.execute(text("SELECT to_regclass(:name)"), {'name': name}).scalar():
+        return None
+    # Файл месяца перезаписывается, поэтому повторно архивировать месяц нельзя
+    if conn.execute(text("SELECT 1 FROM message_archive_segment WHERE month = :month LIMIT 1"),
+                    {'month': month}).first():
+        raise ValueError(f"{month:%Y-%m} уже в архиве, а секция {name} создана снова - перенесите ее строки вручную")
+
+    # Пока месяц выгружается, его строки не меняются; остальные секции доступны
+    conn.execute(text(f"LOCK TABLE {name} IN SHARE MODE"))
+    os.makedirs(directory, exist_ok=True)
+    file_name = archive_file_name(month)
+    # yield_per на самом запросе: Connection.execution_options меняет соединение, и следующие
+    # запросы (INSERT сегментов) тоже шли бы через серверный курсор
+    result = conn.execute(text(
+        f'SELECT {ARCHIVE_COLUMNS}, t.text, m.template_params FROM {name} m '
+        f'LEFT JOIN message_template t ON t.id = m.template_id ORDER BY m.client_id, m."timestamp", m.id'
+    ).execution_options(yield_per=batch_size))
+    segments = write_archive(os.path.join(directory, file_name), result)
+
+    if segments:
+        conn.execute(text("""
+            INSERT INTO message_archive_segment
+                (client_id, month, file_name, byte_offset, byte_length, message_count)
+            VALUES (:client_id, :month, :file_name, :byte_offset, :byte_length, :message_count)
+        """), [dict(segment, month=month, file_name=file_name) for segment in segments])
+    conn.execute(text(f"ALTER TABLE message DETACH PARTITION {name}"))
+    conn.execute(text(f"DROP TABLE {name}"))
+    return {'clients': len(segments), 'messages': sum(segment['message_count'] for segment in segments)}
+
+
+def purge_archived_clients(conn, directory: str, client_ids: List[int]) -> Tuple[int, List[str]]:
+    """Удаляет переписку клиентов из архива: файлы их месяцев переписываются без их gzip-членов.
+    Новые файлы пишутся под новым именем, поэтому до фиксации транзакции архив остается целым.
+    Возвращает освобожденные байты и старые файлы, которые нужно удалить после фиксации"""
+    by_ids = bindparam('client_ids', expanding=True)
+    months = conn.execute(text(
+        "SELECT DISTINCT month, file_name FROM message_archive_segment WHERE client_id IN :client_ids"
+    ).bindparams(by_ids), {'client_ids': client_ids}).fetchall()
+
+    reclaimed, replaced = 0, []
+    purged = set(client_ids)
+    for month, file_name in months:
+        # SQLite возвращает даты из text() строкой
+        month = date.fromisoformat(month) if isinstance(month, str) else month
+        segments = conn.execute(text("""
+            SELECT client_id, byte_offset, byte_length FROM message_archive_segment
+            WHERE month = :month ORDER BY byte_offset
+        """), {'month': month}).fetchall()
+        new_name = archive_file_name(month, revision=int(time.time()))
+        kept = []
+        with open(os.path.join(directory, file_name), 'rb') as source, \
+                open(os.path.join(directory, new_name), 'wb') as out:
+            for client_id, byte_offset, byte_length in segments:
+                if client_id in purged:
+                    reclaimed += byte_length
+                    continue
+                source.seek(byte_offset)
+                kept.append({'client_id': client_id, 'month': month, 'file_name': new_name, 'byte_offset': out.tell()})
+                out.write(source.read(byte_length))
+            out.flush()
+            os.fsync(out.fileno())
+
+        conn.execute(text("DELETE FROM message_archive_segment WHERE month = :month AND client_id IN :client_ids")
+                     .bindparams(by_ids), {'month': month, 'client_ids': client_ids})
+        if kept:
+            conn.execute(text("""
+                UPDATE message_archive_segment SET file_name = :file_name, byte_offset = :byte_offset
+                WHERE client_id = :client_id AND month = :month
+            """), kept)
+        else:
+            os.unlink(os.path.join(directory, new_name))
+        replaced.append(os.path.join(directory, file_name))
+    return reclaimed, replaced
+
+
+class ArchivedMessage:
+    """Сообщение из архива с теми же полями, что у модели Message"""
+    __slots__ = ARCHIVE_FIELDS
+
+    def __init__(self, record: Dict[str, Any]):
+        for field in ARCHIVE_FIELDS:
+            setattr(self, field, record.get(field))
+        if self.timestamp:
+            self.timestamp = datetime.fromisoformat(self.timestamp)
+
+    @property
+    def display_text(self) -> str:
+        return self.message_text
+
+
+def read_segment(directory: str, file_name: str, byte_offset: int, byte_length: int) -> List[ArchivedMessage]:
+    """Сообщения одного клиента за месяц: читается и распаковывается только его gzip-член"""
+    with open(os.path.join(directory, file_name), 'rb') as f:
+        f.seek(byte_offset)
+        data = gzip.decompress(f.read(byte_length))
+    return [ArchivedMessage(json.loads(line)) for line in data.decode('utf-8').splitlines() if line]
+
+
+def read_archived_messages(directory: str, segments: Iterable) -> List[ArchivedMessage]:
+    """Архивные сообщения клиента по его сегментам (объекты с file_name, byte_offset, byte_length)"""
+    messages = []
+    for segment in segments:
+        messages.extend(read_segment(directory, segment.file_name, segment.byte_offset, segment.byte_length))
+    messages.sort(key=lambda message: (message.timestamp, message.id))
+    return messages
+
+
+def main():
+    from dotenv import load_dotenv
+    from sqlalchemy import create_engine
+
+    load_dotenv()
+    parser = argparse.ArgumentParser(description='Секции и архив таблицы message (PostgreSQL)')
+    commands = parser.add_subparsers(dest='command', required=True)
+    commands.add_parser('status', help='Секции и архивные месяцы')
+    ensure = commands.add_parser('ensure', help='Создать секции на будущие месяцы (запускать по расписанию)')
+    ensure.add_argument('--months-ahead', type=int, default=3)
+    archive = commands.add_parser('archive', help='Вынести старые месяцы в архив')
+    archive.add_argument('--older-than-months', type=int, default=12,
+                         help='Архивировать месяцы старше стольких месяцев от текущего')
+    archive.add_argument('--month', help='Архивировать один месяц (YYYY-MM)')
+    archive.add_argument('--dir', default=os.getenv('MESSAGE_ARCHIVE_DIR', 'archive/messages'))
+    args = parser.parse_args()
+
+    database_url = os.getenv('DATABASE_URL', 'postgresql://localhost/clienterra_crm')
+    if database_url.startswith('postgres://'):
+        database_url = database_url.replace('postgres://', 'postgresql://', 1)
+    engine = create_engine(database_url)
+    if engine.dialect.name != 'postgresql':
+        print("❌ Секционирование поддерживается только в PostgreSQL")
+        raise SystemExit(1)
+
+    with engine.begin() as conn:
+        if not is_partitioned(conn):
+            print("❌ Таблица message не секционирована, сначала выполните migrate_partition_message.py")
+            raise SystemExit(1)
+
+        if args.command == 'status':
+            print(f"{'секция':<20} | {'строк (оценка)':>14}")
+            for name, _, estimate in list_partitions(conn):
+                print(f"{name:<20} | {estimate:>14}")
+            archived = conn.execute(text("""
+                SELECT month, count(*), sum(message_count) FROM message_archive_segment GROUP BY month ORDER BY month
+            """)).fetchall()
+            for month, clients, messages in archived:
+                print(f"📦 {month:%Y-%m}: {messages} сообщений {clients} клиентов в архиве")
+            return
+
+        if args.command == 'ensure':
+            created = ensure_partitions(conn, args.months_ahead)
+            print(f"✅ Созданы секции: {', '.join(created)}" if created else "✅ Все секции уже есть")
+            return
+
+        current = month_start(datetime.utcnow())
+        if args.month:
+            months = [date.fromisoformat(f"{args.month}-01")]
+        else:
+            cutoff = add_months(current, -args.older_than_months)
+            months = [month for _, month, _ in list_partitions(conn) if month and month < cutoff]
+
+    for month in months:
+        if month >= current:
+            print(f"⚠️ {month:%Y-%m}: текущий и будущие месяцы не архивируются")
+            continue
+        # Каждый месяц - своя транзакция: файл пишется до фиксации, сегменты и удаление секции - вместе
+        with engine.begin() as conn:
+            stats = archive_month(conn, month, args.dir)
+        if stats is None:
+            print(f"⚠️ {month:%Y-%m}: секции нет")
+        else:
+            print(f"📦 {month:%Y-%m}: {stats['messages']} сообщений {stats['clients']} клиентов "
+                  f"-> {os.path.join(args.dir, archive_file_name(month))}")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,114 @@
+"""
+Сообщения бота, собранные из шаблонов.
+
+Приветствие, вопрос после серии сообщений и ответы на кнопки одинаковы у
+всех клиентов (приветствие - с точностью до имени), поэтому в message для
+них хранится ссылка на строку message_template и параметры, а message_text
+остается пустым. Текст собирается при чтении: страница клиента, API брифа,
+выгрузка и архив показывают то же, что было отправлено.
+
+Шаблон не меняется и не удаляется - новый текст становится новой строкой,
+поэтому процессы держат шаблоны в памяти без инвалидации.
+"""
+
+import hashlib
+import json
+from typing import Callable, Dict, Iterable, Optional
+
+# Схема для PostgreSQL (миграция и секционирование message); в SQLite таблицы создает db.create_all()
+SCHEMA_SQL = [
+    """
+    CREATE TABLE IF NOT EXISTS message_template (
+        id SERIAL PRIMARY KEY,
+        text_hash VARCHAR(64) NOT NULL UNIQUE,
+        text TEXT NOT NULL
+    )
+    """,
+    "ALTER TABLE message ADD COLUMN IF NOT EXISTS template_id INTEGER REFERENCES message_template (id)",
+    "ALTER TABLE message ADD COLUMN IF NOT EXISTS template_params TEXT"
+]
+
+# id шаблона по хэшу текста, шаблон создается при первом использовании (asyncpg)
+UPSERT_TEMPLATE_SQL = """
+    WITH inserted AS (
+        INSERT INTO message_template (text_hash, text) VALUES ($1, $2)
+        ON CONFLICT (text_hash) DO NOTHING
+        RETURNING id
+    )
+    SELECT id FROM inserted
+    UNION ALL
+    SELECT id FROM message_template WHERE text_hash = $1
+    LIMIT 1
+"""
+
+
+def ensure_schema(conn) -> None:
+    # SQLAlchemy нужен только веб-приложению и миграциям, бот его не загружает
+    from sqlalchemy import text
+    for statement in SCHEMA_SQL:
+        conn.execute(text(statement))
+
+
+def render(template: str, params: Optional[Dict[str, str]] = None) -> str:
+    """Подставляет параметры вместо {name}; остальные фигурные скобки текста не трогаются"""
+    for key, value in (params or {}).items():
+        template = template.replace('{' + key + '}', value)
+    return template
+
+
+def template_hash(template: str) -> str:
+    return hashlib.sha256(template.encode('utf-8')).hexdigest()
+
+
+def encode_params(params: Dict[str, str]) -> Optional[str]:
+    return json.dumps(params, ensure_ascii=False) if params else None
+
+
+class TemplatedText(str):
+    """Готовый текст сообщения, который помнит свой шаблон и параметры.
+
+    Это обычная строка для отправки в Telegram, n8n и события CRM; при
+    записи в БД вместо текста сохраняются шаблон и параметры.
+    """
+
+    def __new__(cls, template: str, params: Optional[Dict[str, str]] = None):
+        params = params or {}
+        rendered = super().__new__(cls, render(template, params))
+        rendered.template = template
+        rendered.params = params
+        return rendered
+
+
+class TemplateCache:
+    """Шаблоны в памяти процесса: id по тексту при записи и текст по id при чтении"""
+
+    def __init__(self, loader: Optional[Callable[[Iterable[int]], Dict[int, str]]] = None):
+        self.loader = loader
+        self.ids: Dict[str, int] = {}
+        self.texts: Dict[int, str] = {}
+
+    async def get_id(self, conn, template: str) -> int:
+        """id шаблона; вызывается вне транзакции записи, чтобы откат не оставил в кэше несуществующий id"""
+        template_id = self.ids.get(template)
+        if template_id is None:
+            template_id = await conn.fetchval(UPSERT_TEMPLATE_SQL, template_hash(template), template)
+            self.ids[template] = template_id
+            self.texts[template_id] = template
+        return template_id
+
+    async def row_values(self, conn, message_text: str):
+        """(message_text, template_id, template_params) для записи строки message"""
+        if not isinstance(message_text, TemplatedText):
+            return message_text, None, None
+        template_id = await self.get_id(conn, message_text.template)
+        return '', template_id, encode_params(message_text.params)
+
+    def load(self, template_ids: Iterable[int]) -> None:
+        missing = {template_id for template_id in template_ids if template_id not in self.texts}
+        if missing and self.loader:
+            self.texts.update(self.loader(missing))
+
+    def expand(self, template_id: int, params: Optional[str]) -> str:
+        if template_id not in self.texts:
+            self.load([template_id])
+        return render(self.texts.get(template_id, ''), json.loads(params) if params else None)
@@ -0,0 +1,357 @@
+"""
+Метрики Prometheus для веб-приложения и бота.
+
+Веб-приложение: задержка и коды ответов по маршрутам (шаблон url_rule, а
+не сам путь - число рядов не растет с числом клиентов), заполнение пула
+соединений SQLAlchemy, счетчики приема сообщений. Отдаются на /metrics.
+
+Бот: задержка обработчиков по типам update и число обрабатываемых сейчас
+update, ожидание соединения из пула asyncpg, задержка и ошибки вызовов
+n8n/OpenAI/Qdrant (через circuit breaker'ы). Отдаются небольшим
+HTTP-сервером aiohttp на BOT_METRICS_PORT.
+
+Счетчики компонентов (get_stats() склейки, буфера записи, лимитера,
+breaker'ов, кэшей) не дублируются в коде: StatsCollector читает их
+только в момент опроса Prometheus. Стоимость метрик на запрос - несколько
+операций со счетчиками, поэтому их можно держать включенными.
+
+Без пакета prometheus_client метрики отключаются, код работает как раньше.
+Для gunicorn с несколькими worker'ами задайте PROMETHEUS_MULTIPROC_DIR
+(пустой каталог) - тогда /metrics суммирует счетчики всех worker'ов;
+значения StatsCollector в этом режиме относятся к ответившему worker'у.
+"""
+
+import asyncio
+import hmac
+import logging
+import os
+import time
+from contextlib import asynccontextmanager, contextmanager
+from contextvars import ContextVar
+from typing import Any, Callable, Dict, Optional
+
+try:
+    from prometheus_client import CONTENT_TYPE_LATEST, REGISTRY, CollectorRegistry, Counter, Gauge, Histogram, generate_latest
+    from prometheus_client import disable_created_metrics
+    from prometheus_client.core import GaugeMetricFamily
+    # Ряды *_created только удваивают объем ответа
+    disable_created_metrics()
+    PROMETHEUS_AVAILABLE = True
+except ImportError:
+    CONTENT_TYPE_LATEST = 'text/plain; version=0.0.4; charset=utf-8'
+    PROMETHEUS_AVAILABLE = False
+
+logger = logging.getLogger(__name__)
+
+# Границы корзин: от быстрых ответов API до таймаутов внешних сервисов
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 20.0, 30.0)
+ACQUIRE_BUCKETS = (0.0005, 0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 5.0)
+
+
+class _NullMetric:
+    """Заглушка метрики, когда prometheus_client не установлен"""
+
+    def labels(self, *args, **kwargs) -> "_NullMetric":
+        return self
+
+    def inc(self, amount: float = 1) -> None:
+        pass
+
+    def dec(self, amount: float = 1) -> None:
+        pass
+
+    def observe(self, amount: float) -> None:
+        pass
+
+
+def _metric(cls_name: str, *args, **kwargs):
+    if not PROMETHEUS_AVAILABLE:
+        return _NullMetric()
+    return {'Counter': Counter, 'Gauge': Gauge, 'Histogram': Histogram}[cls_name](*args, **kwargs)
+
+
+# Веб-приложение
+HTTP_REQUEST_SECONDS = _metric(
+    'Histogram', 'crm_http_request_duration_seconds', 'Время обработки HTTP-запроса',
+    ['method', 'route'], buckets=LATENCY_BUCKETS
+)
+HTTP_RESPONSES = _metric(
+    'Counter', 'crm_http_responses_total', 'HTTP-ответы по маршрутам и кодам', ['method', 'route', 'status']
+)
+INGEST_MESSAGES = _metric(
+    'Counter', 'crm_ingest_messages_total',
+    'Запросы приема сообщений: stored, replayed, rejected, failed', ['endpoint', 'outcome']
+)
+INGEST_CLIENTS_CREATED = _metric(
+    'Counter', 'crm_ingest_clients_created_total', 'Клиенты, созданные API приема сообщений', ['endpoint']
+)
+DB_POOL_TIMEOUTS = _metric(
+    'Counter', 'crm_db_pool_timeouts_total', 'Запросы, не дождавшиеся соединения из пула SQLAlchemy (pool_timeout)'
+)
+
+# Бот
+BOT_HANDLER_SECONDS = _metric(
+    'Histogram', 'bot_handler_duration_seconds', 'Время обработки update по обработчикам',
+    ['handler'], buckets=LATENCY_BUCKETS
+)
+BOT_HANDLER_ERRORS = _metric(
+    'Counter', 'bot_handler_errors_total', 'Исключения в обработчиках update', ['handler']
+)
+BOT_UPDATES_IN_FLIGHT = _metric(
+    'Gauge', 'bot_updates_in_flight', 'Update, обрабатываемые в данный момент', ['handler'],
+    multiprocess_mode='livesum'
+)
+BOT_DB_ACQUIRE_SECONDS = _metric(
+    'Histogram', 'bot_db_pool_acquire_seconds', 'Ожидание соединения из пула asyncpg',
+    ['pool'], buckets=ACQUIRE_BUCKETS
+)
+BOT_EXTERNAL_CALL_SECONDS = _metric(
+    'Histogram', 'bot_external_call_duration_seconds', 'Время вызова внешнего сервиса',
+    ['dependency'], buckets=LATENCY_BUCKETS
+)
+BOT_EXTERNAL_CALL_ERRORS = _metric(
+    'Counter', 'bot_external_call_errors_total', 'Неуспешные вызовы внешнего сервиса (ошибка или таймаут)',
+    ['dependency']
+)
+BOT_HANDLER_AWAIT_SECONDS = _metric(
+    'Histogram', 'bot_handler_await_seconds', 'Ожидание внутри обработчика по видам (только при профилировании)',
+    ['handler', 'component'], buckets=LATENCY_BUCKETS
+)
+
+# Суммарное ожидание по видам (db, n8n, openai, telegram...) для текущего обработчика; None - не собирается
+await_breakdown: ContextVar[Optional[Dict[str, float]]] = ContextVar('await_breakdown', default=None)
+
+
+def record_await(component: str, duration: float) -> None:
+    breakdown = await_breakdown.get()
+    if breakdown is not None:
+        breakdown[component] = breakdown.get(component, 0.0) + duration
+
+
+class StatsCollector:
+    """Отдает словари get_stats() компонентов как gauge-метрики при каждом опросе.
+
+    Числовое значение stat компонента component становится метрикой
+    {prefix}_{component}_{stat}; строковое - метрикой с меткой-значением и
+    значением 1 (например, bot_breaker_state{state="open"} 1). Если
+    get_stats возвращает словарь словарей, ключ внешнего словаря
+    становится меткой label.
+    """
+
+    def __init__(self, prefix: str):
+        self.prefix = prefix
+        self._sources: Dict[str, tuple] = {}
+
+    def add(self, component: str, get_stats: Callable[[], Optional[Dict[str, Any]]], label: Optional[str] = None) -> None:
+        self._sources[component] = (get_stats, label)
+
+    def describe(self):
+        # Без describe() реестр вызвал бы collect() при регистрации, до готовности компонентов
+        return []
+
+    def collect(self):
+        for component, (get_stats, label) in list(self._sources.items()):
+            try:
+                stats = get_stats()
+            except Exception as e:
+                logger.warning(f"Не удалось получить статистику {component} для метрик: {e}")
+                continue
+            if not stats:
+                continue
+            groups = stats.items() if label else [(None, stats)]
+            families: Dict[str, GaugeMetricFamily] = {}
+            for group, values in groups:
+                for key, value in values.items():
+                    if label and key == label:
+                        continue
+                    name = f"{self.prefix}_{component}_{key}"
+                    labels = [label] if label else []
+                    label_values = [str(group)] if label else []
+                    if isinstance(value, str):
+                        labels = labels + [key]
+                        label_values = label_values + [value]
+                        value = 1
+                    elif not isinstance(value, (int, float)):
+                        continue
+                    family = families.get(name)
+                    if family is None:
+                        family = families[name] = GaugeMetricFamily(name, f"{component}: {key}", labels=labels)
+                    family.add_metric(label_values, float(value))
+            yield from families.values()
+
+
+# Коллекторы со значениями текущего процесса (в многопроцессном режиме добавляются к сумме worker'ов)
+_process_collectors = []
+
+
+def register_stats(collector: StatsCollector, registry=None) -> None:
+    if PROMETHEUS_AVAILABLE:
+        (registry or REGISTRY).register(collector)
+
+
+def render_latest() -> bytes:
+    """Текст метрик для ответа на опрос Prometheus"""
+    if not PROMETHEUS_AVAILABLE:
+        return b''
+    if os.getenv('PROMETHEUS_MULTIPROC_DIR'):
+        from prometheus_client import multiprocess
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+        for collector in _process_collectors:
+            registry.register(collector)
+        return generate_latest(registry)
+    return generate_latest(REGISTRY)
+
+
+def sqlalchemy_pool_stats(engine, max_size: Optional[int] = None) -> Dict[str, Any]:
+    """Заполнение пула SQLAlchemy (QueuePool); у других пулов часть значений отсутствует.
+    max_size - pool_size + max_overflow: при checked_out = max_size следующий запрос ждет pool_timeout"""
+    pool = engine.pool
+    stats = {'max_size': max_size} if max_size is not None else {}
+    for key, method in (('size', 'size'), ('checked_out', 'checkedout'),
+                        ('checked_in', 'checkedin'), ('overflow', 'overflow')):
+        if hasattr(pool, method):
+            stats[key] = getattr(pool, method)()
+    return stats
+
+
+def init_app(app, stats_sources: Optional[Dict[str, Callable[[], Optional[Dict[str, Any]]]]] = None) -> None:
+    """Метрики HTTP-запросов и маршрут /metrics.
+
+    /metrics отдается только с METRICS_TOKEN (опрос с заголовком Authorization:
+    Bearer <токен>): маршрут на том же порту, что и CRM, а метрики раскрывают
+    задержки маршрутов, состояние пулов и имена обработчиков. Без токена
+    маршрут не регистрируется (404).
+    """
+    from flask import Response, abort, g, request
+
+    if not app.config.get('METRICS_ENABLED', True):
+        return
+    token = app.config.get('METRICS_TOKEN')
+
+    if stats_sources:
+        collector = StatsCollector('crm')
+        for component, get_stats in stats_sources.items():
+            collector.add(component, get_stats)
+        register_stats(collector)
+        _process_collectors.append(collector)
+
+    @app.before_request
+    def _start_request_timer():
+        g.metrics_started = time.perf_counter()
+
+    @app.after_request
+    def _observe_request(response):
+        started = g.pop('metrics_started', None)
+        if started is None or request.endpoint == 'metrics':
+            return response
+        # Шаблон маршрута вместо пути: /client/<int:client_id>, а не /client/123
+        route = request.url_rule.rule if request.url_rule is not None else 'unmatched'
+        HTTP_REQUEST_SECONDS.labels(request.method, route).observe(time.perf_counter() - started)
+        HTTP_RESPONSES.labels(request.method, route, str(response.status_code)).inc()
+        return response
+
+    if not token:
+        app.logger.warning("METRICS_TOKEN не задан: маршрут /metrics отключен")
+        return
+
+    @app.route('/metrics')
+    def metrics():
+        if not hmac.compare_digest(request.headers.get('Authorization', ''), f'Bearer {token}'):
+            abort(401)
+        return Response(render_latest(), content_type=CONTENT_TYPE_LATEST)
+
+
+@contextmanager
+def track_handler(handler: str):
+    """Время обработки и число одновременно обрабатываемых update обработчика"""
+    in_flight = BOT_UPDATES_IN_FLIGHT.labels(handler)
+    in_flight.inc()
+    started = time.perf_counter()
+    try:
+        yield
+    except Exception:
+        BOT_HANDLER_ERRORS.labels(handler).inc()
+        raise
+    finally:
+        BOT_HANDLER_SECONDS.labels(handler).observe(time.perf_counter() - started)
+        in_flight.dec()
+
+
+def observe_external_call(dependency: str, success: bool, duration: float) -> None:
+    """Наблюдатель circuit breaker'а: задержка и ошибки вызовов зависимости"""
+    BOT_EXTERNAL_CALL_SECONDS.labels(dependency).observe(duration)
+    record_await(dependency, duration)
+    if not success:
+        BOT_EXTERNAL_CALL_ERRORS.labels(dependency).inc()
+
+
+class InstrumentedPool:
+    """Обертка пула asyncpg: время ожидания соединения в acquire() и исчерпание пула, остальное - как у пула"""
+
+    def __init__(self, pool, name: str = 'main', acquire_timeout: Optional[float] = None):
+        self._pool = pool
+        self._acquire_seconds = BOT_DB_ACQUIRE_SECONDS.labels(name)
+        self.acquire_timeout = acquire_timeout
+        self._waiting = 0
+        self.stats = {'max_waiting': 0, 'acquire_timeouts': 0}
+
+    @asynccontextmanager
+    async def acquire(self, *, timeout: Optional[float] = None):
+        started = time.perf_counter()
+        self._waiting += 1
+        self.stats['max_waiting'] = max(self.stats['max_waiting'], self._waiting)
+        try:
+            connection = await self._pool.acquire(timeout=timeout or self.acquire_timeout)
+        except asyncio.TimeoutError:
+            self.stats['acquire_timeouts'] += 1
+            raise
+        finally:
+            self._waiting -= 1
+        acquired = time.perf_counter()
+        self._acquire_seconds.observe(acquired - started)
+        record_await('db_acquire', acquired - started)
+        try:
+            yield connection
+        finally:
+            await self._pool.release(connection)
+            # Время работы с соединением (запросы и ожидание между ними)
+            record_await('db', time.perf_counter() - acquired)
+
+    def get_stats(self) -> Dict[str, int]:
+        size = self._pool.get_size()
+        idle = self._pool.get_idle_size()
+        return {
+            'size': size,
+            'idle': idle,
+            'in_use': size - idle,
+            'max_size': self._pool.get_max_size(),
+            'waiting': self._waiting,
+            **self.stats
+        }
+
+    def __getattr__(self, name):
+        return getattr(self._pool, name)
+
+
+async def start_metrics_server(host: str, port: int, collector: Optional[StatsCollector] = None):
+    """HTTP-сервер /metrics в цикле событий бота. Возвращает runner для остановки (runner.cleanup())"""
+    from aiohttp import web
+
+    if not PROMETHEUS_AVAILABLE:
+        logger.warning("prometheus_client не установлен, сервер метрик не запущен")
+        return None
+    if collector is not None:
+        register_stats(collector)
+        _process_collectors.append(collector)
+
+    async def handle_metrics(request):
+        return web.Response(body=render_latest(), headers={'Content-Type': CONTENT_TYPE_LATEST})
+
+    application = web.Application()
+    application.router.add_get('/metrics', handle_metrics)
+    runner = web.AppRunner(application, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    logger.info(f"Метрики бота доступны на http://{host}:{port}/metrics")
+    return runner
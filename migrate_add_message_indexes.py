@@ -0,0 +1,40 @@
+#!/usr/bin/env python3
+"""
+Миграция для добавления индекса постраничной загрузки диалога в таблицу message
+"""
+import os
+from dotenv import load_dotenv
+from sqlalchemy import create_engine, text
+
+load_dotenv()
+
+def migrate_add_message_indexes():
+    """Создает индекс (client_id, timestamp, id) для keyset-пагинации сообщений"""
+    
+    # Получаем URL базы данных
+    database_url = os.getenv('DATABASE_URL', 'postgresql://localhost/clienterra_crm')
+    if database_url.startswith('postgres://'):
+        database_url = database_url.replace('postgres://', 'postgresql://', 1)
+    
+    print(f"🔗 Подключение к базе данных: {database_url.split('@')[1] if '@' in database_url else database_url}")
+    
+    try:
+        engine = create_engine(database_url)
+        
+        # CREATE INDEX CONCURRENTLY нельзя выполнять внутри транзакции
+        with engine.connect().execution_options(isolation_level="AUTOCOMMIT") as conn:
+            print("📝 Создаем индекс ix_message_client_timestamp_id...")
+            conn.execute(text("""
+                CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_message_client_timestamp_id
+                ON message (client_id, timestamp, id)
+            """))
+            print("✅ Миграция успешно завершена!")
+            
+    except Exception as e:
+        print(f"❌ Ошибка миграции: {e}")
+        raise
+
+if __name__ == "__main__":
+    print("🚀 Запуск миграции для добавления индексов таблицы message")
+    print("=" * 50)
+    migrate_add_message_indexes()
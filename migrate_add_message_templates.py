@@ -0,0 +1,87 @@
+#!/usr/bin/env python3
+"""
+Миграция для хранения сообщений бота ссылкой на шаблон: таблица
+message_template и поля template_id, template_params в таблице message.
+Уже записанные служебные сообщения бота переводятся на шаблоны пачками.
+"""
+import os
+import time
+from dotenv import load_dotenv
+from sqlalchemy import bindparam, create_engine, text
+
+from bot_texts import BOILERPLATE_TEXTS
+from message_templates import ensure_schema, template_hash
+
+load_dotenv()
+
+BATCH_SIZE = 1000
+BATCH_PAUSE_SECONDS = 0.1
+
+def convert_existing(engine, template_text):
+    """Заменяет полный текст сообщений бота ссылкой на шаблон, пачками по id"""
+    with engine.begin() as conn:
+        conn.execute(text("""
+            INSERT INTO message_template (text_hash, text) VALUES (:text_hash, :text)
+            ON CONFLICT (text_hash) DO NOTHING
+        """), {'text_hash': template_hash(template_text), 'text': template_text})
+        template_id = conn.execute(text("SELECT id FROM message_template WHERE text_hash = :text_hash"),
+                                   {'text_hash': template_hash(template_text)}).scalar()
+
+    select_batch = text("""
+        SELECT id FROM message
+        WHERE id > :last_id AND is_from_bot AND template_id IS NULL AND message_text = :text
+        ORDER BY id LIMIT :limit
+    """)
+    update_batch = text("UPDATE message SET template_id = :template_id, message_text = '' WHERE id IN :ids") \
+        .bindparams(bindparam('ids', expanding=True))
+
+    converted = 0
+    last_id = 0
+    while True:
+        with engine.begin() as conn:
+            ids = [row[0] for row in conn.execute(select_batch, {'last_id': last_id, 'text': template_text,
+                                                                 'limit': BATCH_SIZE})]
+            if ids:
+                conn.execute(update_batch, {'template_id': template_id, 'ids': ids})
+        converted += len(ids)
+        if len(ids) < BATCH_SIZE:
+            return converted
+        last_id = ids[-1]
+        time.sleep(BATCH_PAUSE_SECONDS)
+
+def migrate_add_message_templates():
+    """Создает таблицу шаблонов и переводит на них служебные сообщения бота"""
+
+    # Получаем URL базы данных
+    database_url = os.getenv('DATABASE_URL', 'postgresql://localhost/clienterra_crm')
+    if database_url.startswith('postgres://'):
+        database_url = database_url.replace('postgres://', 'postgresql://', 1)
+
+    print(f"🔗 Подключение к базе данных: {database_url.split('@')[1] if '@' in database_url else database_url}")
+
+    try:
+        engine = create_engine(database_url)
+
+        with engine.begin() as conn:
+            print("📝 Создаем таблицу message_template и поля template_id, template_params...")
+            ensure_schema(conn)
+            welcome_message = conn.execute(text("SELECT welcome_message FROM bot_settings LIMIT 1")).scalar()
+
+        # Приветствие с {name}/{username} записано уже подставленным - такие сообщения остаются как есть
+        texts = list(BOILERPLATE_TEXTS)
+        if welcome_message and '{name}' not in welcome_message and '{username}' not in welcome_message:
+            texts.append(welcome_message)
+
+        for template_text in texts:
+            converted = convert_existing(engine, template_text)
+            print(f"📝 {template_text[:40]}...: {converted} сообщений")
+        print("✅ Миграция успешно завершена!")
+
+    except Exception as e:
+        print(f"❌ Ошибка миграции: {e}")
+        raise
+
+if __name__ == "__main__":
+    print("🚀 Запуск миграции для хранения сообщений бота по шаблонам")
+    print("=" * 50)
+    migrate_add_message_templates()
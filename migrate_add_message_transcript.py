@@ -0,0 +1,52 @@
+#!/usr/bin/env python3
+"""
+Миграция для добавления поля transcript в таблицу message
+"""
+import os
+from dotenv import load_dotenv
+from sqlalchemy import create_engine, text
+
+load_dotenv()
+
+def migrate_add_message_transcript():
+    """Добавляет поле transcript (расшифровка голосовых сообщений) в таблицу message"""
+    
+    # Получаем URL базы данных
+    database_url = os.getenv('DATABASE_URL', 'postgresql://localhost/clienterra_crm')
+    if database_url.startswith('postgres://'):
+        database_url = database_url.replace('postgres://', 'postgresql://', 1)
+    
+    print(f"🔗 Подключение к базе данных: {database_url.split('@')[1] if '@' in database_url else database_url}")
+    
+    try:
+        engine = create_engine(database_url)
+        
+        with engine.connect() as conn:
+            # Проверяем, существует ли уже поле transcript
+            result = conn.execute(text("""
+                SELECT column_name 
+                FROM information_schema.columns 
+                WHERE table_name = 'message' AND column_name = 'transcript'
+            """))
+            
+            if result.fetchone():
+                print("✅ Поле transcript уже существует")
+                return
+            
+            print("📝 Добавляем поле transcript...")
+            conn.execute(text("""
+                ALTER TABLE message 
+                ADD COLUMN transcript TEXT
+            """))
+            
+            conn.commit()
+            print("✅ Миграция успешно завершена!")
+            
+    except Exception as e:
+        print(f"❌ Ошибка миграции: {e}")
+        raise
+
+if __name__ == "__main__":
+    print("🚀 Запуск миграции для добавления поля transcript")
+    print("=" * 50)
+    migrate_add_message_transcript()
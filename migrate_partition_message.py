@@ -0,0 +1,54 @@
+#!/usr/bin/env python3
+"""
+Миграция таблицы message в секционированную по месяцам (PostgreSQL)
+и создание таблицы сегментов архива message_archive_segment
+"""
+import os
+from dotenv import load_dotenv
+from sqlalchemy import create_engine, text
+
+from message_partitions import partition_message_table
+
+load_dotenv()
+
+def migrate_partition_message(months_ahead=3):
+    """Переносит сообщения в секционированную таблицу; таблица блокируется на время копирования"""
+
+    # Получаем URL базы данных
+    database_url = os.getenv('DATABASE_URL', 'postgresql://localhost/clienterra_crm')
+    if database_url.startswith('postgres://'):
+        database_url = database_url.replace('postgres://', 'postgresql://', 1)
+
+    print(f"🔗 Подключение к базе данных: {database_url.split('@')[1] if '@' in database_url else database_url}")
+
+    try:
+        engine = create_engine(database_url)
+
+        with engine.begin() as conn:
+            print("📝 Создаем таблицу message_archive_segment...")
+            conn.execute(text("""
+                CREATE TABLE IF NOT EXISTS message_archive_segment (
+                    client_id INTEGER NOT NULL REFERENCES client (id) ON DELETE CASCADE,
+                    month DATE NOT NULL,
+                    file_name VARCHAR(255) NOT NULL,
+                    byte_offset BIGINT NOT NULL,
+                    byte_length INTEGER NOT NULL,
+                    message_count INTEGER NOT NULL,
+                    PRIMARY KEY (client_id, month)
+                )
+            """))
+
+            print("📝 Секционируем таблицу message...")
+            if partition_message_table(conn, months_ahead):
+                print("✅ Миграция успешно завершена!")
+            else:
+                print("✅ Таблица message уже секционирована")
+
+    except Exception as e:
+        print(f"❌ Ошибка миграции: {e}")
+        raise
+
+if __name__ == "__main__":
+    print("🚀 Запуск миграции секционирования таблицы message")
+    print("=" * 50)
+    migrate_partition_message()
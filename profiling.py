@@ -0,0 +1,350 @@
+"""
+Профилирование по запросу для веб-приложения и бота.
+
+Профиль снимается сэмплированием: фоновый поток каждые interval секунд
+читает стек профилируемого потока (sys._current_frames) и считает
+одинаковые стеки. Результат сохраняется в формате folded stacks
+("f1;f2;f3 N" в строке) - его понимают flamegraph.pl, speedscope и
+inferno. Код профилируемого потока не замедляется, пока сэмплер не
+включен.
+
+Веб-приложение: RequestProfiler профилирует долю запросов (sample_rate)
+и запросы с заголовком X-Profile (значение - PROFILE_TOKEN, либо любое
+значение от вошедшего пользователя). Долю можно менять без перезапуска:
+она хранится в файле в каталоге профилей и перечитывается всеми
+worker'ами.
+
+Бот: BotProfiler включается и выключается сигналом SIGUSR1. Включенный
+профилировщик сэмплирует поток цикла событий, ловит блокировки цикла
+дольше порога (со стеком блокирующего кода) и раскладывает время
+обработчиков по видам ожидания: БД, n8n, OpenAI, Qdrant, Telegram API.
+"""
+
+import asyncio
+import logging
+import os
+import random
+import re
+import sys
+import threading
+import time
+from collections import Counter
+from contextlib import contextmanager
+from datetime import datetime
+from typing import Any, Dict, List, Optional
+
+from metrics import BOT_HANDLER_AWAIT_SECONDS, await_breakdown
+
+logger = logging.getLogger(__name__)
+
+PROFILE_SUFFIX = '.folded'
+
+
+def fold_stack(frame) -> str:
+    """Стек от корня к вершине: функция (файл:строка начала), через ';'"""
+    names = []
+    while frame is not None:
+        code = frame.f_code
+        names.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+        frame = frame.f_back
+    return ';'.join(reversed(names))
+
+
+class StackSampler:
+    """Один фоновый поток на процесс, сэмплирует стеки зарегистрированных потоков"""
+
+    def __init__(self, interval: float):
+        self.interval = interval
+        self._targets: Dict[int, Counter] = {}
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        self._thread_pid: Optional[int] = None
+
+    def start(self, thread_id: int) -> Counter:
+        samples = Counter()
+        with self._lock:
+            self._targets[thread_id] = samples
+            # После fork (gunicorn --preload) поток сэмплера нужно создать заново
+            if self._thread is None or self._thread_pid != os.getpid() or not self._thread.is_alive():
+                self._thread_pid = os.getpid()
+                self._thread = threading.Thread(target=self._run, name='stack-sampler', daemon=True)
+                self._thread.start()
+        self._wakeup.set()
+        return samples
+
+    def stop(self, thread_id: int) -> Counter:
+        with self._lock:
+            return self._targets.pop(thread_id, Counter())
+
+    def _run(self) -> None:
+        while True:
+            with self._lock:
+                targets = list(self._targets.items())
+            if not targets:
+                self._wakeup.wait()
+                self._wakeup.clear()
+                continue
+            frames = sys._current_frames()
+            for thread_id, samples in targets:
+                frame = frames.get(thread_id)
+                if frame is not None:
+                    samples[fold_stack(frame)] += 1
+            del frames
+            time.sleep(self.interval)
+
+
+def write_profile(directory: str, name: str, samples: Counter, max_files: int) -> Optional[str]:
+    """Сохраняет профиль в формате folded stacks; старые файлы сверх max_files удаляются"""
+    if not samples:
+        return None
+    os.makedirs(directory, exist_ok=True)
+    filename = f"{datetime.utcnow().strftime('%Y%m%dT%H%M%S')}_{os.getpid()}_{re.sub(r'[^A-Za-z0-9_.-]+', '-', name)}{PROFILE_SUFFIX}"
+    path = os.path.join(directory, filename)
+    with open(path, 'w', encoding='utf-8') as f:
+        for stack, count in samples.most_common():
+            f.write(f"{stack} {count}\n")
+
+    profiles = list_profiles(directory)
+    for old in profiles[max_files:]:
+        try:
+            os.remove(os.path.join(directory, old['name']))
+        except OSError:
+            pass
+    return path
+
+
+def list_profiles(directory: str) -> List[Dict[str, Any]]:
+    """Профили каталога, новые первыми"""
+    try:
+        entries = [entry for entry in os.scandir(directory) if entry.name.endswith(PROFILE_SUFFIX)]
+    except FileNotFoundError:
+        return []
+    entries.sort(key=lambda entry: entry.stat().st_mtime, reverse=True)
+    return [{'name': entry.name, 'size': entry.stat().st_size} for entry in entries]
+
+
+class RequestProfiler:
+    """Сэмплирующее профилирование части HTTP-запросов Flask"""
+
+    RATE_FILE = 'sample_rate'
+
+    def __init__(self, directory: str, sample_rate: float = 0.0, interval: float = 0.005,
+                 header: str = 'X-Profile', token: Optional[str] = None, max_files: int = 200):
+        self.directory = directory
+        self.default_rate = sample_rate
+        self.header = header
+        self.token = token
+        self.max_files = max_files
+        self.sampler = StackSampler(interval)
+        self._rate = sample_rate
+        self._rate_checked_at = 0.0
+        self._rate_mtime = None
+        self.stats = {'profiled': 0, 'forced': 0, 'written': 0}
+
+    @property
+    def sample_rate(self) -> float:
+        """Доля профилируемых запросов; файл настройки перечитывается не чаще раза в секунду"""
+        now = time.monotonic()
+        if now - self._rate_checked_at >= 1.0:
+            self._rate_checked_at = now
+            path = os.path.join(self.directory, self.RATE_FILE)
+            try:
+                mtime = os.stat(path).st_mtime
+                if mtime != self._rate_mtime:
+                    with open(path) as f:
+                        self._rate = min(1.0, max(0.0, float(f.read().strip())))
+                    self._rate_mtime = mtime
+            except (OSError, ValueError):
+                self._rate = self.default_rate
+                self._rate_mtime = None
+        return self._rate
+
+    def set_sample_rate(self, rate: float) -> None:
+        """Меняет долю для всех worker'ов (через файл в каталоге профилей)"""
+        os.makedirs(self.directory, exist_ok=True)
+        path = os.path.join(self.directory, self.RATE_FILE)
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, 'w') as f:
+            f.write(str(min(1.0, max(0.0, rate))))
+        os.replace(tmp_path, path)
+        self._rate_checked_at = 0.0
+
+    def init_app(self, app) -> None:
+        from flask import g, request
+        from flask_login import current_user
+
+        @app.before_request
+        def _start_profile():
+            value = request.headers.get(self.header)
+            # С PROFILE_TOKEN заголовок должен содержать токен, без него - достаточно входа в CRM
+            forced = bool(value) and (value == self.token if self.token else current_user.is_authenticated)
+            rate = self.sample_rate
+            if not forced and not (rate > 0 and random.random() < rate):
+                return
+            g.profile_forced = forced
+            g.profile_started = time.perf_counter()
+            g.profile_samples = self.sampler.start(threading.get_ident())
+
+        def finish(response=None):
+            samples = g.pop('profile_samples', None)
+            if samples is None:
+                return None
+            self.sampler.stop(threading.get_ident())
+            elapsed_ms = (time.perf_counter() - g.pop('profile_started')) * 1000
+            forced = g.pop('profile_forced', False)
+            self.stats['profiled'] += 1
+            self.stats['forced'] += forced
+            endpoint = request.endpoint or 'unmatched'
+            try:
+                path = write_profile(self.directory, f"{endpoint}_{elapsed_ms:.0f}ms", samples, self.max_files)
+            except OSError as e:
+                logger.warning(f"Не удалось сохранить профиль запроса {request.path}: {e}")
+                return None
+            if path is None:
+                return None
+            self.stats['written'] += 1
+            logger.info(f"Профиль {request.method} {request.path} ({elapsed_ms:.0f} мс): {path}")
+            if response is not None and forced:
+                response.headers['X-Profile-File'] = os.path.basename(path)
+            return path
+
+        @app.after_request
+        def _finish_profile(response):
+            finish(response)
+            return response
+
+        @app.teardown_request
+        def _finish_failed_profile(exc):
+            # after_request не вызывается при необработанном исключении
+            finish()
+
+    def get_stats(self) -> Dict[str, Any]:
+        stats = dict(self.stats)
+        stats['sample_rate'] = self.sample_rate
+        return stats
+
+
+class BotProfiler:
+    """Профилирование цикла событий бота, включается и выключается без перезапуска"""
+
+    def __init__(self, directory: str, stall_seconds: float = 0.1, interval: float = 0.005,
+                 max_files: int = 200):
+        self.directory = directory
+        self.stall_seconds = stall_seconds
+        self.max_files = max_files
+        self.sampler = StackSampler(interval)
+        self.enabled = False
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._loop_thread_id: Optional[int] = None
+        self._samples: Counter = Counter()
+        self._heartbeat_task: Optional[asyncio.Task] = None
+        self._watchdog: Optional[threading.Thread] = None
+        self._last_beat = 0.0
+        self._stall_reported = False
+        self.stats = {'stalls': 0, 'max_stall_seconds': 0.0, 'slow_handlers': 0, 'profiles_written': 0}
+
+    def enable(self) -> None:
+        if self.enabled:
+            return
+        self._loop = asyncio.get_running_loop()
+        self._loop_thread_id = threading.get_ident()
+        self._samples = self.sampler.start(self._loop_thread_id)
+        self._last_beat = time.monotonic()
+        self.enabled = True
+        self._heartbeat_task = asyncio.create_task(self._heartbeat())
+        if self._watchdog is None or not self._watchdog.is_alive():
+            self._watchdog = threading.Thread(target=self._watch, name='loop-watchdog', daemon=True)
+            self._watchdog.start()
+        logger.info(f"Профилирование бота включено (порог блокировки цикла {self.stall_seconds * 1000:.0f} мс)")
+
+    def disable(self) -> Optional[str]:
+        """Выключает профилирование и сохраняет профиль цикла событий"""
+        if not self.enabled:
+            return None
+        self.enabled = False
+        if self._heartbeat_task:
+            self._heartbeat_task.cancel()
+        samples = self.sampler.stop(self._loop_thread_id)
+        path = None
+        try:
+            path = write_profile(self.directory, 'bot', samples, self.max_files)
+        except OSError as e:
+            logger.warning(f"Не удалось сохранить профиль бота: {e}")
+        if path:
+            self.stats['profiles_written'] += 1
+        logger.info(f"Профилирование бота выключено, профиль: {path or 'нет сэмплов'}")
+        return path
+
+    def toggle(self) -> None:
+        if self.enabled:
+            self.disable()
+        else:
+            self.enable()
+
+    def install_signal_handler(self, signum: int) -> bool:
+        """Переключение профилирования сигналом (kill -USR1 <pid>); False - платформа не поддерживает"""
+        try:
+            asyncio.get_running_loop().add_signal_handler(signum, self.toggle)
+            return True
+        except (NotImplementedError, RuntimeError):
+            return False
+
+    async def _heartbeat(self) -> None:
+        """Отметки цикла событий; задержка отметки - время, когда цикл был занят"""
+        interval = self.stall_seconds / 2
+        while self.enabled:
+            expected = time.monotonic() + interval
+            await asyncio.sleep(interval)
+            now = time.monotonic()
+            lag = now - expected
+            self._last_beat = now
+            self._stall_reported = False
+            if lag >= self.stall_seconds:
+                self.stats['stalls'] += 1
+                self.stats['max_stall_seconds'] = round(max(self.stats['max_stall_seconds'], lag), 3)
+
+    def _watch(self) -> None:
+        """Поток-сторож: если цикл не отмечался дольше порога, записывает стек блокирующего кода"""
+        while self.enabled:
+            time.sleep(self.stall_seconds / 4)
+            blocked = time.monotonic() - self._last_beat
+            if blocked < self.stall_seconds * 1.5 or self._stall_reported:
+                continue
+            frame = sys._current_frames().get(self._loop_thread_id)
+            if frame is None:
+                continue
+            self._stall_reported = True
+            stack = fold_stack(frame).split(';')
+            logger.warning(
+                f"Цикл событий заблокирован дольше {blocked * 1000:.0f} мс, стек:\n  " + '\n  '.join(stack[-15:])
+            )
+
+    @contextmanager
+    def handler_breakdown(self, handler: str):
+        """Раскладывает время обработчика по видам ожидания (только при включенном профилировании)"""
+        if not self.enabled:
+            yield
+            return
+        breakdown: Dict[str, float] = {}
+        token = await_breakdown.set(breakdown)
+        started = time.monotonic()
+        try:
+            yield
+        finally:
+            await_breakdown.reset(token)
+            elapsed = time.monotonic() - started
+            for component, seconds in breakdown.items():
+                BOT_HANDLER_AWAIT_SECONDS.labels(handler, component).observe(seconds)
+            if elapsed >= self.stall_seconds:
+                self.stats['slow_handlers'] += 1
+                waited = sum(breakdown.values())
+                parts = [f"{component} {seconds * 1000:.0f} мс" for component, seconds in
+                         sorted(breakdown.items(), key=lambda item: -item[1])]
+                parts.append(f"прочее {max(0.0, elapsed - waited) * 1000:.0f} мс")
+                logger.info(f"Обработчик {handler} {elapsed * 1000:.0f} мс: {', '.join(parts)}")
+
+    def get_stats(self) -> Dict[str, Any]:
+        stats = dict(self.stats)
+        stats['enabled'] = int(self.enabled)
+        return stats
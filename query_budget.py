@@ -0,0 +1,145 @@
+"""
+Учет SQL-запросов на HTTP-запрос Flask.
+
+Обработчики событий SQLAlchemy (before/after_cursor_execute) считают
+запросы и их время в контексте текущего запроса. После ответа итог
+уходит в заголовок Server-Timing (виден во вкладке Network браузера) и
+в лог; запросы с одинаковым текстом, выполненные много раз подряд,
+помечаются как вероятный N+1.
+
+count_queries() и assert_max_queries() считают запросы внутри блока кода -
+для проверок бюджета запросов (см. check_query_budgets.py) и тестов.
+"""
+
+import logging
+import time
+from collections import Counter
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Iterator, List, Optional, Tuple
+
+from flask import Flask, g, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+logger = logging.getLogger(__name__)
+
+_current: ContextVar[Optional["QueryStats"]] = ContextVar('query_stats', default=None)
+
+
+class QueryStats:
+    """Счетчики запросов одного блока; вложенные блоки добавляют свои запросы и во внешний"""
+
+    def __init__(self, parent: Optional["QueryStats"] = None):
+        self.parent = parent
+        self.count = 0
+        self.duration = 0.0
+        self.statements: Counter = Counter()
+
+    def record(self, statement: str, duration: float) -> None:
+        stats = self
+        while stats is not None:
+            stats.count += 1
+            stats.duration += duration
+            stats.statements[statement] += 1
+            stats = stats.parent
+
+    def repeated(self, threshold: int) -> List[Tuple[str, int]]:
+        """Запросы, выполненные не меньше threshold раз - признак N+1"""
+        return [(statement, count) for statement, count in self.statements.most_common() if count >= threshold]
+
+    def summary(self, limit: int = 5) -> str:
+        lines = [f"{self.count} запросов, {self.duration * 1000:.1f} мс"]
+        for statement, count in self.statements.most_common(limit):
+            lines.append(f"  {count} x {' '.join(statement.split())[:200]}")
+        return '\n'.join(lines)
+
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    if _current.get() is not None:
+        conn.info.setdefault('query_started', []).append(time.perf_counter())
+
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    stats = _current.get()
+    started = conn.info.get('query_started')
+    if stats is not None and started:
+        stats.record(statement, time.perf_counter() - started.pop())
+
+
+@event.listens_for(Engine, 'handle_error')
+def _handle_error(exception_context):
+    started = exception_context.connection.info.get('query_started') if exception_context.connection else None
+    if started:
+        started.pop()
+
+
+@contextmanager
+def count_queries() -> Iterator[QueryStats]:
+    """Считает SQL-запросы, выполненные внутри блока"""
+    stats = QueryStats(parent=_current.get())
+    token = _current.set(stats)
+    try:
+        yield stats
+    finally:
+        _current.reset(token)
+
+
+@contextmanager
+def assert_max_queries(max_count: int, max_repeats: Optional[int] = None) -> Iterator[QueryStats]:
+    """AssertionError, если блок выполнил больше max_count запросов
+    (или один и тот же запрос больше max_repeats раз)"""
+    with count_queries() as stats:
+        yield stats
+    if stats.count > max_count:
+        raise AssertionError(f"Ожидалось не больше {max_count} запросов, выполнено {stats.summary()}")
+    if max_repeats is not None:
+        repeated = stats.repeated(max_repeats + 1)
+        if repeated:
+            raise AssertionError(f"Запрос повторен {repeated[0][1]} раз (лимит {max_repeats}):\n{stats.summary()}")
+
+
+def init_app(app: Flask) -> None:
+    """Учет запросов для каждого HTTP-запроса приложения"""
+    warn_count = app.config.get('QUERY_BUDGET_WARN', 20)
+    repeat_warn = app.config.get('QUERY_REPEAT_WARN', 5)
+    timing_header = app.config.get('QUERY_TIMING_HEADER', True)
+
+    @app.before_request
+    def _start_query_stats():
+        g.query_stats = QueryStats(parent=_current.get())
+        g.query_stats_token = _current.set(g.query_stats)
+        g.request_started = time.perf_counter()
+
+    @app.after_request
+    def _report_query_stats(response):
+        stats = g.pop('query_stats', None)
+        if stats is None:
+            return response
+        total = time.perf_counter() - g.pop('request_started')
+
+        if timing_header:
+            response.headers.add(
+                'Server-Timing',
+                f'db;dur={stats.duration * 1000:.1f};desc="{stats.count} queries", app;dur={total * 1000:.1f}'
+            )
+
+        repeated = stats.repeated(repeat_warn)
+        if stats.count > warn_count or repeated:
+            reason = 'повторяющиеся запросы (N+1?)' if repeated else 'превышен бюджет запросов'
+            logger.warning(f"{request.method} {request.path}: {reason}, {stats.summary()}")
+        else:
+            logger.debug(f"{request.method} {request.path}: {stats.count} запросов, {stats.duration * 1000:.1f} мс")
+        return response
+
+    @app.teardown_request
+    def _reset_query_stats(exc):
+        token = g.pop('query_stats_token', None)
+        if token is not None:
+            try:
+                _current.reset(token)
+            except ValueError:
+                # Контекст уже другой (например, ответ отдается в другом потоке)
+                _current.set(None)
@@ -0,0 +1,245 @@
+"""
+Ограничение частоты сообщений бота (token bucket).
+
+Два уровня: корзина на каждого пользователя (telegram_id) и общая корзина
+на весь бот. Состояние хранится в памяти процесса или, если запущено
+несколько worker'ов бота, корзины пользователей - в таблице bot_rate_limit
+в PostgreSQL. Общая корзина всегда в памяти: каждый worker получает свою
+долю общего лимита, иначе все сообщения бота обновляли бы одну строку
+таблицы и worker'ы ждали бы друг друга на ее блокировке.
+"""
+
+import asyncio
+import logging
+import time
+from collections import OrderedDict, deque
+from typing import Any, Callable, Deque, Dict, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+CREATE_TABLE_SQL = """
+    CREATE TABLE IF NOT EXISTS bot_rate_limit (
+        bucket_key VARCHAR(64) PRIMARY KEY,
+        tokens DOUBLE PRECISION NOT NULL,
+        updated_at TIMESTAMP NOT NULL DEFAULT (now() AT TIME ZONE 'utc')
+    )
+"""
+
+# Пополнение и списание токена одним атомарным запросом.
+# Если токенов не хватает, WHERE отсекает обновление и строка не возвращается.
+TAKE_TOKEN_SQL = """
+    INSERT INTO bot_rate_limit AS b (bucket_key, tokens, updated_at)
+    VALUES ($1, $2 - 1, now() AT TIME ZONE 'utc')
+    ON CONFLICT (bucket_key) DO UPDATE SET
+        tokens = LEAST($2, b.tokens + EXTRACT(EPOCH FROM (now() AT TIME ZONE 'utc' - b.updated_at)) * $3) - 1,
+        updated_at = now() AT TIME ZONE 'utc'
+    WHERE LEAST($2, b.tokens + EXTRACT(EPOCH FROM (now() AT TIME ZONE 'utc' - b.updated_at)) * $3) >= 1
+    RETURNING tokens
+"""
+
+# Корзина, не обновлявшаяся дольше времени полного пополнения, снова полная:
+# ее строку можно удалить, следующий TAKE_TOKEN_SQL создаст ее заново
+PRUNE_SQL = """
+    DELETE FROM bot_rate_limit
+    WHERE updated_at < now() AT TIME ZONE 'utc' - make_interval(secs => $1)
+"""
+
+
+class TokenBucket:
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def take(self) -> bool:
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return True
+        return False
+
+    def refund(self) -> None:
+        self.tokens = min(self.capacity, self.tokens + 1)
+
+
+class RateLimiter:
+    """Лимиты на пользователя и на весь бот, состояние в памяти процесса"""
+
+    def __init__(self, user_rate: float, user_burst: int, global_rate: float, global_burst: int,
+                 max_tracked_users: int = 100000):
+        self.user_rate = user_rate
+        self.user_burst = user_burst
+        self.global_rate = global_rate
+        self.global_burst = global_burst
+        self.max_tracked_users = max_tracked_users
+        self._global = TokenBucket(global_rate, global_burst)
+        self._users: "OrderedDict[int, TokenBucket]" = OrderedDict()
+        self.stats = {"allowed": 0, "limited_user": 0, "limited_global": 0}
+
+    async def acquire(self, telegram_id: int) -> bool:
+        """Списывает токен пользователя и общий токен. False - лимит превышен"""
+        bucket = self._users.get(telegram_id)
+        if bucket is None:
+            bucket = TokenBucket(self.user_rate, self.user_burst)
+            self._users[telegram_id] = bucket
+            # Вытесняем давно неактивных пользователей, их корзины все равно полные
+            if len(self._users) > self.max_tracked_users:
+                self._users.popitem(last=False)
+        else:
+            self._users.move_to_end(telegram_id)
+
+        if not bucket.take():
+            self.stats["limited_user"] += 1
+            return False
+        if not self._global.take():
+            bucket.refund()
+            self.stats["limited_global"] += 1
+            return False
+
+        self.stats["allowed"] += 1
+        return True
+
+    def get_stats(self) -> Dict[str, Any]:
+        stats = dict(self.stats)
+        stats["backend"] = "memory"
+        stats["tracked_users"] = len(self._users)
+        return stats
+
+
+class PostgresRateLimiter(RateLimiter):
+    """Те же лимиты, но корзины пользователей общие для всех worker'ов бота (таблица bot_rate_limit).
+
+    Общая корзина - в памяти процесса, с 1/workers долей скорости и всплеска.
+    Строки давно неактивных пользователей удаляются не чаще раза в
+    prune_interval секунд. При ошибке БД сообщение пропускается (fail open),
+    чтобы сбой лимитера не останавливал бота.
+    """
+
+    def __init__(self, pool, user_rate: float, user_burst: int, global_rate: float, global_burst: int,
+                 workers: int = 1, prune_interval: float = 60.0):
+        workers = max(1, workers)
+        super().__init__(user_rate, user_burst, global_rate / workers, max(1.0, global_burst / workers))
+        self.pool = pool
+        self.workers = workers
+        self.prune_interval = prune_interval
+        # Время, за которое пустая корзина пользователя пополняется полностью
+        self.refill_seconds = user_burst / user_rate if user_rate > 0 else float("inf")
+        self._last_prune = time.monotonic()
+        self.stats["pruned"] = 0
+
+    async def ensure_schema(self) -> None:
+        async with self.pool.acquire() as conn:
+            await conn.execute(CREATE_TABLE_SQL)
+
+    async def acquire(self, telegram_id: int) -> bool:
+        # Общий лимит проверяется первым: при его превышении запрос в БД не нужен
+        if not self._global.take():
+            self.stats["limited_global"] += 1
+            return False
+        user_key = f"user:{telegram_id}"
+        try:
+            async with self.pool.acquire() as conn:
+                if await conn.fetchval(TAKE_TOKEN_SQL, user_key, float(self.user_burst), self.user_rate) is None:
+                    self._global.refund()
+                    self.stats["limited_user"] += 1
+                    return False
+                await self._maybe_prune(conn)
+        except Exception as e:
+            logger.error(f"Ошибка проверки лимита в БД: {e}")
+
+        self.stats["allowed"] += 1
+        return True
+
+    async def _maybe_prune(self, conn) -> None:
+        now = time.monotonic()
+        if now - self._last_prune < self.prune_interval or self.refill_seconds == float("inf"):
+            return
+        self._last_prune = now
+        result = await conn.execute(PRUNE_SQL, self.refill_seconds)
+        # asyncpg возвращает статус команды: 'DELETE <n>'
+        self.stats["pruned"] += int(result.split()[-1])
+
+    def get_stats(self) -> Dict[str, Any]:
+        stats = dict(self.stats)
+        stats["backend"] = "postgres"
+        stats["workers"] = self.workers
+        return stats
+
+
+class DeferredQueue:
+    """Очередь отложенной обработки сообщений, не прошедших лимит.
+
+    Сообщения хранятся по чатам; фоновая задача по кругу обходит чаты и
+    передает первое сообщение чата в dispatch, как только лимитер
+    выдает токен. Размер очереди ограничен max_items.
+    """
+
+    def __init__(self, limiter: RateLimiter, dispatch: Callable, max_items: int = 1000,
+                 retry_interval: float = 1.0):
+        self.limiter = limiter
+        self.dispatch = dispatch
+        self.max_items = max_items
+        self.retry_interval = retry_interval
+        self._chats: "OrderedDict[int, Deque[Tuple]]" = OrderedDict()
+        self._size = 0
+        self._task: Optional[asyncio.Task] = None
+        self.stats = {"deferred": 0, "deferred_sent": 0, "dropped_overflow": 0}
+
+    def start(self) -> None:
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    def put(self, chat_id: int, *args) -> bool:
+        """Откладывает сообщение. False - очередь переполнена"""
+        if self._size >= self.max_items:
+            self.stats["dropped_overflow"] += 1
+            return False
+        self._chats.setdefault(chat_id, deque()).append(args)
+        self._size += 1
+        self.stats["deferred"] += 1
+        return True
+
+    async def _run(self) -> None:
+        while True:
+            await asyncio.sleep(self.retry_interval)
+            for chat_id in list(self._chats):
+                if not await self.limiter.acquire(chat_id):
+                    continue
+                items = self._chats[chat_id]
+                args = items.popleft()
+                self._size -= 1
+                if not items:
+                    del self._chats[chat_id]
+                try:
+                    await self.dispatch(chat_id, *args)
+                    self.stats["deferred_sent"] += 1
+                except Exception as e:
+                    logger.error(f"Ошибка обработки отложенного сообщения пользователя {chat_id}: {e}")
+
+    async def close(self) -> None:
+        """Останавливает фоновую задачу и передает оставшиеся сообщения без учета лимита"""
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+        while self._chats:
+            chat_id, items = self._chats.popitem(last=False)
+            for args in items:
+                self._size -= 1
+                try:
+                    await self.dispatch(chat_id, *args)
+                    self.stats["deferred_sent"] += 1
+                except Exception as e:
+                    logger.error(f"Ошибка обработки отложенного сообщения пользователя {chat_id}: {e}")
+
+    def get_stats(self) -> Dict[str, Any]:
+        stats = dict(self.stats)
+        stats["pending"] = self._size
+        return stats
@@ -0,0 +1,148 @@
+"""
+Чтение CRM с реплики PostgreSQL.
+
+Представления, помеченные @replica_read, только читают данные - их запросы
+выполняются на реплике (DATABASE_REPLICA_URL), все остальное идет в
+основную базу. Чтение возвращается на основную базу, если:
+- реплика отстает больше REPLICA_MAX_LAG_SECONDS или недоступна (отставание
+  проверяется не чаще раза в REPLICA_LAG_CHECK_SECONDS);
+- пользователь CRM только что что-то изменил (POST из его сессии) - чтобы
+  он увидел свое изменение;
+- по клиенту только что пришли данные через API приема (n8n) - закрепление
+  по telegram_id и id клиента.
+Закрепление действует REPLICA_PIN_SECONDS. Закрепления по клиенту хранятся
+в памяти процесса: при нескольких worker'ах gunicorn чтение в другом
+worker'е защищено только проверкой отставания.
+"""
+
+import functools
+import logging
+import threading
+import time
+from typing import Any, Dict, Optional
+
+from flask import Flask, current_app, g, has_request_context, request, session
+from flask_sqlalchemy.session import Session
+from sqlalchemy import create_engine, text
+
+logger = logging.getLogger(__name__)
+
+# На основной базе (pg_is_in_recovery() = false) отставание считается нулевым - удобно для проверки на двух инстансах
+LAG_SQL = """
+    SELECT CASE
+        WHEN NOT pg_is_in_recovery() THEN 0
+        WHEN pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0
+        ELSE COALESCE(EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp()), 0)
+    END
+"""
+
+
+def replica_read(pin_arg: Optional[str] = None):
+    """Помечает представление как только читающее; pin_arg - аргумент маршрута
+    (telegram_id, client_id), по которому чтение закрепляется за основной базой"""
+    def decorator(view):
+        @functools.wraps(view)
+        def wrapper(*args, **kwargs):
+            return view(*args, **kwargs)
+        wrapper.replica_read = pin_arg or ''
+        return wrapper
+    return decorator
+
+
+class RoutingSession(Session):
+    """Сессия Flask-SQLAlchemy: запросы представлений @replica_read идут на реплику"""
+
+    def get_bind(self, mapper=None, clause=None, bind=None, **kwargs):
+        if bind is None and not self._flushing and has_request_context() and g.get('db_replica'):
+            return current_app.extensions['replica_router'].engine
+        return super().get_bind(mapper=mapper, clause=clause, bind=bind, **kwargs)
+
+
+class ReplicaRouter:
+    """Выбор базы для чтения: проверка отставания реплики и закрепления за основной базой"""
+
+    def __init__(self, url: str, max_lag: float = 5.0, check_interval: float = 1.0, pin_seconds: float = 10.0,
+                 engine_options: Optional[Dict[str, Any]] = None):
+        self.engine = create_engine(url, **{'pool_pre_ping': True, **(engine_options or {})})
+        self.max_lag = max_lag
+        self.check_interval = check_interval
+        self.pin_seconds = pin_seconds
+        self._lag: Optional[float] = None
+        self._checked_at = 0.0
+        self._lock = threading.Lock()
+        self._pins: Dict[str, float] = {}
+        self.stats = {
+            "replica_reads": 0,
+            "primary_pinned": 0,
+            "primary_lagging": 0,
+            "lag_check_errors": 0
+        }
+
+    def lag(self) -> Optional[float]:
+        """Отставание реплики в секундах (из кэша); None - реплика недоступна"""
+        now = time.monotonic()
+        if now - self._checked_at < self.check_interval:
+            return self._lag
+        # Проверяет один поток, остальные берут прошлое значение
+        if not self._lock.acquire(blocking=False):
+            return self._lag
+        try:
+            with self.engine.connect() as conn:
+                self._lag = float(conn.execute(text(LAG_SQL)).scalar())
+        except Exception as e:
+            if self._lag is not None:
+                logger.warning(f"Реплика недоступна, чтение идет в основную базу: {e}")
+            self._lag = None
+            self.stats["lag_check_errors"] += 1
+        finally:
+            self._checked_at = time.monotonic()
+            self._lock.release()
+        return self._lag
+
+    def pin(self, name: str, value: Any) -> None:
+        """Чтение по клиенту (name=telegram_id/client_id) идет в основную базу ближайшие pin_seconds"""
+        now = time.monotonic()
+        self._pins[f"{name}:{value}"] = now + self.pin_seconds
+        if len(self._pins) > 10000:
+            self._pins = {key: until for key, until in self._pins.items() if until > now}
+
+    def is_pinned(self, name: str, value: Any) -> bool:
+        return self._pins.get(f"{name}:{value}", 0) > time.monotonic()
+
+    def use_replica(self, pin_arg: str, view_args: Dict[str, Any]) -> bool:
+        if session.get('primary_until', 0) > time.time() or \
+                (pin_arg and self.is_pinned(pin_arg, view_args.get(pin_arg))):
+            self.stats["primary_pinned"] += 1
+            return False
+        lag = self.lag()
+        if lag is None or lag > self.max_lag:
+            self.stats["primary_lagging"] += 1
+            return False
+        self.stats["replica_reads"] += 1
+        return True
+
+    def get_stats(self) -> Dict[str, Any]:
+        stats = dict(self.stats)
+        stats["lag_seconds"] = self._lag if self._lag is not None else -1
+        stats["pins"] = len(self._pins)
+        return stats
+
+    def init_app(self, app: Flask) -> None:
+        app.extensions['replica_router'] = self
+
+        @app.before_request
+        def _choose_database():
+            view = app.view_functions.get(request.endpoint)
+            pin_arg = getattr(view, 'replica_read', None)
+            if pin_arg is not None and request.method in ('GET', 'HEAD'):
+                g.db_replica = self.use_replica(pin_arg, request.view_args or {})
+
+        @app.after_request
+        def _pin_after_write(response):
+            # Пользователь CRM, изменивший данные, читает их из основной базы
+            if request.method not in ('GET', 'HEAD', 'OPTIONS') and response.status_code < 400 \
+                    and '_user_id' in session:
+                session['primary_until'] = time.time() + self.pin_seconds
+            if 'db_replica' in g:
+                response.headers['X-DB-Route'] = 'replica' if g.db_replica else 'primary'
+            return response
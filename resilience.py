@@ -0,0 +1,178 @@
+"""
+Circuit breaker'ы и бюджет задержки для внешних зависимостей бота.
+
+Breaker считает ошибки и медленные вызовы в скользящем окне. Когда доля
+ошибок или медленных вызовов превышает порог, breaker открывается и
+вызовы сразу уходят в fallback, не дожидаясь таймаута. Через
+open_seconds breaker пропускает пробный вызов (half-open) и по его
+результату закрывается или снова открывается.
+
+Бюджет задержки ограничивает суммарное время обработки одного update:
+таймаут каждого внешнего вызова не превышает остаток бюджета.
+"""
+
+import asyncio
+import logging
+import time
+from collections import deque
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Any, Callable, Dict, Optional
+
+logger = logging.getLogger(__name__)
+
+
+class CircuitOpenError(Exception):
+    """Вызов отклонен: breaker зависимости открыт"""
+
+
+class LatencyBudgetExceeded(Exception):
+    """Бюджет задержки обработчика исчерпан"""
+
+
+class CircuitBreaker:
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+    def __init__(self, name: str, failure_rate: float = 0.5, slow_call_seconds: float = 5.0,
+                 slow_call_rate: float = 0.8, window_seconds: float = 60.0, min_calls: int = 5,
+                 open_seconds: float = 30.0, half_open_calls: int = 1,
+                 observer: Optional[Callable[[str, bool, float], None]] = None):
+        self.name = name
+        self.failure_rate = failure_rate
+        self.slow_call_seconds = slow_call_seconds
+        self.slow_call_rate = slow_call_rate
+        self.window_seconds = window_seconds
+        self.min_calls = min_calls
+        self.open_seconds = open_seconds
+        self.half_open_calls = half_open_calls
+        # Вызывается на каждый завершенный вызов: observer(name, success, duration)
+        self.observer = observer
+
+        self.state = self.CLOSED
+        self._calls = deque()  # (время, успех, медленный)
+        self._opened_at = 0.0
+        self._half_open_in_flight = 0
+        self.stats = {"calls": 0, "failures": 0, "slow_calls": 0, "rejected": 0, "opened": 0}
+
+    def allow(self) -> bool:
+        """Можно ли выполнять вызов. При True вызывающий обязан вызвать record()"""
+        if self.state == self.OPEN:
+            if time.monotonic() - self._opened_at < self.open_seconds:
+                self.stats["rejected"] += 1
+                return False
+            self._transition(self.HALF_OPEN)
+
+        if self.state == self.HALF_OPEN:
+            if self._half_open_in_flight >= self.half_open_calls:
+                self.stats["rejected"] += 1
+                return False
+            self._half_open_in_flight += 1
+
+        return True
+
+    def record(self, success: bool, duration: float) -> None:
+        """Учитывает результат вызова, разрешенного allow()"""
+        if self.observer is not None:
+            self.observer(self.name, success, duration)
+        slow = duration >= self.slow_call_seconds
+        self.stats["calls"] += 1
+        self.stats["failures"] += not success
+        self.stats["slow_calls"] += slow
+
+        if self.state == self.HALF_OPEN:
+            self._half_open_in_flight = max(0, self._half_open_in_flight - 1)
+            if success and not slow:
+                self._transition(self.CLOSED)
+            else:
+                self._transition(self.OPEN)
+            return
+
+        if self.state == self.OPEN:
+            # Вызов начался до открытия breaker'а
+            return
+
+        now = time.monotonic()
+        self._calls.append((now, success, slow))
+        self._prune(now)
+
+        total = len(self._calls)
+        if total < self.min_calls:
+            return
+
+        failures = sum(1 for _, ok, _ in self._calls if not ok)
+        slow_calls = sum(1 for _, _, is_slow in self._calls if is_slow)
+        if failures / total >= self.failure_rate or slow_calls / total >= self.slow_call_rate:
+            self._transition(self.OPEN)
+
+    async def call(self, func, *args, timeout: Optional[float] = None, **kwargs) -> Any:
+        """Выполняет корутину func под защитой breaker'а и бюджета задержки"""
+        if timeout is not None:
+            timeout = budget_timeout(timeout)
+        if not self.allow():
+            raise CircuitOpenError(self.name)
+
+        start = time.monotonic()
+        success = False
+        try:
+            result = await asyncio.wait_for(func(*args, **kwargs), timeout)
+            success = True
+            return result
+        finally:
+            self.record(success, time.monotonic() - start)
+
+    def _prune(self, now: float) -> None:
+        while self._calls and now - self._calls[0][0] > self.window_seconds:
+            self._calls.popleft()
+
+    def _transition(self, state: str) -> None:
+        if state == self.state:
+            return
+        logger.warning(f"Circuit breaker {self.name}: {self.state} -> {state}")
+        self.state = state
+        if state == self.OPEN:
+            self._opened_at = time.monotonic()
+            self.stats["opened"] += 1
+        elif state == self.CLOSED:
+            self._calls.clear()
+        self._half_open_in_flight = 0
+
+    def get_state(self) -> Dict[str, Any]:
+        self._prune(time.monotonic())
+        total = len(self._calls)
+        failures = sum(1 for _, ok, _ in self._calls if not ok)
+        state = {
+            "name": self.name,
+            "state": self.state,
+            "window_calls": total,
+            "window_failure_rate": round(failures / total, 3) if total else 0.0
+        }
+        if self.state == self.OPEN:
+            state["retry_in_seconds"] = round(max(0.0, self._opened_at + self.open_seconds - time.monotonic()), 1)
+        state.update(self.stats)
+        return state
+
+
+_deadline: ContextVar[Optional[float]] = ContextVar("handler_deadline", default=None)
+
+
+@contextmanager
+def latency_budget(seconds: float):
+    """Задает общий бюджет задержки для кода внутри блока"""
+    token = _deadline.set(time.monotonic() + seconds)
+    try:
+        yield
+    finally:
+        _deadline.reset(token)
+
+
+def budget_timeout(timeout: float) -> float:
+    """Таймаут вызова с учетом остатка бюджета. Бюджет исчерпан - исключение"""
+    deadline = _deadline.get()
+    if deadline is None:
+        return timeout
+    remaining = deadline - time.monotonic()
+    if remaining <= 0:
+        raise LatencyBudgetExceeded()
+    return min(timeout, remaining)
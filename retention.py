@@ -0,0 +1,223 @@
+#!/usr/bin/env python3
+"""
+Очистка переписки от служебных сообщений бота и удаление давно
+неактивных лидов.
+
+- Служебные сообщения бота (bot_texts.BOILERPLATE_TEXTS: вопрос после
+  серии сообщений и ответы на кнопки) одинаковы у всех клиентов и нужны
+  только в идущем диалоге - старше RETENTION_BOILERPLATE_DAYS они удаляются.
+- Клиенты без новых сообщений и изменений дольше RETENTION_LEAD_DAYS
+  удаляются полностью: сообщения, переписка в архиве (message_partitions.py),
+  время первого ответа. Клиенты со статусами RETENTION_KEEP_STATUSES остаются.
+  Условия удаления перепроверяются после блокировки строки клиента, поэтому
+  клиент, написавший во время очистки, остается. Сообщения, которые бот еще
+  держит в буфере записи (write_buffer.py), после удаления клиента
+  записываются к новому клиенту (upsert пачки создает его заново) - как
+  если бы лид написал уже после очистки.
+
+Строки удаляются пачками по первичному ключу (keyset), каждая пачка - своя
+короткая транзакция, между пачками пауза, чтобы не держать блокировки и не
+создавать всплеск WAL. Агрегаты аналитики (daily_stats) не пересчитываются.
+Освобожденные байты - размер удаленных строк; место в таблице переиспользуется
+после autovacuum.
+
+Запуск:
+    python retention.py --dry-run
+    python retention.py
+    python retention.py --boilerplate-days 14 --lead-days 180 --batch-size 500 --pause-ms 500
+"""
+
+import argparse
+import os
+import time
+from datetime import datetime, timedelta
+
+from sqlalchemy import bindparam, text
+
+from app import app, db
+from bot_texts import BOILERPLATE_TEXTS
+from message_partitions import purge_archived_clients
+
+# Размер строки без PostgreSQL (SQLite при локальной разработке) - по длине текстовых полей
+ROW_SIZE_FALLBACK = {
+    'message': "length(message_text) + coalesce(length(transcript), 0) + coalesce(length(template_params), 0)",
+    'client': "coalesce(length(user_brief), 0) + coalesce(length(project_description), 0)"
+}
+
+
+def _row_size(table: str, alias: str = None) -> str:
+    if db.engine.dialect.name == 'postgresql':
+        return f"pg_column_size({alias or table}.*)"
+    return ROW_SIZE_FALLBACK[table]
+
+
+class Step:
+    """Счетчики одного шага очистки"""
+
+    def __init__(self, name: str):
+        self.name = name
+        self.rows = 0
+        self.bytes = 0
+        self.batches = 0
+
+    def add(self, rows: int, size: int) -> None:
+        self.rows += rows
+        self.bytes += size or 0
+        self.batches += 1
+
+
+def delete_messages(where: str, params: dict, expanding: list, step: Step,
+                    batch_size: int, pause: float, dry_run: bool) -> None:
+    """Удаляет сообщения по условию пачками по id, каждая пачка в своей транзакции"""
+    names = [bindparam(name, expanding=True) for name in expanding]
+    select_batch = text(
+        f"SELECT id, {_row_size('message')} FROM message WHERE id > :last_id AND {where} ORDER BY id LIMIT :limit"
+    ).bindparams(*names)
+    # Условие повторяется в DELETE: по "timestamp" PostgreSQL отсекает лишние секции
+    delete_batch = text(f"DELETE FROM message WHERE id IN :ids AND {where}") \
+        .bindparams(bindparam('ids', expanding=True), *names)
+
+    last_id = 0
+    while True:
+        rows = db.session.execute(select_batch, dict(params, last_id=last_id, limit=batch_size)).fetchall()
+        if not rows:
+            break
+        ids = [row[0] for row in rows]
+        if not dry_run:
+            db.session.execute(delete_batch, dict(params, ids=ids))
+        db.session.commit()
+        step.add(len(rows), sum(row[1] or 0 for row in rows))
+        last_id = ids[-1]
+        if len(rows) < batch_size:
+            break
+        time.sleep(pause)
+
+
+def purge_boilerplate(cutoff: datetime, batch_size: int, pause: float, dry_run: bool) -> Step:
+    step = Step('служебные сообщения бота')
+    delete_messages(
+        'is_from_bot AND "timestamp" < :cutoff AND (message_text IN :texts OR '
+        'template_id IN (SELECT id FROM message_template WHERE text IN :texts))',
+        {'cutoff': cutoff, 'texts': list(BOILERPLATE_TEXTS)}, ['texts'],
+        step, batch_size, pause, dry_run
+    )
+    return step
+
+
+def purge_stale_leads(cutoff: datetime, keep_statuses: list, archive_dir: str,
+                      batch_size: int, pause: float, dry_run: bool):
+    clients = Step('неактивные клиенты')
+    messages = Step('их сообщения')
+    archive = Step('их переписка в архиве')
+
+    keep_filter = "AND COALESCE(c.status, '') NOT IN :keep" if keep_statuses else ''
+    select_clients = text(f"""
+        SELECT c.id FROM client c
+        WHERE c.id > :last_id AND COALESCE(c.updated_at, c.created_at) < :cutoff {keep_filter}
+          AND NOT EXISTS (SELECT 1 FROM message m WHERE m.client_id = c.id AND m."timestamp" >= :cutoff)
+        ORDER BY c.id LIMIT :limit
+    """)
+    if keep_statuses:
+        select_clients = select_clients.bindparams(bindparam('keep', expanding=True))
+    by_ids = bindparam('client_ids', expanding=True)
+    lock = text("SELECT id FROM client WHERE id IN :client_ids ORDER BY id FOR UPDATE").bindparams(by_ids) \
+        if db.engine.dialect.name == 'postgresql' else None
+    # Клиент, написавший во время очистки, не удаляется (его новые сообщения остаются). Условия
+    # проверяются отдельным запросом после блокировки: снимок данных этого запроса уже видит
+    # записи, зафиксированные, пока очистка ждала строку клиента (пачку буфера записи бота
+    # с upsert клиента и сообщениями, прием от n8n)
+    deletable = text(f"""
+        SELECT c.id, {_row_size('client', 'c')} FROM client c
+        WHERE c.id IN :client_ids AND COALESCE(c.updated_at, c.created_at) < :cutoff {keep_filter}
+          AND NOT EXISTS (SELECT 1 FROM message m WHERE m.client_id = c.id)
+    """).bindparams(by_ids)
+    if keep_statuses:
+        deletable = deletable.bindparams(bindparam('keep', expanding=True))
+    archived = text("""
+        SELECT count(*), COALESCE(sum(byte_length), 0) FROM message_archive_segment WHERE client_id IN :client_ids
+    """).bindparams(by_ids)
+
+    last_id = 0
+    while True:
+        params = {'last_id': last_id, 'cutoff': cutoff, 'limit': batch_size, 'keep': keep_statuses}
+        client_ids = [row[0] for row in db.session.execute(select_clients, params)]
+        db.session.commit()
+        if not client_ids:
+            break
+        last_id = client_ids[-1]
+
+        delete_messages('client_id IN :client_ids', {'client_ids': client_ids}, ['client_ids'],
+                        messages, batch_size, pause, dry_run)
+
+        if dry_run:
+            segments, archived_bytes = db.session.execute(archived, {'client_ids': client_ids}).one()
+            clients.add(len(client_ids), db.session.execute(text(
+                f"SELECT sum({_row_size('client')}) FROM client WHERE id IN :client_ids"
+            ).bindparams(by_ids), {'client_ids': client_ids}).scalar())
+            archive.add(segments, archived_bytes)
+            db.session.commit()
+        else:
+            if lock is not None:
+                db.session.execute(lock, {'client_ids': client_ids})
+            rows = db.session.execute(deletable, {'client_ids': client_ids, 'cutoff': cutoff,
+                                                  'keep': keep_statuses}).fetchall()
+            ids = [row[0] for row in rows]
+            replaced = []
+            if ids:
+                params = {'client_ids': ids}
+                segments = db.session.execute(archived, params).one()[0]
+                archived_bytes, replaced = purge_archived_clients(db.session.connection(), archive_dir, ids)
+                archive.add(segments, archived_bytes)
+                db.session.execute(text("DELETE FROM client_first_reply WHERE client_id IN :client_ids")
+                                   .bindparams(by_ids), params)
+                db.session.execute(text("DELETE FROM client WHERE id IN :client_ids").bindparams(by_ids), params)
+                clients.add(len(ids), sum(row[1] or 0 for row in rows))
+            db.session.commit()
+            # Старые файлы архива больше не нужны только после фиксации
+            for path in replaced:
+                os.unlink(path)
+
+        if len(client_ids) < batch_size:
+            break
+        time.sleep(pause)
+    return clients, messages, archive
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Очистка служебных сообщений и неактивных лидов')
+    parser.add_argument('--boilerplate-days', type=int, default=int(os.getenv('RETENTION_BOILERPLATE_DAYS', '30')),
+                        help='Удалять служебные сообщения бота старше стольких дней (0 - не удалять)')
+    parser.add_argument('--lead-days', type=int, default=int(os.getenv('RETENTION_LEAD_DAYS', '365')),
+                        help='Удалять клиентов, неактивных дольше стольких дней (0 - не удалять)')
+    parser.add_argument('--keep-statuses', default=os.getenv('RETENTION_KEEP_STATUSES', 'в работе'),
+                        help='Статусы клиентов, которые не удаляются (через запятую)')
+    parser.add_argument('--batch-size', type=int, default=int(os.getenv('RETENTION_BATCH_SIZE', '1000')))
+    parser.add_argument('--pause-ms', type=float, default=float(os.getenv('RETENTION_PAUSE_MS', '200')),
+                        help='Пауза между пачками')
+    parser.add_argument('--dry-run', action='store_true', help='Только посчитать, ничего не удалять')
+    args = parser.parse_args()
+
+    now = datetime.utcnow()
+    pause = args.pause_ms / 1000
+    keep_statuses = [status.strip() for status in args.keep_statuses.split(',') if status.strip()]
+    steps = []
+    started = time.perf_counter()
+    with app.app_context():
+        if args.boilerplate_days > 0:
+            steps.append(purge_boilerplate(now - timedelta(days=args.boilerplate_days),
+                                           args.batch_size, pause, args.dry_run))
+        if args.lead_days > 0:
+            steps.extend(purge_stale_leads(now - timedelta(days=args.lead_days), keep_statuses,
+                                           app.config['MESSAGE_ARCHIVE_DIR'], args.batch_size, pause, args.dry_run))
+
+    print(f"{'шаг':<28} | {'строк':>8} | {'байт':>12} | {'пачек':>5}")
+    for step in steps:
+        print(f"{step.name:<28} | {step.rows:>8} | {step.bytes:>12} | {step.batches:>5}")
+    total_rows = sum(step.rows for step in steps)
+    total_bytes = sum(step.bytes for step in steps)
+    verb = 'Будет удалено' if args.dry_run else 'Удалено'
+    print(f"{verb}: {total_rows} строк, {total_bytes / 1024 / 1024:.1f} МБ за {time.perf_counter() - started:.1f} с")
+
+
+if __name__ == '__main__':
+    main()
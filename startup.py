@@ -0,0 +1,58 @@
+"""
+Отчет о времени запуска процессов (веб-приложение и бот).
+
+Таймер создается до тяжелых импортов; шаги запуска отмечаются по мере
+выполнения, шаги в фоне (наполнение базы знаний) - отдельно, со своим
+временем начала. Отчет выводится, когда процесс готов обслуживать
+запросы, а длительности шагов отдаются в метрики ({prefix}_startup_*).
+"""
+
+import time
+from contextlib import contextmanager
+from typing import Any, Dict, List, Tuple
+
+
+class StartupTimer:
+    """Длительности шагов запуска процесса"""
+
+    def __init__(self, name: str):
+        self.name = name
+        self.started = time.perf_counter()
+        self._last = self.started
+        self.steps: List[Tuple[str, float]] = []
+        self.ready_seconds = None
+
+    def mark(self, step: str) -> float:
+        """Завершает шаг: его длительность - время с предыдущей отметки"""
+        now = time.perf_counter()
+        duration = now - self._last
+        self._last = now
+        self.steps.append((step, duration))
+        return duration
+
+    @contextmanager
+    def step(self, step: str):
+        """Шаг, который идет параллельно с остальными (в фоне) и не сдвигает отметки"""
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.steps.append((step, time.perf_counter() - started))
+
+    async def run(self, step: str, awaitable):
+        """Ожидание awaitable как фонового шага (для параллельных шагов в asyncio.gather)"""
+        with self.step(step):
+            return await awaitable
+
+    def ready(self) -> str:
+        """Процесс готов: отчет о шагах до этого момента"""
+        self.ready_seconds = time.perf_counter() - self.started
+        lines = [f"Запуск {self.name}: готов за {self.ready_seconds:.2f} с"]
+        lines += [f"  {step:<24} {duration:8.3f} с" for step, duration in self.steps]
+        return "\n".join(lines)
+
+    def get_stats(self) -> Dict[str, Any]:
+        stats = {f"{step}_seconds": duration for step, duration in self.steps}
+        if self.ready_seconds is not None:
+            stats["ready_seconds"] = self.ready_seconds
+        return stats
@@ -369,12 +369,124 @@ function showNewClientModal() {
     showNotification('Функция добавления клиента будет доступна в следующем обновлении', 'info');
 }
 
-function exportClients() {
-    showNotification('Экспорт данных будет доступен в следующем обновлении', 'info');
+// Выгрузка формируется на сервере потоково, браузер просто скачивает файл
+function exportClients(format = 'csv', options = {}) {
+    const params = new URLSearchParams({ format: format });
+    const statusFilter = document.getElementById('statusFilter');
+    const status = options.status !== undefined ? options.status : (statusFilter ? statusFilter.value : '');
+    
+    if (status) params.set('status', status);
+    if (options.dateFrom) params.set('date_from', options.dateFrom);
+    if (options.dateTo) params.set('date_to', options.dateTo);
+    if (options.includeMessages) params.set('include_messages', '1');
+    if (options.gzip) params.set('gzip', '1');
+    
+    window.location.href = `/export/clients?${params}`;
+    showNotification('Выгрузка началась', 'info', 2000);
+}
+
+// Аналитика читается из ежедневных агрегатов, поэтому ответ приходит сразу
+function showAnalytics(days = 30) {
+    fetch(`/api/analytics?days=${days}`)
+        .then(response => {
+            if (!response.ok) throw new Error(`HTTP ${response.status}`);
+            return response.json();
+        })
+        .then(data => renderAnalyticsModal(data))
+        .catch(error => {
+            console.error('Ошибка загрузки аналитики:', error);
+            showNotification('Не удалось загрузить аналитику', 'error');
+        });
+}
+
+function escapeAnalyticsText(value) {
+    const div = document.createElement('div');
+    div.textContent = value === null || value === undefined ? '—' : String(value);
+    return div.innerHTML;
 }
 
-function showAnalytics() {
-    showNotification('Детальная аналитика будет доступна в следующем обновлении', 'info');
+function renderAnalyticsModal(data) {
+    const totals = data.totals;
+    const avgReply = totals.avg_first_reply_seconds === null
+        ? '—'
+        : `${Math.round(totals.avg_first_reply_seconds)} с`;
+    const cards = [
+        ['Новых клиентов', totals.new_clients],
+        ['Входящих сообщений', totals.messages_in],
+        ['Ответов бота', totals.messages_out],
+        ['Доля голосовых', `${(totals.voice_share * 100).toFixed(1)}%`],
+        ['Среднее время до первого ответа', avgReply]
+    ].map(([title, value]) => `
+        <div class="col">
+            <div class="border rounded p-2 h-100">
+                <div class="text-muted small">${title}</div>
+                <div class="fs-5 fw-bold">${escapeAnalyticsText(value)}</div>
+            </div>
+        </div>`).join('');
+
+    const dayRows = data.days.slice().reverse().map(day => `
+        <tr>
+            <td>${escapeAnalyticsText(day.day)}</td>
+            <td>${day.new_clients}</td>
+            <td>${day.messages_in}</td>
+            <td>${day.messages_out}</td>
+            <td>${day.voice_messages}</td>
+        </tr>`).join('') || '<tr><td colspan="5" class="text-muted">Нет данных за период</td></tr>';
+
+    const transitionRows = data.status_transitions.map(item => `
+        <tr>
+            <td>${escapeAnalyticsText(item.from_status)}</td>
+            <td>${escapeAnalyticsText(item.to_status)}</td>
+            <td>${item.count}</td>
+        </tr>`).join('') || '<tr><td colspan="3" class="text-muted">Смен статуса не было</td></tr>';
+
+    let modalElement = document.getElementById('analyticsModal');
+    if (!modalElement) {
+        modalElement = document.createElement('div');
+        modalElement.id = 'analyticsModal';
+        modalElement.className = 'modal fade';
+        modalElement.tabIndex = -1;
+        document.body.appendChild(modalElement);
+    }
+    modalElement.innerHTML = `
+        <div class="modal-dialog modal-lg modal-dialog-scrollable">
+            <div class="modal-content">
+                <div class="modal-header">
+                    <h5 class="modal-title"><i class="fas fa-chart-line me-2"></i>Аналитика: ${escapeAnalyticsText(data.date_from)} — ${escapeAnalyticsText(data.date_to)}</h5>
+                    <button type="button" class="btn-close" data-bs-dismiss="modal"></button>
+                </div>
+                <div class="modal-body">
+                    <div class="row row-cols-2 row-cols-md-5 g-2 mb-4">${cards}</div>
+                    <h6>По дням</h6>
+                    <table class="table table-sm">
+                        <thead><tr><th>День</th><th>Новые</th><th>Входящие</th><th>Ответы</th><th>Голосовые</th></tr></thead>
+                        <tbody>${dayRows}</tbody>
+                    </table>
+                    <h6>Смены статусов</h6>
+                    <table class="table table-sm">
+                        <thead><tr><th>Было</th><th>Стало</th><th>Количество</th></tr></thead>
+                        <tbody>${transitionRows}</tbody>
+                    </table>
+                </div>
+            </div>
+        </div>`;
+    bootstrap.Modal.getOrCreateInstance(modalElement).show();
+}
+
+// Живые обновления: поток SSE /events, при переполнении сервер просит перезагрузить страницу
+function subscribeLiveEvents(handlers, clientId = null) {
+    if (!window.EventSource) return null;
+    const url = clientId ? `/events?client_id=${clientId}` : '/events';
+    const source = new EventSource(url);
+    
+    Object.entries(handlers).forEach(([eventType, handler]) => {
+        source.addEventListener(eventType, event => handler(JSON.parse(event.data)));
+    });
+    source.addEventListener('resync', () => {
+        source.close();
+        window.location.reload();
+    });
+    return source;
 }
 
 function showSettings() {
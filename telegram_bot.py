@@ -1,24 +1,36 @@
+import time
+
+from startup import StartupTimer
+
+# Раньше остальных импортов, чтобы отчет о запуске включал и их время
+startup_timer = StartupTimer('бота')
+
 import os
-import openai
 import logging
+import importlib.util
 from datetime import datetime
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
 from telegram.ext import Application, CommandHandler, MessageHandler, CallbackQueryHandler, filters, ContextTypes
+from telegram.request import HTTPXRequest
 from dotenv import load_dotenv
 import asyncio
-import asyncpg
 from typing import List, Dict, Any
-import aiohttp
 import json
+import functools
+import signal
+import tempfile
 
-# Try to import Qdrant, but don't fail if it's not available
-try:
-    from qdrant_client import QdrantClient
-    from qdrant_client.models import Distance, VectorParams, PointStruct
-    QDRANT_AVAILABLE = True
-except ImportError:
-    QDRANT_AVAILABLE = False
-    logger.warning("Qdrant client недоступен")
+from rate_limiter import RateLimiter, PostgresRateLimiter, DeferredQueue
+from resilience import CircuitBreaker, CircuitOpenError, LatencyBudgetExceeded, latency_budget, budget_timeout
+from voice_pipeline import VoiceJob, VoicePipeline, load_backend
+from write_buffer import MessageWriteBuffer
+from bot_texts import CHOICE_ERROR_REPLY, CHOICE_REPLIES, FOLLOW_UP_QUESTION
+from message_templates import TemplateCache, TemplatedText
+from analytics import DailyDelta, FIRST_REPLY_SQL, daily_stats_upsert_sql, first_message_insert_sql
+from live_events import CHANNEL, NOTIFY_SQL, client_event, encode_event, message_event, transcript_event
+from metrics import InstrumentedPool, StatsCollector, observe_external_call, record_await, start_metrics_server, track_handler
+from profiling import BotProfiler
+from knowledge_sync import load_items, openai_embedder, sync_collection
 
 # Настройка логирования
 logging.basicConfig(
@@ -27,6 +39,12 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+# openai, qdrant_client, aiohttp и asyncpg импортируются при первом использовании (load_openai,
+# create_qdrant_client, send_n8n_webhook, init_db_pool): бот начинает отвечать, не дожидаясь их загрузки
+QDRANT_AVAILABLE = importlib.util.find_spec('qdrant_client') is not None
+if not QDRANT_AVAILABLE:
+    logger.warning("Qdrant client недоступен")
+
 load_dotenv()
 
 # Конфигурация
@@ -36,45 +54,439 @@ QDRANT_URL = os.getenv('QDRANT_URL')
 QDRANT_API_KEY = os.getenv('QDRANT_API_KEY')
 DATABASE_URL = os.getenv('DATABASE_URL')
 N8N_WEBHOOK_URL = os.getenv('N8N_WEBHOOK_URL')
+# Окно склейки серии сообщений одного чата (0 - отключить склейку)
+MESSAGE_DEBOUNCE_SECONDS = float(os.getenv('MESSAGE_DEBOUNCE_SECONDS', '3'))
+# Максимальная длительность одной серии, чтобы непрерывный поток не откладывался бесконечно
+MESSAGE_DEBOUNCE_MAX_SECONDS = float(os.getenv('MESSAGE_DEBOUNCE_MAX_SECONDS', '15'))
+# Пул соединений asyncpg: размер, ожидание соединения, таймауты подключения и запроса (секунды)
+BOT_DB_POOL_MIN_SIZE = int(os.getenv('BOT_DB_POOL_MIN_SIZE', '2'))
+BOT_DB_POOL_MAX_SIZE = int(os.getenv('BOT_DB_POOL_MAX_SIZE', '10'))
+BOT_DB_ACQUIRE_TIMEOUT = float(os.getenv('BOT_DB_ACQUIRE_TIMEOUT', '10'))
+DB_CONNECT_TIMEOUT = float(os.getenv('DB_CONNECT_TIMEOUT', '10'))
+BOT_DB_COMMAND_TIMEOUT = float(os.getenv('BOT_DB_COMMAND_TIMEOUT', '30'))
+# Время жизни соединений: закрытие простаивающих, замена после стольких запросов и всех соединений пула
+# раз в BOT_DB_POOL_RECYCLE_SECONDS (0 - не заменять)
+BOT_DB_MAX_INACTIVE_LIFETIME = float(os.getenv('BOT_DB_MAX_INACTIVE_LIFETIME', '300'))
+BOT_DB_MAX_QUERIES = int(os.getenv('BOT_DB_MAX_QUERIES', '50000'))
+BOT_DB_POOL_RECYCLE_SECONDS = float(os.getenv('BOT_DB_POOL_RECYCLE_SECONDS', '1800'))
+# Работа через PgBouncer в режиме transaction: подготовленные запросы не переживают транзакцию,
+# поэтому кэш запросов asyncpg по умолчанию выключается (PgBouncer 1.21+ с max_prepared_statements - можно включить)
+DB_PGBOUNCER = os.getenv('DB_PGBOUNCER', 'false').lower() == 'true'
+# Кэш подготовленных запросов на соединение: каждый запрос разбирается сервером один раз на соединение
+BOT_DB_STATEMENT_CACHE_SIZE = int(os.getenv('BOT_DB_STATEMENT_CACHE_SIZE', '0' if DB_PGBOUNCER else '100'))
+BOT_DB_STATEMENT_CACHE_LIFETIME = float(os.getenv('BOT_DB_STATEMENT_CACHE_LIFETIME', '0'))
+# Буфер отложенной пакетной записи сообщений в БД
+DB_WRITE_BUFFER_ENABLED = os.getenv('DB_WRITE_BUFFER_ENABLED', 'false').lower() == 'true'
+DB_WRITE_BUFFER_FLUSH_MS = int(os.getenv('DB_WRITE_BUFFER_FLUSH_MS', '200'))
+DB_WRITE_BUFFER_BATCH_ROWS = int(os.getenv('DB_WRITE_BUFFER_BATCH_ROWS', '500'))
+DB_WRITE_BUFFER_MAX_PENDING = int(os.getenv('DB_WRITE_BUFFER_MAX_PENDING', '10000'))
+# База знаний: файл, с которым синхронизируется коллекция Qdrant при запуске, и отслеживание его изменений
+KNOWLEDGE_BASE_FILE = os.getenv('KNOWLEDGE_BASE_FILE', os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                                                     'knowledge_base.json'))
+KNOWLEDGE_BASE_WATCH = os.getenv('KNOWLEDGE_BASE_WATCH', 'false').lower() == 'true'
+KNOWLEDGE_BASE_WATCH_INTERVAL = float(os.getenv('KNOWLEDGE_BASE_WATCH_INTERVAL', '5'))
+# Таймауты внешних вызовов и общий бюджет задержки обработчика (секунды)
+N8N_TIMEOUT_SECONDS = float(os.getenv('N8N_TIMEOUT_SECONDS', '10'))
+QDRANT_TIMEOUT_SECONDS = float(os.getenv('QDRANT_TIMEOUT_SECONDS', '3'))
+OPENAI_TIMEOUT_SECONDS = float(os.getenv('OPENAI_TIMEOUT_SECONDS', '20'))
+HANDLER_LATENCY_BUDGET_SECONDS = float(os.getenv('HANDLER_LATENCY_BUDGET_SECONDS', '15'))
+# Пороги circuit breaker'ов (общие для n8n, Qdrant и OpenAI)
+BREAKER_WINDOW_SECONDS = float(os.getenv('BREAKER_WINDOW_SECONDS', '60'))
+BREAKER_MIN_CALLS = int(os.getenv('BREAKER_MIN_CALLS', '5'))
+BREAKER_FAILURE_RATE = float(os.getenv('BREAKER_FAILURE_RATE', '0.5'))
+BREAKER_SLOW_CALL_RATE = float(os.getenv('BREAKER_SLOW_CALL_RATE', '0.8'))
+BREAKER_OPEN_SECONDS = float(os.getenv('BREAKER_OPEN_SECONDS', '30'))
+# Ограничение частоты сообщений: на пользователя и на весь бот (сообщений в секунду и размер всплеска)
+RATE_LIMIT_ENABLED = os.getenv('RATE_LIMIT_ENABLED', 'true').lower() == 'true'
+RATE_LIMIT_USER_RATE = float(os.getenv('RATE_LIMIT_USER_RATE', '0.5'))
+RATE_LIMIT_USER_BURST = int(os.getenv('RATE_LIMIT_USER_BURST', '10'))
+RATE_LIMIT_GLOBAL_RATE = float(os.getenv('RATE_LIMIT_GLOBAL_RATE', '30'))
+RATE_LIMIT_GLOBAL_BURST = int(os.getenv('RATE_LIMIT_GLOBAL_BURST', '100'))
+# Что делать с сообщением сверх лимита: drop - только сохранить в БД, defer - отложить отправку в n8n
+RATE_LIMIT_POLICY = os.getenv('RATE_LIMIT_POLICY', 'drop')
+RATE_LIMIT_DEFER_MAX = int(os.getenv('RATE_LIMIT_DEFER_MAX', '1000'))
+# memory - состояние в процессе, postgres - общее для нескольких worker'ов бота
+RATE_LIMIT_BACKEND = os.getenv('RATE_LIMIT_BACKEND', 'memory')
+# Для postgres: число worker'ов бота - каждый держит в памяти 1/N общего лимита
+RATE_LIMIT_WORKERS = int(os.getenv('RATE_LIMIT_WORKERS', '1'))
+# Фоновая расшифровка голосовых: openai, stub или путь 'module:Class' (пусто - отключить)
+VOICE_TRANSCRIPTION_BACKEND = os.getenv('VOICE_TRANSCRIPTION_BACKEND', 'openai')
+VOICE_PIPELINE_WORKERS = int(os.getenv('VOICE_PIPELINE_WORKERS', '2'))
+VOICE_PIPELINE_QUEUE = int(os.getenv('VOICE_PIPELINE_QUEUE', '100'))
+VOICE_TMP_DIR = os.getenv('VOICE_TMP_DIR')
+# Сервер метрик Prometheus (/metrics); 0 - не запускать
+BOT_METRICS_PORT = int(os.getenv('BOT_METRICS_PORT', '0'))
+BOT_METRICS_HOST = os.getenv('BOT_METRICS_HOST', '0.0.0.0')
+# Профилирование цикла событий (переключается без перезапуска: kill -USR1 <pid бота>)
+BOT_PROFILING_ENABLED = os.getenv('BOT_PROFILING_ENABLED', 'false').lower() == 'true'
+# Порог блокировки цикла событий и медленного обработчика, мс
+BOT_SLOW_CALLBACK_MS = float(os.getenv('BOT_SLOW_CALLBACK_MS', '100'))
+BOT_PROFILE_DIR = os.getenv('BOT_PROFILE_DIR', os.path.join(tempfile.gettempdir(), 'clienterra_profiles'))
+# Отладочный режим asyncio: предупреждения о медленных callback'ах от самого asyncio (заметно дороже)
+BOT_ASYNCIO_DEBUG = os.getenv('BOT_ASYNCIO_DEBUG', 'false').lower() == 'true'
+
+UPSERT_CLIENT_SQL = """
+    INSERT INTO client (telegram_id, created_at, updated_at) VALUES ($1, $2, $2)
+    ON CONFLICT (telegram_id) DO UPDATE SET updated_at = EXCLUDED.updated_at
+    RETURNING id, (xmax = 0) AS inserted
+"""
+
+# Обновление агрегатов аналитики (asyncpg, позиционные параметры)
+DAILY_STATS_UPSERT_SQL = daily_stats_upsert_sql(numeric=True)
+FIRST_MESSAGE_SQL = first_message_insert_sql(numeric=True)
+
+
+def load_openai():
+    """Модуль openai (импорт занимает сотни миллисекунд, поэтому откладывается до первого вызова)"""
+    import openai
+    if OPENAI_API_KEY and not openai.api_key:
+        openai.api_key = OPENAI_API_KEY
+    return openai
+
+
+def preload_modules() -> None:
+    """Импорт отложенных модулей, которые понадобятся при обработке сообщений"""
+    import aiohttp  # noqa: F401 - webhook n8n и скачивание голосовых
+    if OPENAI_API_KEY:
+        load_openai()
+
+
+def fallback_texts(items: List[dict], limit: int = 3) -> List[str]:
+    """Базовая информация, когда Qdrant или OpenAI недоступны - первые элементы файла базы знаний"""
+    return [item["text"] for item in items[:limit]]
+
+
+def load_fallback_knowledge() -> List[str]:
+    try:
+        return fallback_texts(load_items(KNOWLEDGE_BASE_FILE))
+    except Exception as e:
+        logger.warning(f"Не удалось прочитать {KNOWLEDGE_BASE_FILE}: {e}")
+        return []
+
+
+def create_qdrant_client(url: str, api_key: str = None):
+    """Клиент Qdrant; qdrant_client импортируется здесь - вызывать вне цикла событий (asyncio.to_thread)"""
+    from qdrant_client import QdrantClient
+    if api_key:
+        return QdrantClient(url=url, api_key=api_key)
+    return QdrantClient(url=url)
+
+
+class MessageDebouncer:
+    """Склейка серий сообщений одного чата в одну отправку.
+
+    Каждое сообщение по-прежнему сохраняется в БД сразу, а webhook в n8n
+    и follow-up вопрос отправляются один раз на серию - после паузы
+    длиной window секунд (но не позднее max_window от начала серии).
+    """
+
+    def __init__(self, flush_callback, window: float, max_window: float):
+        self.flush_callback = flush_callback
+        self.window = window
+        self.max_window = max(max_window, window)
+        self._pending: Dict[int, Dict[str, Any]] = {}
+        self.stats = {
+            "messages_received": 0,
+            "bursts_flushed": 0,
+            "messages_collapsed": 0,
+            "max_burst_size": 0
+        }
+
+    async def add(self, chat_id: int, user_info: dict, message_data: dict, context) -> None:
+        """Добавляет сообщение в текущую серию чата и перезапускает таймер"""
+        self.stats["messages_received"] += 1
+
+        if self.window <= 0:
+            await self._flush_burst(chat_id, {"items": [message_data], "user_info": user_info, "context": context})
+            return
+
+        loop = asyncio.get_running_loop()
+        burst = self._pending.get(chat_id)
+        if burst is None:
+            burst = {"items": [], "started": loop.time(), "task": None}
+            self._pending[chat_id] = burst
+
+        burst["items"].append(message_data)
+        burst["user_info"] = user_info
+        burst["context"] = context
+
+        if burst["task"]:
+            burst["task"].cancel()
+        delay = min(self.window, max(0.0, burst["started"] + self.max_window - loop.time()))
+        burst["task"] = asyncio.create_task(self._flush_later(chat_id, delay))
+
+    async def _flush_later(self, chat_id: int, delay: float) -> None:
+        await asyncio.sleep(delay)
+        # После pop новые сообщения начнут новую серию и не отменят текущую отправку
+        burst = self._pending.pop(chat_id, None)
+        if burst:
+            await self._flush_burst(chat_id, burst)
+
+    async def flush(self, chat_id: int) -> None:
+        """Немедленно отправляет накопленную серию чата (если есть)"""
+        burst = self._pending.pop(chat_id, None)
+        if burst:
+            burst["task"].cancel()
+            await self._flush_burst(chat_id, burst)
+
+    async def flush_all(self) -> None:
+        """Отправляет все накопленные серии (используется при остановке бота)"""
+        for chat_id in list(self._pending):
+            await self.flush(chat_id)
+
+    async def _flush_burst(self, chat_id: int, burst: Dict[str, Any]) -> None:
+        items = burst["items"]
+        self.stats["bursts_flushed"] += 1
+        self.stats["messages_collapsed"] += len(items) - 1
+        self.stats["max_burst_size"] = max(self.stats["max_burst_size"], len(items))
+
+        if len(items) > 1:
+            logger.info(f"Склеено {len(items)} сообщений пользователя {chat_id} в одну отправку")
+
+        try:
+            await self.flush_callback(chat_id, burst["user_info"], merge_message_burst(items), burst["context"])
+        except Exception as e:
+            logger.error(f"Ошибка отправки серии сообщений пользователя {chat_id}: {e}")
+
+    def get_stats(self) -> Dict[str, Any]:
+        """Статистика склейки: сколько webhook'ов и follow-up вопросов сэкономлено"""
+        stats = dict(self.stats)
+        stats["pending_chats"] = len(self._pending)
+        # На каждое склеенное сообщение экономится один webhook и один follow-up
+        stats["webhooks_saved"] = stats["messages_collapsed"]
+        stats["follow_ups_saved"] = stats["messages_collapsed"]
+        received = stats["messages_received"]
+        stats["collapse_ratio"] = round(stats["messages_collapsed"] / received, 3) if received else 0.0
+        return stats
+
+
+def merge_message_burst(items: List[dict]) -> dict:
+    """Объединяет серию message_data в один payload для n8n"""
+    if len(items) == 1:
+        return items[0]
+
+    # Идентификаторы и время берем из последнего сообщения серии
+    merged = dict(items[-1])
+    texts = [item["text"] for item in items if item.get("text")]
+    merged["text"] = "\n".join(texts) if texts else None
+    merged["is_first_message"] = any(item.get("is_first_message") for item in items)
+
+    message_types = {item.get("message_type", "text") for item in items}
+    merged["message_type"] = message_types.pop() if len(message_types) == 1 else "mixed"
+
+    # Первое голосовое сообщение серии - в привычные поля, полный состав - в parts
+    merged.pop("audio_file_id", None)
+    merged.pop("audio_duration", None)
+    for item in items:
+        if item.get("audio_file_id"):
+            merged["audio_file_id"] = item["audio_file_id"]
+            merged["audio_duration"] = item.get("audio_duration")
+            break
+
+    merged["burst_size"] = len(items)
+    merged["parts"] = [
+        {
+            "text": item.get("text"),
+            "message_type": item.get("message_type", "text"),
+            "timestamp": item.get("timestamp"),
+            "message_id": item.get("message_id"),
+            "audio_file_id": item.get("audio_file_id"),
+            "audio_duration": item.get("audio_duration")
+        }
+        for item in items
+    ]
+    return merged
+
+
+def make_breaker(name: str, timeout: float) -> CircuitBreaker:
+    """Breaker зависимости: медленным считается вызов дольше половины таймаута"""
+    return CircuitBreaker(
+        name,
+        failure_rate=BREAKER_FAILURE_RATE,
+        slow_call_seconds=timeout / 2,
+        slow_call_rate=BREAKER_SLOW_CALL_RATE,
+        window_seconds=BREAKER_WINDOW_SECONDS,
+        min_calls=BREAKER_MIN_CALLS,
+        open_seconds=BREAKER_OPEN_SECONDS,
+        observer=observe_external_call
+    )
+
+
+class TimedRequest(HTTPXRequest):
+    """Запросы к Telegram Bot API с учетом времени в разбивке обработчика"""
+
+    async def do_request(self, *args, **kwargs):
+        started = time.perf_counter()
+        try:
+            return await super().do_request(*args, **kwargs)
+        finally:
+            record_await('telegram', time.perf_counter() - started)
 
-# Set OpenAI API key
-if OPENAI_API_KEY:
-    openai.api_key = OPENAI_API_KEY
 
 class TelegramBot:
     def __init__(self):
         self.qdrant_client = None
         self.collection_name = "knowledge_base"
         self.db_pool = None
+        self.pool_recycler = None
+        self.write_buffer = None
+        # Приветствие, вопросы и ответы на кнопки пишутся в message ссылкой на шаблон
+        self.templates = TemplateCache()
         self.qdrant_available = False
+        self.breakers = {
+            "n8n": make_breaker("n8n", N8N_TIMEOUT_SECONDS),
+            "qdrant": make_breaker("qdrant", QDRANT_TIMEOUT_SECONDS),
+            "openai": make_breaker("openai", OPENAI_TIMEOUT_SECONDS)
+        }
+        self.debouncer = MessageDebouncer(
+            self.process_message_burst,
+            window=MESSAGE_DEBOUNCE_SECONDS,
+            max_window=MESSAGE_DEBOUNCE_MAX_SECONDS
+        )
+        self.rate_limiter = None
+        self.deferred_queue = None
+        self.shed_stats = {"dropped": 0}
+        if RATE_LIMIT_ENABLED:
+            self.rate_limiter = RateLimiter(
+                RATE_LIMIT_USER_RATE, RATE_LIMIT_USER_BURST,
+                RATE_LIMIT_GLOBAL_RATE, RATE_LIMIT_GLOBAL_BURST
+            )
+            self.deferred_queue = DeferredQueue(self.rate_limiter, self.debouncer.add, max_items=RATE_LIMIT_DEFER_MAX)
+        self.voice_pipeline = self.create_voice_pipeline()
+        self.profiler = BotProfiler(BOT_PROFILE_DIR, stall_seconds=BOT_SLOW_CALLBACK_MS / 1000)
+        # Настройка базы знаний идет в фоне после запуска бота (start_knowledge_base)
+        self.knowledge_task = None
+        self.knowledge_stats = None
+        self.fallback_knowledge = load_fallback_knowledge()
         
-        # Initialize Qdrant if available and configured
-        if QDRANT_AVAILABLE and QDRANT_URL:
-            try:
-                if QDRANT_API_KEY:
-                    self.qdrant_client = QdrantClient(url=QDRANT_URL, api_key=QDRANT_API_KEY)
-                else:
-                    self.qdrant_client = QdrantClient(url=QDRANT_URL)
-                logger.info("Qdrant client инициализирован")
-            except Exception as e:
-                logger.warning(f"Не удалось инициализировать Qdrant: {e}")
+    def create_voice_pipeline(self):
+        """Создает очередь расшифровки голосовых сообщений, если она настроена"""
+        backend_name = VOICE_TRANSCRIPTION_BACKEND
+        if not backend_name:
+            return None
+        if backend_name == 'openai' and not OPENAI_API_KEY:
+            logger.warning("OPENAI_API_KEY не задан, расшифровка голосовых сообщений отключена")
+            return None
         
-    async def init_db_pool(self):
-        """Инициализация пула подключений к базе данных"""
+        try:
+            backend = load_backend(backend_name, breaker=self.breakers["openai"])
+        except Exception as e:
+            logger.error(f"Не удалось загрузить backend расшифровки {backend_name}: {e}")
+            return None
+        
+        return VoicePipeline(
+            backend,
+            self.save_transcript_to_db,
+            workers=VOICE_PIPELINE_WORKERS,
+            max_queue=VOICE_PIPELINE_QUEUE,
+            tmp_dir=VOICE_TMP_DIR
+        )
+    
+    async def init_db_pool(self, **pool_options):
+        """Инициализация пула подключений к базе данных (pool_options дополняют параметры asyncpg.create_pool)"""
         if DATABASE_URL:
             try:
-                self.db_pool = await asyncpg.create_pool(DATABASE_URL)
-                logger.info("Подключение к базе данных установлено")
+                import asyncpg
+                options = dict(
+                    min_size=BOT_DB_POOL_MIN_SIZE,
+                    max_size=BOT_DB_POOL_MAX_SIZE,
+                    timeout=DB_CONNECT_TIMEOUT,
+                    command_timeout=BOT_DB_COMMAND_TIMEOUT,
+                    max_queries=BOT_DB_MAX_QUERIES,
+                    max_inactive_connection_lifetime=BOT_DB_MAX_INACTIVE_LIFETIME,
+                    statement_cache_size=BOT_DB_STATEMENT_CACHE_SIZE,
+                    max_cached_statement_lifetime=BOT_DB_STATEMENT_CACHE_LIFETIME
+                )
+                options.update(pool_options)
+                # Обертка учитывает в метриках ожидание соединения из пула и его исчерпание
+                self.db_pool = InstrumentedPool(await asyncpg.create_pool(DATABASE_URL, **options),
+                                                acquire_timeout=BOT_DB_ACQUIRE_TIMEOUT)
+                logger.info(f"Подключение к базе данных установлено (пул {options['min_size']}-{options['max_size']})")
             except Exception as e:
                 logger.error(f"Ошибка подключения к БД: {e}")
         
+        if self.db_pool and BOT_DB_POOL_RECYCLE_SECONDS > 0:
+            self.pool_recycler = asyncio.create_task(self.recycle_db_pool(BOT_DB_POOL_RECYCLE_SECONDS))
+        
+        if self.db_pool and DB_WRITE_BUFFER_ENABLED:
+            self.write_buffer = MessageWriteBuffer(
+                self.db_pool,
+                flush_interval=DB_WRITE_BUFFER_FLUSH_MS / 1000,
+                max_batch_rows=DB_WRITE_BUFFER_BATCH_ROWS,
+                max_pending_rows=DB_WRITE_BUFFER_MAX_PENDING,
+                on_batch=self.record_batch,
+                templates=self.templates
+            )
+            self.write_buffer.start()
+            logger.info("Включен буфер пакетной записи сообщений")
+        
+        if self.db_pool and self.rate_limiter and RATE_LIMIT_BACKEND == 'postgres':
+            limiter = PostgresRateLimiter(
+                self.db_pool,
+                RATE_LIMIT_USER_RATE, RATE_LIMIT_USER_BURST,
+                RATE_LIMIT_GLOBAL_RATE, RATE_LIMIT_GLOBAL_BURST,
+                workers=RATE_LIMIT_WORKERS
+            )
+            try:
+                await limiter.ensure_schema()
+                self.rate_limiter = self.deferred_queue.limiter = limiter
+                logger.info("Лимиты сообщений хранятся в PostgreSQL")
+            except Exception as e:
+                logger.error(f"Не удалось создать таблицу лимитов, используем лимиты в памяти: {e}")
+    
+    async def recycle_db_pool(self, interval: float) -> None:
+        """Соединения пула заменяются новыми раз в interval секунд (занятые - после возврата в пул):
+        долгоживущие соединения не копят память на сервере и переподключаются после переключения БД"""
+        while True:
+            await asyncio.sleep(interval)
+            await self.db_pool.expire_connections()
+    
+    async def close_db_pool(self):
+        """Сброс буфера записи и закрытие пула подключений"""
+        if self.pool_recycler:
+            self.pool_recycler.cancel()
+            self.pool_recycler = None
+        if self.write_buffer:
+            await self.write_buffer.close()
+            self.write_buffer = None
+        if self.db_pool:
+            await self.db_pool.close()
+        
+    def start_knowledge_base(self) -> None:
+        """Запускает настройку базы знаний в фоне: пока она не готова, поиск возвращает базовую информацию"""
+        self.knowledge_task = asyncio.create_task(self.setup_knowledge_base())
+    
+    async def setup_knowledge_base(self):
+        with startup_timer.step('knowledge_base'):
+            # Модули первых ответов загружаются в отдельном потоке, а не в цикле событий на первом сообщении
+            await asyncio.to_thread(preload_modules)
+            await self.setup_qdrant_collection()
+        logger.info(f"База знаний готова (Qdrant {'доступен' if self.qdrant_available else 'недоступен'})")
+        if KNOWLEDGE_BASE_WATCH and self.qdrant_available:
+            await self.watch_knowledge_base(KNOWLEDGE_BASE_WATCH_INTERVAL)
+    
+    async def stop_knowledge_base(self) -> None:
+        if self.knowledge_task and not self.knowledge_task.done():
+            self.knowledge_task.cancel()
+            try:
+                await self.knowledge_task
+            except asyncio.CancelledError:
+                pass
+    
     async def setup_qdrant_collection(self):
         """Настройка коллекции в Qdrant"""
+        if not self.qdrant_client and QDRANT_AVAILABLE and QDRANT_URL:
+            try:
+                self.qdrant_client = await asyncio.to_thread(create_qdrant_client, QDRANT_URL, QDRANT_API_KEY)
+                logger.info("Qdrant client инициализирован")
+            except Exception as e:
+                logger.warning(f"Не удалось инициализировать Qdrant: {e}")
         if not self.qdrant_client:
             logger.warning("Qdrant недоступен")
             return
             
         try:
+            from qdrant_client.models import Distance, VectorParams
             collections = await asyncio.to_thread(self.qdrant_client.get_collections)
             collection_names = [col.name for col in collections.collections]
             
@@ -85,10 +497,10 @@ class TelegramBot:
                     vectors_config=VectorParams(size=1536, distance=Distance.COSINE)
                 )
                 logger.info(f"Создана коллекция {self.collection_name}")
-                await self.populate_knowledge_base()
             else:
                 logger.info(f"Коллекция {self.collection_name} уже существует")
-                
+            
+            await self.sync_knowledge_base()
             self.qdrant_available = True
                 
         except Exception as e:
@@ -96,82 +508,39 @@ class TelegramBot:
             logger.warning("Бот будет работать без базы знаний Qdrant")
             self.qdrant_available = False
     
-    async def populate_knowledge_base(self):
-        """Заполнение базы знаний информацией об услугах"""
-        if not OPENAI_API_KEY or not self.qdrant_client:
-            return
-            
-        knowledge_items = [
-            {
-                "id": 1,
-                "text": "Мы создаем Telegram-ботов для автоматизации бизнес-процессов: прием заказов, консультации клиентов, запись на услуги, уведомления о статусе заказов.",
-                "category": "automation"
-            },
-            {
-                "id": 2,
-                "text": "Интеграция с CRM системами, базами данных, платежными системами (Stripe, ЮKassa), API сторонних сервисов для полной автоматизации бизнеса.",
-                "category": "integrations"
-            },
-            {
-                "id": 3,
-                "text": "Боты для интернет-магазинов: каталог товаров, корзина, оформление заказов, отслеживание доставки, система лояльности и скидок.",
-                "category": "ecommerce"
-            },
-            {
-                "id": 4,
-                "text": "Обучающие боты и боты-помощники: курсы, тесты, напоминания, персональные рекомендации, чат-боты с ИИ для консультаций.",
-                "category": "education"
-            },
-            {
-                "id": 5,
-                "text": "Боты для управления сообществами: модерация, автоответы, опросы, розыгрыши, система ролей и прав доступа.",
-                "category": "community"
-            },
-            {
-                "id": 6,
-                "text": "Аналитика и отчетность: сбор статистики использования бота, анализ поведения пользователей, A/B тестирование функций.",
-                "category": "analytics"
-            }
-        ]
-        
-        for item in knowledge_items:
+    async def sync_knowledge_base(self) -> None:
+        """Синхронизация коллекции с KNOWLEDGE_BASE_FILE: эмбеддинги только для новых и измененных элементов"""
+        try:
+            items = await asyncio.to_thread(load_items, KNOWLEDGE_BASE_FILE)
+            embed = openai_embedder(await asyncio.to_thread(load_openai)) if OPENAI_API_KEY else None
+            report = await asyncio.to_thread(sync_collection, self.qdrant_client, self.collection_name, items, embed)
+            self.knowledge_stats = report.as_dict()
+            self.fallback_knowledge = fallback_texts(items)
+            logger.info(f"База знаний синхронизирована с {KNOWLEDGE_BASE_FILE}: {self.knowledge_stats}")
+        except Exception as e:
+            logger.error(f"Ошибка синхронизации базы знаний: {e}")
+    
+    async def watch_knowledge_base(self, interval: float) -> None:
+        """Синхронизация при изменении файла базы знаний (проверка времени изменения раз в interval секунд)"""
+        def modified_at():
             try:
-                # Получаем эмбеддинг от OpenAI (старый API)
-                response = await asyncio.to_thread(
-                    openai.Embedding.create,
-                    input=item["text"],
-                    model="text-embedding-ada-002"
-                )
-                embedding = response['data'][0]['embedding']
-                
-                # Добавляем в Qdrant
-                await asyncio.to_thread(
-                    self.qdrant_client.upsert,
-                    collection_name=self.collection_name,
-                    points=[
-                        PointStruct(
-                            id=item["id"],
-                            vector=embedding,
-                            payload={
-                                "text": item["text"],
-                                "category": item["category"]
-                            }
-                        )
-                    ]
-                )
-                logger.info(f"Добавлен элемент знаний: {item['category']}")
-                
-            except Exception as e:
-                logger.error(f"Ошибка добавления знаний: {e}")
+                return os.stat(KNOWLEDGE_BASE_FILE).st_mtime_ns
+            except OSError:
+                return None
+        
+        last_modified = modified_at()
+        logger.info(f"Отслеживаются изменения {KNOWLEDGE_BASE_FILE}")
+        while True:
+            await asyncio.sleep(interval)
+            current = modified_at()
+            if current is not None and current != last_modified:
+                last_modified = current
+                await self.sync_knowledge_base()
     
     async def search_knowledge(self, query: str, limit: int = 3) -> List[str]:
         """Поиск релевантной информации в базе знаний"""
         # Fallback knowledge base
-        fallback_knowledge = [
-            "Мы создаем Telegram-ботов для автоматизации бизнес-процессов: прием заказов, консультации клиентов, запись на услуги, уведомления о статусе заказов.",
-            "Интеграция с CRM системами, базами данных, платежными системами (Stripe, ЮKassa), API сторонних сервисов для полной автоматизации бизнеса.",
-            "Боты для интернет-магазинов: каталог товаров, корзина, оформление заказов, отслеживание доставки, система лояльности и скидок."
-        ]
+        fallback_knowledge = self.fallback_knowledge
         
         if not self.qdrant_available or not OPENAI_API_KEY:
             logger.warning("Qdrant или OpenAI недоступен, возвращаем базовую информацию")
@@ -179,23 +548,33 @@ class TelegramBot:
         
         try:
             # Получаем эмбеддинг запроса (старый API)
-            response = await asyncio.to_thread(
-                openai.Embedding.create,
+            response = await self.breakers["openai"].call(
+                asyncio.to_thread,
+                load_openai().Embedding.create,
                 input=query,
-                model="text-embedding-ada-002"
+                model="text-embedding-ada-002",
+                timeout=OPENAI_TIMEOUT_SECONDS
             )
             query_embedding = response['data'][0]['embedding']
             
             # Поиск в Qdrant
-            search_result = await asyncio.to_thread(
+            search_result = await self.breakers["qdrant"].call(
+                asyncio.to_thread,
                 self.qdrant_client.search,
                 collection_name=self.collection_name,
                 query_vector=query_embedding,
-                limit=limit
+                limit=limit,
+                timeout=QDRANT_TIMEOUT_SECONDS
             )
             
             return [hit.payload["text"] for hit in search_result]
             
+        except CircuitOpenError as e:
+            logger.warning(f"Circuit breaker {e} открыт, возвращаем базовую информацию")
+            return fallback_knowledge
+        except LatencyBudgetExceeded:
+            logger.warning("Бюджет задержки исчерпан, возвращаем базовую информацию")
+            return fallback_knowledge
         except Exception as e:
             logger.error(f"Ошибка поиска в базе знаний: {e}")
             return fallback_knowledge
@@ -226,57 +605,133 @@ class TelegramBot:
             ]
             
             # Используем старый API OpenAI
-            response = await asyncio.to_thread(
-                openai.ChatCompletion.create,
+            response = await self.breakers["openai"].call(
+                asyncio.to_thread,
+                load_openai().ChatCompletion.create,
                 model="gpt-4",
                 messages=messages,
                 max_tokens=500,
-                temperature=0.7
+                temperature=0.7,
+                timeout=OPENAI_TIMEOUT_SECONDS
             )
             
             return response.choices[0].message.content
             
+        except (CircuitOpenError, LatencyBudgetExceeded) as e:
+            logger.warning(f"OpenAI пропущен ({type(e).__name__}), возвращаем резервный ответ")
+            return "Извините, сервис временно недоступен. Пожалуйста, свяжитесь с нашим менеджером напрямую."
         except Exception as e:
             logger.error(f"Ошибка OpenAI: {e}")
             return "Извините, произошла ошибка. Попробуйте еще раз или свяжитесь с нашим менеджером."
     
-    async def save_message_to_db(self, telegram_id: int, message_text: str, is_from_bot: bool = False):
-        """Сохранение сообщения в базу данных"""
+    async def save_message_to_db(self, telegram_id: int, message_text: str, is_from_bot: bool = False,
+                                 buffered: bool = True, is_voice: bool = False):
+        """Сохранение сообщения в базу данных.
+        
+        Возвращает id сообщения, если запись выполнена сразу (buffered=False
+        или буфер записи выключен), иначе None.
+        """
         if not self.db_pool:
             logger.warning("База данных недоступна")
-            return
+            return None
+        
+        # При включенном буфере запись идет пачками в фоне
+        if buffered and self.write_buffer and await self.write_buffer.put(telegram_id, message_text, is_from_bot, is_voice):
+            return None
             
         try:
             async with self.db_pool.acquire() as conn:
-                # Проверяем, существует ли клиент
-                client = await conn.fetchrow(
-                    "SELECT id FROM client WHERE telegram_id = $1", telegram_id
-                )
-                
-                if not client:
-                    # Создаем нового клиента
-                    client_id = await conn.fetchval(
-                        """INSERT INTO client (telegram_id, created_at, updated_at) 
-                           VALUES ($1, $2, $2) RETURNING id""",
-                        telegram_id, datetime.utcnow()
-                    )
-                else:
+                stored_text, template_id, template_params = await self.templates.row_values(conn, message_text)
+                async with conn.transaction():
+                    now = datetime.utcnow()
+                    # Создаем клиента или обновляем время последней активности одним запросом:
+                    # параллельная запись того же пользователя (n8n, другой worker) не падает на unique
+                    client = await conn.fetchrow(UPSERT_CLIENT_SQL, telegram_id, now)
                     client_id = client['id']
-                    # Обновляем время последней активности
-                    await conn.execute(
-                        "UPDATE client SET updated_at = $1 WHERE id = $2",
-                        datetime.utcnow(), client_id
+                    created = client['inserted']
+                    
+                    # Сохраняем сообщение
+                    message_id = await conn.fetchval(
+                        """INSERT INTO message (client_id, message_text, is_from_bot, timestamp, template_id, template_params)
+                           VALUES ($1, $2, $3, $4, $5, $6) RETURNING id""",
+                        client_id, stored_text, is_from_bot, now, template_id, template_params
                     )
-                
-                # Сохраняем сообщение
-                await conn.execute(
-                    """INSERT INTO message (client_id, message_text, is_from_bot, timestamp)
-                       VALUES ($1, $2, $3, $4)""",
-                    client_id, message_text, is_from_bot, datetime.utcnow()
-                )
+                    
+                    delta = DailyDelta()
+                    delta.add_message(now, is_from_bot, is_voice)
+                    if created:
+                        delta.add(now, new_clients=1)
+                    await self.record_daily_stats(conn, delta, [(client_id, now, is_from_bot)])
+                    
+                    events = [('message', message_event(client_id, message_id, message_text, is_from_bot, now))]
+                    if created:
+                        events.insert(0, ('client', client_event(client_id, telegram_id, None, None, None, now, now,
+                                                                 created=True)))
+                    await self.publish_events(conn, events)
+                    return message_id
                 
         except Exception as e:
             logger.error(f"Ошибка сохранения в БД: {e}")
+            return None
+    
+    @staticmethod
+    async def record_daily_stats(conn, delta: DailyDelta, messages) -> None:
+        """Обновляет агрегаты аналитики в текущей транзакции.
+        
+        messages - (client_id, timestamp, is_from_bot) в порядке записи. Ошибка
+        (например, таблицы аналитики еще не созданы) откатывает только точку
+        сохранения, само сообщение остается записанным.
+        """
+        try:
+            async with conn.transaction():
+                await conn.executemany(DAILY_STATS_UPSERT_SQL, delta.as_tuples())
+                for client_id, timestamp, is_from_bot in messages:
+                    if is_from_bot:
+                        await conn.execute(FIRST_REPLY_SQL, client_id, timestamp)
+                    else:
+                        await conn.execute(FIRST_MESSAGE_SQL, client_id, timestamp)
+        except Exception as e:
+            logger.error(f"Ошибка обновления агрегатов аналитики: {e}")
+    
+    @staticmethod
+    async def publish_events(conn, events) -> None:
+        """NOTIFY для живых обновлений CRM: уходят при commit текущей транзакции"""
+        try:
+            async with conn.transaction():
+                await conn.executemany(NOTIFY_SQL, [(CHANNEL, encode_event(*event)) for event in events])
+        except Exception as e:
+            logger.error(f"Ошибка отправки событий CRM: {e}")
+    
+    async def record_batch(self, conn, batch, clients) -> None:
+        """Агрегаты аналитики и события CRM для пачки буфера записи"""
+        delta, messages = MessageWriteBuffer.batch_stats(batch, clients)
+        await self.record_daily_stats(conn, delta, messages)
+        
+        client_ids = {row['telegram_id']: row['id'] for row in clients}
+        events = []
+        new_clients = {row['telegram_id'] for row in clients if row['inserted']}
+        for _, telegram_id, message_text, is_from_bot, timestamp, _ in batch:
+            if telegram_id in new_clients:
+                new_clients.discard(telegram_id)
+                events.append(('client', client_event(client_ids[telegram_id], telegram_id, None, None, None,
+                                                      timestamp, timestamp, created=True)))
+            events.append(('message', message_event(client_ids[telegram_id], None, message_text, is_from_bot,
+                                                    timestamp)))
+        await self.publish_events(conn, events)
+    
+    async def save_transcript_to_db(self, job: VoiceJob, transcript: str) -> None:
+        """Записывает расшифровку голосового сообщения в его строку message"""
+        async with self.db_pool.acquire() as conn:
+            async with conn.transaction():
+                # updated_at клиента меняет версию кэшированной ленты сообщений в CRM
+                client_id = await conn.fetchval(
+                    """WITH m AS (UPDATE message SET transcript = $1 WHERE id = $2 RETURNING client_id)
+                       UPDATE client SET updated_at = $3 FROM m WHERE client.id = m.client_id RETURNING client.id""",
+                    transcript, job.message_id, datetime.utcnow()
+                )
+                if client_id:
+                    await self.publish_events(conn, [('transcript', transcript_event(client_id, job.message_id, transcript))])
+        logger.info(f"Сохранена расшифровка голосового сообщения {job.message_id} пользователя {job.telegram_id}")
     
     async def get_welcome_message(self, user_info: dict = None) -> str:
         """Получение приветственного сообщения из настроек"""
@@ -294,23 +749,13 @@ class TelegramBot:
                 logger.error(f"Ошибка получения настроек: {e}")
                 message = "Привет! Я помогу вам создать идеального Telegram-бота для вашего бизнеса. Расскажите, что вас интересует?"
         
-        # Заменяем плейсхолдеры на реальные данные пользователя
-        if user_info:
-            if user_info.get('first_name'):
-                message = message.replace('{name}', user_info['first_name'])
-            else:
-                message = message.replace('{name}', 'пользователь')
-                
-            if user_info.get('username'):
-                message = message.replace('{username}', f"@{user_info['username']}")
-            else:
-                message = message.replace('{username}', 'пользователь')
-        else:
-            # Если нет информации о пользователе, заменяем на общие значения
-            message = message.replace('{name}', 'пользователь')
-            message = message.replace('{username}', 'пользователь')
-        
-        return message
+        # Плейсхолдеры заменяются данными пользователя, в БД сохраняются шаблон и эти значения
+        user_info = user_info or {}
+        params = {
+            'name': user_info.get('first_name') or 'пользователь',
+            'username': f"@{user_info['username']}" if user_info.get('username') else 'пользователь'
+        }
+        return TemplatedText(message, {key: value for key, value in params.items() if '{' + key + '}' in message})
 
     async def send_welcome_if_new_user(self, update: Update) -> bool:
         """Отправляет приветствие если пользователь новый"""
@@ -348,7 +793,21 @@ class TelegramBot:
         if not N8N_WEBHOOK_URL:
             logger.warning("N8N_WEBHOOK_URL не настроен")
             return False
-            
+        
+        breaker = self.breakers["n8n"]
+        try:
+            timeout = budget_timeout(N8N_TIMEOUT_SECONDS)
+        except LatencyBudgetExceeded:
+            logger.warning("Бюджет задержки исчерпан, webhook на n8n не отправлен")
+            return False
+        
+        # Пока n8n недоступен, не ждем таймаута на каждом сообщении
+        if not breaker.allow():
+            logger.warning("Circuit breaker n8n открыт, webhook не отправлен")
+            return False
+        
+        started = time.monotonic()
+        success = False
         try:
             # Подготавливаем данные для отправки
             webhook_data = {
@@ -376,20 +835,27 @@ class TelegramBot:
                 webhook_data["message"]["audio_file_id"] = message_data["audio_file_id"]
                 webhook_data["message"]["audio_duration"] = message_data.get("audio_duration")
             
+            # Если это склеенная серия сообщений, передаем ее состав
+            if message_data.get("parts"):
+                webhook_data["message"]["burst_size"] = message_data["burst_size"]
+                webhook_data["message"]["parts"] = message_data["parts"]
+            
             logger.info(f"Отправляем данные: {json.dumps(webhook_data, ensure_ascii=False, indent=2)}")
             
+            import aiohttp
             async with aiohttp.ClientSession() as session:
                 async with session.post(
                     N8N_WEBHOOK_URL,
                     json=webhook_data,
                     headers={"Content-Type": "application/json"},
-                    timeout=aiohttp.ClientTimeout(total=30)
+                    timeout=aiohttp.ClientTimeout(total=timeout)
                 ) as response:
                     response_text = await response.text()
                     logger.info(f"Ответ от n8n: статус {response.status}, тело: {response_text}")
                     
                     if response.status == 200:
                         logger.info(f"Webhook успешно отправлен на n8n для пользователя {user_info.get('telegram_id')}")
+                        success = True
                         return True
                     elif response.status == 500:
                         logger.error(f"N8N workflow не может быть запущен (500). Проверьте что workflow активен и настроен правильно. Ответ: {response_text}")
@@ -410,11 +876,35 @@ class TelegramBot:
         except Exception as e:
             logger.error(f"Ошибка отправки webhook на n8n: {e}")
             return False
+        finally:
+            breaker.record(success, time.monotonic() - started)
+    
+    def get_breaker_states(self) -> Dict[str, Dict[str, Any]]:
+        """Текущее состояние circuit breaker'ов внешних зависимостей"""
+        return {name: breaker.get_state() for name, breaker in self.breakers.items()}
+    
+    def create_stats_collector(self) -> StatsCollector:
+        """Счетчики компонентов бота для сервера метрик (читаются в момент опроса)"""
+        collector = StatsCollector('bot')
+        collector.add('debouncer', self.debouncer.get_stats)
+        collector.add('breaker', self.get_breaker_states, label='name')
+        collector.add('rate_limit', self.get_rate_limit_stats)
+        collector.add('write_buffer', lambda: self.write_buffer.get_stats() if self.write_buffer else None)
+        collector.add('voice', lambda: self.voice_pipeline.get_stats() if self.voice_pipeline else None)
+        collector.add('db_pool', lambda: self.db_pool.get_stats() if self.db_pool else None)
+        collector.add('profiler', self.profiler.get_stats)
+        collector.add('startup', startup_timer.get_stats)
+        collector.add('knowledge_sync', lambda: self.knowledge_stats)
+        return collector
 
     async def is_new_user(self, user_id: int) -> bool:
         """Проверяет, является ли пользователь новым (нет записей в БД)"""
         if not self.db_pool:
             return True
+        
+        # Клиент будет создан при сбросе буфера
+        if self.write_buffer and self.write_buffer.has_pending(user_id):
+            return False
             
         try:
             async with self.db_pool.acquire() as conn:
@@ -433,6 +923,10 @@ class TelegramBot:
         """Проверяет, является ли это первым сообщением пользователя после приветствия"""
         if not self.db_pool:
             return False
+        
+        # Проверка читает историю из БД, поэтому дожидаемся записи буфера
+        if self.write_buffer:
+            await self.write_buffer.sync(user_id)
             
         try:
             async with self.db_pool.acquire() as conn:
@@ -490,7 +984,7 @@ class TelegramBot:
         ]
         reply_markup = InlineKeyboardMarkup(keyboard)
         
-        message_text = "🤔 Есть ли у вас что-то еще рассказать, или можно формировать итоговое предложение?"
+        message_text = TemplatedText(FOLLOW_UP_QUESTION)
         
         await context.bot.send_message(
             chat_id=chat_id,
@@ -501,14 +995,52 @@ class TelegramBot:
         # Сохраняем сообщение бота в БД
         await self.save_message_to_db(chat_id, message_text, is_from_bot=True)
 
+    async def allow_fan_out(self, user_id: int) -> bool:
+        """Проверяет лимиты частоты сообщений пользователя и всего бота"""
+        if not self.rate_limiter:
+            return True
+        return await self.rate_limiter.acquire(user_id)
+    
+    def shed_fan_out(self, user_id: int, user_info: dict, message_data: dict,
+                     context: ContextTypes.DEFAULT_TYPE) -> None:
+        """Сообщение сверх лимита: сохранено в БД, отправка в n8n откладывается или пропускается"""
+        if RATE_LIMIT_POLICY == 'defer' and self.deferred_queue.put(user_id, user_info, message_data, context):
+            logger.info(f"Лимит сообщений превышен, отправка в n8n для пользователя {user_id} отложена")
+            return
+        self.shed_stats["dropped"] += 1
+        logger.info(f"Лимит сообщений превышен, отправка в n8n для пользователя {user_id} пропущена")
+    
+    def get_rate_limit_stats(self) -> Dict[str, Any]:
+        """Счетчики лимитера: пропущенные и отложенные сообщения"""
+        if not self.rate_limiter:
+            return {}
+        stats = self.rate_limiter.get_stats()
+        stats.update(self.shed_stats)
+        stats.update(self.deferred_queue.get_stats())
+        return stats
+    
+    async def process_message_burst(self, chat_id: int, user_info: dict, message_data: dict,
+                                    context: ContextTypes.DEFAULT_TYPE) -> None:
+        """Отправляет серию сообщений в n8n и задает один follow-up вопрос"""
+        # Серия отправляется из фоновой задачи, поэтому у нее свой бюджет задержки
+        with track_handler('message_burst'), self.profiler.handler_breakdown('message_burst'), \
+                latency_budget(HANDLER_LATENCY_BUDGET_SECONDS):
+            webhook_sent = await self.send_n8n_webhook(user_info, message_data)
+        
+        if webhook_sent:
+            logger.info(f"Сообщения пользователя {chat_id} отправлены в n8n")
+        else:
+            logger.warning(f"Не удалось отправить сообщения пользователя {chat_id} в n8n")
+        
+        # Отправляем follow-up вопрос с inline кнопками
+        await self.send_follow_up_question(chat_id, context)
+
     async def handle_user_choice(self, user_id: int, choice: str, context: ContextTypes.DEFAULT_TYPE) -> None:
         """Обрабатывает выбор пользователя"""
-        if choice == "more_info":
-            message_text = "👍 Отлично! Расскажите подробнее о ваших потребностях. Это поможет нам создать более точное предложение."
-        elif choice == "ready_for_proposal":
-            message_text = "🎯 Понятно! Сейчас мы проанализируем всю информацию и подготовим для вас персональное предложение. Это займет несколько минут."
-        else:
-            message_text = "Извините, произошла ошибка. Попробуйте еще раз."
+        message_text = TemplatedText(CHOICE_REPLIES.get(choice, CHOICE_ERROR_REPLY))
+        
+        # Недоотправленная серия сообщений должна попасть в n8n раньше выбора
+        await self.debouncer.flush(user_id)
         
         await context.bot.send_message(
             chat_id=user_id,
@@ -530,13 +1062,29 @@ class TelegramBot:
             "text": f"Пользователь выбрал: {choice}",
             "message_type": "choice",
             "timestamp": datetime.utcnow().isoformat(),
+            # У выбора нет своего сообщения Telegram: с message_id 0 CRM не строит ключ идемпотентности
             "message_id": 0,
             "user_choice": choice
         }
         
         await self.send_n8n_webhook(user_info, message_data)
 
+def with_latency_budget(handler):
+    """Ограничивает внешние вызовы обработчика общим бюджетом задержки"""
+    @functools.wraps(handler)
+    async def wrapper(update: Update, context: ContextTypes.DEFAULT_TYPE):
+        started = time.monotonic()
+        with track_handler(handler.__name__), bot_instance.profiler.handler_breakdown(handler.__name__), \
+                latency_budget(HANDLER_LATENCY_BUDGET_SECONDS):
+            result = await handler(update, context)
+        elapsed = time.monotonic() - started
+        if elapsed > HANDLER_LATENCY_BUDGET_SECONDS:
+            logger.warning(f"Обработчик {handler.__name__} превысил бюджет задержки: {elapsed:.2f}с")
+        return result
+    return wrapper
+
 # Обработчики команд
+@with_latency_budget
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Обработчик команды /start"""
     # Получаем информацию о пользователе
@@ -561,6 +1109,7 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
         is_from_bot=True
     )
 
+@with_latency_budget
 async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Обработчик текстовых сообщений"""
     user_message = update.message.text
@@ -569,6 +1118,27 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
     
     logger.info(f"Получено сообщение от пользователя {user_id}: '{user_message}'")
     
+    user_info = {
+        "telegram_id": user_id,
+        "first_name": user.first_name,
+        "last_name": user.last_name,
+        "username": user.username,
+        "language_code": user.language_code
+    }
+    
+    # Сверх лимита сообщение только сохраняется, без приветствия, n8n и follow-up
+    if not await bot_instance.allow_fan_out(user_id):
+        await bot_instance.save_message_to_db(user_id, user_message, is_from_bot=False)
+        message_data = {
+            "text": user_message,
+            "message_type": "text",
+            "timestamp": update.message.date.isoformat(),
+            "message_id": update.message.message_id,
+            "is_first_message": False
+        }
+        bot_instance.shed_fan_out(user_id, user_info, message_data, context)
+        return
+    
     # Проверяем, нужно ли отправить автоматическое приветствие
     welcome_sent = await bot_instance.send_welcome_if_new_user(update)
     logger.info(f"Приветствие отправлено: {welcome_sent}")
@@ -582,16 +1152,8 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
     
     logger.info(f"welcome_sent: {welcome_sent}, is_first_message_check: {is_first_message_check}, итого is_first_message: {is_first_message}")
     
-    # Отправляем ВСЕ сообщения пользователей в n8n
-    logger.info(f"Отправляем сообщение от пользователя {user_id} в n8n: '{user_message}'")
-    
-    user_info = {
-        "telegram_id": user_id,
-        "first_name": user.first_name,
-        "last_name": user.last_name,
-        "username": user.username,
-        "language_code": user.language_code
-    }
+    # Отправляем ВСЕ сообщения пользователей в n8n (серии склеиваются)
+    logger.info(f"Ставим сообщение от пользователя {user_id} в очередь для n8n: '{user_message}'")
     
     message_data = {
         "text": user_message,
@@ -601,31 +1163,54 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
         "is_first_message": is_first_message  # Указываем в метаданных, но отправляем все сообщения
     }
     
-    # Отправляем webhook на n8n
-    webhook_sent = await bot_instance.send_n8n_webhook(user_info, message_data)
-    
-    if webhook_sent:
-        logger.info(f"Сообщение пользователя {user_id} отправлено в n8n")
-    else:
-        logger.warning(f"Не удалось отправить сообщение пользователя {user_id} в n8n")
-    
-    # Отправляем follow-up вопрос с inline кнопками
-    await bot_instance.send_follow_up_question(user_id, context)
+    # Webhook на n8n и follow-up вопрос отправляются один раз на серию сообщений
+    await bot_instance.debouncer.add(user_id, user_info, message_data, context)
     
     return
 
+@with_latency_budget
 async def handle_voice(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Обработчик голосовых сообщений"""
     user_id = update.effective_user.id
     user = update.effective_user
     voice = update.message.voice
+    audio_message_text = f"[Голосовое сообщение: {voice.duration}с]"
+    
+    user_info = {
+        "telegram_id": user_id,
+        "first_name": user.first_name,
+        "last_name": user.last_name,
+        "username": user.username,
+        "language_code": user.language_code
+    }
+    
+    # Сверх лимита сообщение только сохраняется, без приветствия, n8n и follow-up
+    if not await bot_instance.allow_fan_out(user_id):
+        await bot_instance.save_message_to_db(user_id, audio_message_text, is_from_bot=False, is_voice=True)
+        message_data = {
+            "text": None,
+            "message_type": "voice",
+            "timestamp": update.message.date.isoformat(),
+            "message_id": update.message.message_id,
+            "is_first_message": False,
+            "audio_file_id": voice.file_id,
+            "audio_duration": voice.duration
+        }
+        bot_instance.shed_fan_out(user_id, user_info, message_data, context)
+        return
     
     # Проверяем, нужно ли отправить автоматическое приветствие
     welcome_sent = await bot_instance.send_welcome_if_new_user(update)
     
-    # Сохраняем информацию об аудио сообщении в БД
-    audio_message_text = f"[Голосовое сообщение: {voice.duration}с]"
-    await bot_instance.save_message_to_db(user_id, audio_message_text, is_from_bot=False)
+    # Сохраняем информацию об аудио сообщении в БД (сразу, чтобы получить id для расшифровки)
+    db_message_id = await bot_instance.save_message_to_db(user_id, audio_message_text, is_from_bot=False, buffered=False,
+                                                           is_voice=True)
+    
+    # Скачивание и расшифровка идут в фоне, обработчик не ждет их
+    if bot_instance.voice_pipeline and db_message_id:
+        bot_instance.voice_pipeline.submit(
+            VoiceJob(user_id, db_message_id, voice.file_id, voice.duration, context.bot)
+        )
     
     # Определяем является ли это первое сообщение после приветствия (для метаданных)
     is_first_message_check = await bot_instance.is_first_message_after_welcome(user_id)
@@ -634,14 +1219,6 @@ async def handle_voice(update: Update, context: ContextTypes.DEFAULT_TYPE):
     # Отправляем ВСЕ голосовые сообщения в n8n
     logger.info(f"Отправляем голосовое сообщение от пользователя {user_id} в n8n")
     
-    user_info = {
-        "telegram_id": user_id,
-        "first_name": user.first_name,
-        "last_name": user.last_name,
-        "username": user.username,
-        "language_code": user.language_code
-    }
-    
     message_data = {
         "text": None,  # Для аудио сообщений текста нет
         "message_type": "voice",
@@ -652,19 +1229,12 @@ async def handle_voice(update: Update, context: ContextTypes.DEFAULT_TYPE):
         "audio_duration": voice.duration
     }
     
-    # Отправляем webhook на n8n
-    webhook_sent = await bot_instance.send_n8n_webhook(user_info, message_data)
-    
-    if webhook_sent:
-        logger.info(f"Голосовое сообщение пользователя {user_id} отправлено в n8n")
-    else:
-        logger.warning(f"Не удалось отправить голосовое сообщение пользователя {user_id} в n8n")
-    
-    # Отправляем follow-up вопрос с inline кнопками
-    await bot_instance.send_follow_up_question(user_id, context)
+    # Webhook на n8n и follow-up вопрос отправляются один раз на серию сообщений
+    await bot_instance.debouncer.add(user_id, user_info, message_data, context)
     
     return
 
+@with_latency_budget
 async def handle_callback_query(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Обработчик нажатий на inline кнопки"""
     query = update.callback_query
@@ -679,45 +1249,138 @@ async def handle_callback_query(update: Update, context: ContextTypes.DEFAULT_TY
     # Обрабатываем выбор пользователя
     await bot_instance.handle_user_choice(user_id, choice, context)
 
-def main():
-    """Основная функция запуска бота"""
-    global bot_instance
-    bot_instance = TelegramBot()
-    
-    # Создание приложения
-    application = Application.builder().token(TELEGRAM_TOKEN).build()
+def build_application(token: str = None, request=None, **builder_options) -> Application:
+    """Приложение с обработчиками бота; builder_options - другие методы ApplicationBuilder (base_file_url=...)"""
+    # Пул соединений как у запроса по умолчанию; long polling (get_updates) в разбивку не попадает
+    builder = Application.builder().token(token or TELEGRAM_TOKEN) \
+        .request(request or TimedRequest(connection_pool_size=256))
+    for name, value in builder_options.items():
+        builder = getattr(builder, name)(value)
+    application = builder.build()
     
     # Добавление обработчиков
     application.add_handler(CommandHandler("start", start))
     application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_message))
     application.add_handler(MessageHandler(filters.VOICE, handle_voice))
     application.add_handler(CallbackQueryHandler(handle_callback_query))
+    return application
+
+def install_stop_signal_handlers(stop_requested: asyncio.Event) -> None:
+    """SIGTERM (остановка при деплое) и SIGINT запускают штатную остановку бота.
+
+    Без обработчиков SIGTERM завершает процесс сразу, а KeyboardInterrupt
+    вылетает из run_until_complete мимо finally корутины - накопленные серии
+    сообщений и строки буфера записи терялись бы. Повторный сигнал
+    обрабатывается по умолчанию и прерывает зависшую остановку.
+    """
+    loop = asyncio.get_running_loop()
+    signals = [signal.SIGTERM, signal.SIGINT]
+    
+    def request_stop(signum):
+        logger.info(f"Получен сигнал {signal.Signals(signum).name}, останавливаем бота")
+        for sig in signals:
+            loop.remove_signal_handler(sig)
+        stop_requested.set()
+    
+    for sig in signals:
+        try:
+            loop.add_signal_handler(sig, request_stop, sig)
+        except NotImplementedError:  # Windows: остается KeyboardInterrupt
+            pass
+
+def main():
+    """Основная функция запуска бота"""
+    global bot_instance
+    startup_timer.mark('imports')
+    bot_instance = TelegramBot()
+    
+    # Создание приложения
+    application = build_application()
+    startup_timer.mark('build_application')
     
     logger.info("Бот запущен!")
     
     # Запуск бота с инициализацией
     async def initialize_and_run():
+        metrics_runner = None
+        stop_requested = asyncio.Event()
+        install_stop_signal_handlers(stop_requested)
         try:
-            await bot_instance.init_db_pool()
-            await bot_instance.setup_qdrant_collection()
-            await application.initialize()
+            if BOT_ASYNCIO_DEBUG:
+                loop = asyncio.get_running_loop()
+                loop.set_debug(True)
+                loop.slow_callback_duration = BOT_SLOW_CALLBACK_MS / 1000
+            if hasattr(signal, 'SIGUSR1'):
+                bot_instance.profiler.install_signal_handler(signal.SIGUSR1)
+            if BOT_PROFILING_ENABLED:
+                bot_instance.profiler.enable()
+            # Подключение к БД и проверка токена в Telegram (getMe) не зависят друг от друга
+            await asyncio.gather(
+                startup_timer.run('db_pool', bot_instance.init_db_pool()),
+                startup_timer.run('telegram_initialize', application.initialize())
+            )
+            startup_timer.mark('connect')
+            if BOT_METRICS_PORT:
+                metrics_runner = await start_metrics_server(
+                    BOT_METRICS_HOST, BOT_METRICS_PORT, bot_instance.create_stats_collector()
+                )
+            if bot_instance.deferred_queue:
+                bot_instance.deferred_queue.start()
+            if bot_instance.voice_pipeline and bot_instance.db_pool:
+                bot_instance.voice_pipeline.start()
+            # Qdrant и наполнение базы знаний - в фоне, бот отвечает сразу
+            bot_instance.start_knowledge_base()
             await application.start()
             await application.updater.start_polling()
+            startup_timer.mark('start_polling')
+            logger.info(startup_timer.ready())
             
-            # Ждем бесконечно
-            while True:
-                await asyncio.sleep(1)
-        except KeyboardInterrupt:
-            logger.info("Получен сигнал остановки")
+            # Работаем до SIGTERM/SIGINT: остановка ниже досылает серии и сбрасывает буфер записи
+            await stop_requested.wait()
         finally:
-            try:
-                await application.updater.stop()
-                await application.stop()
-                await application.shutdown()
-                if bot_instance.db_pool:
-                    await bot_instance.db_pool.close()
-            except Exception as e:
-                logger.error(f"Ошибка при остановке: {e}")
+            # Каждый шаг остановки выполняется независимо: ошибка остановки polling'а
+            # или недошедший до конца запуск не должны пропускать досылку серий
+            # сообщений и сброс буфера записи в close_db_pool
+            async def flush_deferred_queue():
+                if bot_instance.deferred_queue:
+                    await bot_instance.deferred_queue.close()
+                    logger.info(f"Статистика лимитов сообщений: {bot_instance.get_rate_limit_stats()}")
+            
+            async def flush_debouncer():
+                await bot_instance.debouncer.flush_all()
+                logger.info(f"Статистика склейки сообщений: {bot_instance.debouncer.get_stats()}")
+                logger.info(f"Состояние circuit breaker'ов: {bot_instance.get_breaker_states()}")
+            
+            async def close_voice_pipeline():
+                if bot_instance.voice_pipeline:
+                    await bot_instance.voice_pipeline.close()
+                    logger.info(f"Статистика обработки голосовых сообщений: {bot_instance.voice_pipeline.get_stats()}")
+            
+            async def cleanup_metrics():
+                if metrics_runner:
+                    await metrics_runner.cleanup()
+            
+            async def disable_profiler():
+                bot_instance.profiler.disable()
+            
+            # Досылаем отложенные сообщения и накопленные серии, пока бот еще может отправлять сообщения
+            shutdown_steps = [
+                bot_instance.stop_knowledge_base,
+                application.updater.stop,
+                flush_deferred_queue,
+                flush_debouncer,
+                close_voice_pipeline,
+                application.stop,
+                application.shutdown,
+                bot_instance.close_db_pool,
+                cleanup_metrics,
+                disable_profiler,
+            ]
+            for step in shutdown_steps:
+                try:
+                    await step()
+                except Exception as e:
+                    logger.error(f"Ошибка при остановке ({step.__name__}): {e}")
     
     # Используем простой event loop
     loop = asyncio.new_event_loop()
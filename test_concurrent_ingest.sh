@@ -0,0 +1,59 @@
+#!/bin/bash
+
+echo "🧪 Нагрузочный тест: параллельные запросы одного нового пользователя"
+echo "==================================================================="
+
+# URL приложения (по умолчанию локальный запуск)
+APP_URL="${APP_URL:-http://localhost:5000}"
+# Сколько запросов отправить одновременно
+CONCURRENCY="${CONCURRENCY:-50}"
+# Новый telegram_id на каждый запуск, чтобы первым запросом создавался клиент
+TELEGRAM_ID="${TELEGRAM_ID:-$(( 7000000000 + RANDOM * 32768 + RANDOM ))}"
+
+RESULTS_DIR=$(mktemp -d)
+trap 'rm -rf "$RESULTS_DIR"' EXIT
+
+echo -e "\n📤 Отправляем $CONCURRENCY запросов для telegram_id $TELEGRAM_ID (половина через save_final_message, половина через add_brief)..."
+
+for i in $(seq 1 "$CONCURRENCY"); do
+  if (( i % 2 )); then
+    curl -s -o /dev/null -w "%{http_code}\n" -X POST "$APP_URL/api/save_final_message" \
+      -H "Content-Type: application/json" \
+      -d "{
+        \"user\": {\"telegram_id\": $TELEGRAM_ID, \"first_name\": \"Нагрузка\", \"last_name\": \"Тест\"},
+        \"message\": {\"text\": \"Часть брифа $i\", \"message_type\": \"text\", \"message_id\": $i},
+        \"metadata\": {\"is_first_message\": $([ "$i" -eq 1 ] && echo true || echo false)}
+      }" > "$RESULTS_DIR/$i" &
+  else
+    curl -s -o /dev/null -w "%{http_code}\n" -X POST "$APP_URL/api/add_brief" \
+      -H "Content-Type: application/json" \
+      -d "{\"telegram_id\": $TELEGRAM_ID, \"text\": \"Часть брифа $i\"}" > "$RESULTS_DIR/$i" &
+  fi
+done
+wait
+
+OK_COUNT=$(cat "$RESULTS_DIR"/* | grep -c '^200$')
+echo "Успешных ответов: $OK_COUNT из $CONCURRENCY"
+echo "Коды ответов: $(cat "$RESULTS_DIR"/* | sort | uniq -c | tr '\n' ' ')"
+
+echo -e "\n🔍 Проверяем, что ни одно сообщение и ни одна часть брифа не потеряны..."
+curl -s "$APP_URL/api/get_brief/$TELEGRAM_ID" | python3 -c "
+import json, sys
+concurrency = $CONCURRENCY
+brief = json.load(sys.stdin)
+messages = [m['text'] for m in brief['messages']]
+parts = brief['user_brief'].split('\n\n--- Новое сообщение ---\n')
+missing = [i for i in range(1, concurrency + 1) if f'Часть брифа {i}' not in parts]
+print(f'Сообщений в БД: {len(messages)}, частей брифа: {len(parts)}')
+if len(messages) != concurrency or len(parts) != concurrency or missing:
+    print(f'❌ Потеряны данные, отсутствуют части: {missing}')
+    sys.exit(1)
+print('✅ Все сообщения и части брифа на месте')
+" || exit 1
+
+if [ "$OK_COUNT" -ne "$CONCURRENCY" ]; then
+  echo "❌ Не все запросы выполнены успешно"
+  exit 1
+fi
+
+echo -e "\n✅ Тест завершен!"
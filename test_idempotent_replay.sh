@@ -0,0 +1,75 @@
+#!/bin/bash
+
+echo "🧪 Тест идемпотентности: один и тот же запрос много раз одновременно"
+echo "===================================================================="
+
+# URL приложения (по умолчанию локальный запуск)
+APP_URL="${APP_URL:-http://localhost:5000}"
+# Сколько одинаковых запросов отправить одновременно
+REPLAYS="${REPLAYS:-50}"
+TELEGRAM_ID="${TELEGRAM_ID:-$(( 6000000000 + RANDOM * 32768 + RANDOM ))}"
+MESSAGE_ID=$(( RANDOM + 1 ))
+
+RESULTS_DIR=$(mktemp -d)
+trap 'rm -rf "$RESULTS_DIR"' EXIT
+
+PAYLOAD="{
+  \"user\": {\"telegram_id\": $TELEGRAM_ID, \"first_name\": \"Повтор\", \"last_name\": \"Тест\"},
+  \"message\": {\"text\": \"Сообщение, которое n8n доставил несколько раз\", \"message_type\": \"text\", \"message_id\": $MESSAGE_ID},
+  \"metadata\": {\"is_first_message\": true}
+}"
+
+echo -e "\n📤 Отправляем $REPLAYS одинаковых запросов (telegram_id $TELEGRAM_ID, message_id $MESSAGE_ID)..."
+for i in $(seq 1 "$REPLAYS"); do
+  curl -s -X POST "$APP_URL/api/save_final_message" \
+    -H "Content-Type: application/json" \
+    -d "$PAYLOAD" > "$RESULTS_DIR/$i" &
+done
+wait
+
+echo -e "\n🔍 Проверяем ответы и данные клиента..."
+cat "$RESULTS_DIR"/* | python3 -c "
+import json, sys
+responses = [json.loads(line) for line in sys.stdin.read().replace('}{', '}\n{').splitlines() if line.strip()]
+message_ids = {r.get('message_id') for r in responses}
+print(f'Ответов: {len(responses)}, разных message_id в ответах: {len(message_ids)}')
+if len(responses) != $REPLAYS or len(message_ids) != 1 or not all(r.get('success') for r in responses):
+    print(f'❌ Повторы получили разные ответы: {responses[:3]}')
+    sys.exit(1)
+" || exit 1
+
+curl -s "$APP_URL/api/get_brief/$TELEGRAM_ID" | python3 -c "
+import json, sys
+brief = json.load(sys.stdin)
+parts = brief['user_brief'].split('\n\n--- Новое сообщение ---\n')
+print(f'Сообщений в БД: {len(brief[\"messages\"])}, частей брифа: {len(parts)}')
+if len(brief['messages']) != 1 or len(parts) != 1:
+    print('❌ Повторы создали дубликаты')
+    sys.exit(1)
+print('✅ Сохранено ровно одно сообщение, повторы получили исходный ответ')
+" || exit 1
+
+# Выбор кнопки приходит от бота с message_id 0: это не повтор, каждый выбор сохраняется
+CHOICE_TELEGRAM_ID=$(( TELEGRAM_ID + 1 ))
+echo -e "\n📤 Отправляем два разных выбора с message_id 0 (telegram_id $CHOICE_TELEGRAM_ID)..."
+for choice in more_info ready_for_proposal; do
+  curl -s -o /dev/null -D - -X POST "$APP_URL/api/save_final_message" \
+    -H "Content-Type: application/json" \
+    -d "{
+      \"user\": {\"telegram_id\": $CHOICE_TELEGRAM_ID, \"first_name\": \"Пользователь\"},
+      \"message\": {\"text\": \"Пользователь выбрал: $choice\", \"message_type\": \"choice\", \"message_id\": 0}
+    }" | grep -i '^Idempotent-Replay' && { echo "❌ Выбор $choice принят за повтор"; exit 1; }
+done
+
+curl -s "$APP_URL/api/get_brief/$CHOICE_TELEGRAM_ID" | python3 -c "
+import json, sys
+brief = json.load(sys.stdin)
+texts = [m['text'] for m in brief['messages']]
+print(f'Сообщений в БД: {len(texts)}')
+if sorted(texts) != ['Пользователь выбрал: more_info', 'Пользователь выбрал: ready_for_proposal']:
+    print(f'❌ Выбор потерян: {texts}')
+    sys.exit(1)
+print('✅ Оба выбора сохранены')
+" || exit 1
+
+echo -e "\n✅ Тест завершен!"
@@ -0,0 +1,73 @@
+#!/bin/bash
+
+echo "🧪 Тест живых обновлений: NOTIFY в PostgreSQL -> LISTEN -> потоки SSE дашборда"
+echo "================================================================================"
+
+# URL приложения (по умолчанию локальный запуск). Доставка между worker'ами gunicorn
+# проверяется только на PostgreSQL: в SQLite события не выходят за пределы процесса
+APP_URL="${APP_URL:-http://localhost:5000}"
+ADMIN_USERNAME="${ADMIN_USERNAME:-admin}"
+ADMIN_PASSWORD="${ADMIN_PASSWORD:-admin123}"
+# Сколько потоков SSE открыть одновременно (больше SSE_MAX_CONNECTIONS - лишние получат 503)
+STREAMS="${STREAMS:-6}"
+TELEGRAM_ID="${TELEGRAM_ID:-$(( 5000000000 + RANDOM * 32768 + RANDOM ))}"
+
+RESULTS_DIR=$(mktemp -d)
+trap 'kill $(jobs -p) 2>/dev/null; rm -rf "$RESULTS_DIR"' EXIT
+
+echo -e "\n🔑 Вход в CRM..."
+curl -s -o /dev/null -c "$RESULTS_DIR/cookies" -b "$RESULTS_DIR/cookies" -X POST "$APP_URL/login" \
+  -d "username=$ADMIN_USERNAME" -d "password=$ADMIN_PASSWORD"
+if ! curl -s -o /dev/null -w "%{http_code}" -b "$RESULTS_DIR/cookies" "$APP_URL/" | grep -q '^200$'; then
+  echo "❌ Не удалось войти в CRM как $ADMIN_USERNAME"
+  exit 1
+fi
+
+echo -e "\n📡 Открываем $STREAMS потоков /events..."
+for i in $(seq 1 "$STREAMS"); do
+  curl -sN -b "$RESULTS_DIR/cookies" -D "$RESULTS_DIR/headers_$i" "$APP_URL/events" > "$RESULTS_DIR/stream_$i" &
+done
+# LISTEN-поток worker'а подключается при первом открытом потоке
+sleep 2
+
+OPEN_STREAMS=$(grep -l '^HTTP/[0-9.]* 200' "$RESULTS_DIR"/headers_* | wc -l)
+REJECTED_STREAMS=$(grep -l '^HTTP/[0-9.]* 503' "$RESULTS_DIR"/headers_* | wc -l)
+echo "Открыто потоков: $OPEN_STREAMS, отклонено по лимиту SSE_MAX_CONNECTIONS: $REJECTED_STREAMS"
+if [ "$OPEN_STREAMS" -eq 0 ]; then
+  echo "❌ Ни один поток SSE не открыт"
+  exit 1
+fi
+
+echo -e "\n⏱️ Обычный запрос, пока потоки SSE открыты..."
+STATUS=$(curl -s -o /dev/null -w "%{http_code}" --max-time 5 -b "$RESULTS_DIR/cookies" "$APP_URL/")
+if [ "$STATUS" != "200" ]; then
+  echo "❌ Дашборд не ответил за 5 секунд (код $STATUS): потоки SSE заняли все потоки gunicorn"
+  exit 1
+fi
+echo "✅ Дашборд ответил"
+
+echo -e "\n📤 Новое сообщение через API (telegram_id $TELEGRAM_ID)..."
+curl -s -o /dev/null -X POST "$APP_URL/api/save_final_message" \
+  -H "Content-Type: application/json" \
+  -d "{
+    \"user\": {\"telegram_id\": $TELEGRAM_ID, \"first_name\": \"Живые\", \"last_name\": \"Обновления\"},
+    \"message\": {\"text\": \"Событие для дашборда $TELEGRAM_ID\", \"message_type\": \"text\", \"message_id\": 1},
+    \"metadata\": {\"is_first_message\": true}
+  }"
+sleep 2
+
+echo -e "\n🔍 Проверяем, что событие получили все открытые потоки..."
+for i in $(seq 1 "$STREAMS"); do
+  grep -q '^HTTP/[0-9.]* 200' "$RESULTS_DIR/headers_$i" || continue
+  if ! grep -q "^event: client" "$RESULTS_DIR/stream_$i" || ! grep -q "\"telegram_id\": $TELEGRAM_ID" "$RESULTS_DIR/stream_$i"; then
+    echo "❌ Поток $i не получил событие о клиенте"
+    exit 1
+  fi
+  if ! grep -q "^event: message" "$RESULTS_DIR/stream_$i" || ! grep -q "Событие для дашборда $TELEGRAM_ID" "$RESULTS_DIR/stream_$i"; then
+    echo "❌ Поток $i не получил событие о сообщении"
+    exit 1
+  fi
+done
+echo "✅ События client и message доставлены во все $OPEN_STREAMS потоков"
+
+echo -e "\n✅ Тест завершен!"
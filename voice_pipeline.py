@@ -0,0 +1,227 @@
+"""
+Фоновая обработка голосовых сообщений бота.
+
+Обработчик ставит задачу в ограниченную очередь и сразу возвращается.
+Пул worker'ов скачивает файл из Telegram потоково во временный файл,
+отправляет его в подключаемый backend расшифровки и передает результат
+в on_result (бот записывает расшифровку в строку message).
+"""
+
+import asyncio
+import importlib
+import logging
+import os
+import tempfile
+import time
+from dataclasses import dataclass
+from typing import Any, Awaitable, Callable, Dict, List, Optional
+
+logger = logging.getLogger(__name__)
+
+DOWNLOAD_CHUNK_SIZE = 64 * 1024
+
+
+@dataclass
+class VoiceJob:
+    telegram_id: int
+    message_id: Optional[int]  # id строки в таблице message
+    file_id: str
+    duration: Optional[int]
+    bot: Any  # telegram.Bot, через который скачивается файл
+    enqueued_at: float = 0.0
+
+
+class TranscriptionBackend:
+    """Интерфейс backend'а расшифровки: получает путь к аудиофайлу, возвращает текст"""
+
+    name = "base"
+
+    async def transcribe(self, path: str, duration: Optional[int] = None) -> str:
+        raise NotImplementedError
+
+
+class StubTranscriptionBackend(TranscriptionBackend):
+    """Локальная заглушка без внешних вызовов - для тестов и разработки"""
+
+    name = "stub"
+
+    async def transcribe(self, path: str, duration: Optional[int] = None) -> str:
+        size = await asyncio.to_thread(os.path.getsize, path)
+        return f"[Расшифровка-заглушка: {duration or 0}с, {size} байт]"
+
+
+class OpenAIWhisperBackend(TranscriptionBackend):
+    """Расшифровка через OpenAI Whisper (старый API openai 0.28)"""
+
+    name = "openai"
+
+    def __init__(self, model: str = "whisper-1", breaker=None, timeout: float = 60.0):
+        self.model = model
+        self.breaker = breaker
+        self.timeout = timeout
+
+    def _transcribe_sync(self, path: str) -> str:
+        import openai
+
+        with open(path, "rb") as audio_file:
+            response = openai.Audio.transcribe(self.model, audio_file)
+        return response["text"]
+
+    async def transcribe(self, path: str, duration: Optional[int] = None) -> str:
+        if self.breaker:
+            return await self.breaker.call(asyncio.to_thread, self._transcribe_sync, path, timeout=self.timeout)
+        return await asyncio.wait_for(asyncio.to_thread(self._transcribe_sync, path), self.timeout)
+
+
+BACKENDS = {
+    StubTranscriptionBackend.name: StubTranscriptionBackend,
+    OpenAIWhisperBackend.name: OpenAIWhisperBackend,
+}
+
+
+def load_backend(name: str, **kwargs) -> TranscriptionBackend:
+    """Backend по имени ('stub', 'openai') или по пути 'package.module:ClassName'"""
+    if name in BACKENDS:
+        backend_class = BACKENDS[name]
+    elif ":" in name:
+        module_name, class_name = name.split(":", 1)
+        backend_class = getattr(importlib.import_module(module_name), class_name)
+    else:
+        raise ValueError(f"Неизвестный backend расшифровки: {name}")
+
+    if backend_class is OpenAIWhisperBackend:
+        return backend_class(**kwargs)
+    return backend_class()
+
+
+class DownloadError(Exception):
+    """Ошибка скачивания файла Telegram без URL (в нем токен бота)"""
+
+
+async def download_telegram_file(bot, file_id: str, directory: str, max_bytes: int) -> str:
+    """Потоково скачивает файл Telegram во временный файл и возвращает путь к нему"""
+    import aiohttp  # импорт при первом голосовом сообщении, а не при запуске бота
+    tg_file = await bot.get_file(file_id)
+    fd, path = tempfile.mkstemp(suffix=".oga", dir=directory)
+    size = 0
+    try:
+        with os.fdopen(fd, "wb") as out:
+            async with aiohttp.ClientSession() as session:
+                async with session.get(tg_file.file_path, timeout=aiohttp.ClientTimeout(total=120)) as response:
+                    response.raise_for_status()
+                    async for chunk in response.content.iter_chunked(DOWNLOAD_CHUNK_SIZE):
+                        size += len(chunk)
+                        if size > max_bytes:
+                            raise ValueError(f"Голосовое сообщение больше {max_bytes} байт")
+                        out.write(chunk)
+    except aiohttp.ClientResponseError as e:
+        # URL файла содержит токен бота (/file/bot<TOKEN>/...), а str(e) включает URL -
+        # в лог попадает только HTTP статус
+        os.unlink(path)
+        raise DownloadError(f"Telegram вернул HTTP {e.status} при скачивании файла") from None
+    except aiohttp.InvalidURL:
+        os.unlink(path)
+        raise DownloadError("Некорректный URL файла Telegram") from None
+    except BaseException:
+        os.unlink(path)
+        raise
+    return path
+
+
+class VoicePipeline:
+    """Очередь голосовых сообщений с ограниченным пулом worker'ов"""
+
+    def __init__(self, backend: TranscriptionBackend, on_result: Callable[[VoiceJob, str], Awaitable[None]],
+                 workers: int = 2, max_queue: int = 100, tmp_dir: Optional[str] = None,
+                 max_file_bytes: int = 20 * 1024 * 1024, downloader=download_telegram_file):
+        self.backend = backend
+        self.on_result = on_result
+        self.workers = workers
+        self.tmp_dir = tmp_dir or tempfile.gettempdir()
+        self.max_file_bytes = max_file_bytes
+        self.downloader = downloader
+        self._queue: asyncio.Queue = asyncio.Queue(maxsize=max_queue)
+        self._tasks: List[asyncio.Task] = []
+        self._in_progress = 0
+        self.stats = {
+            "submitted": 0,
+            "processed": 0,
+            "failed": 0,
+            "dropped": 0,
+            "bytes_downloaded": 0,
+            "processing_seconds_total": 0.0,
+            "processing_seconds_max": 0.0,
+            "queue_wait_seconds_max": 0.0
+        }
+
+    def start(self) -> None:
+        if not self._tasks:
+            self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+            logger.info(f"Обработка голосовых сообщений запущена: backend {self.backend.name}, worker'ов {self.workers}")
+
+    def submit(self, job: VoiceJob) -> bool:
+        """Ставит задачу в очередь без ожидания. False - очередь заполнена"""
+        job.enqueued_at = time.monotonic()
+        try:
+            self._queue.put_nowait(job)
+        except asyncio.QueueFull:
+            self.stats["dropped"] += 1
+            logger.warning(f"Очередь голосовых сообщений заполнена, сообщение пользователя {job.telegram_id} не будет расшифровано")
+            return False
+        self.stats["submitted"] += 1
+        return True
+
+    async def _worker(self) -> None:
+        while True:
+            job = await self._queue.get()
+            self._in_progress += 1
+            try:
+                await self._process(job)
+            finally:
+                self._in_progress -= 1
+                self._queue.task_done()
+
+    async def _process(self, job: VoiceJob) -> None:
+        started = time.monotonic()
+        self.stats["queue_wait_seconds_max"] = max(self.stats["queue_wait_seconds_max"], started - job.enqueued_at)
+        path = None
+        try:
+            path = await self.downloader(job.bot, job.file_id, self.tmp_dir, self.max_file_bytes)
+            size = await asyncio.to_thread(os.path.getsize, path)
+            self.stats["bytes_downloaded"] += size
+            transcript = await self.backend.transcribe(path, job.duration)
+            await self.on_result(job, transcript)
+            self.stats["processed"] += 1
+        except Exception as e:
+            self.stats["failed"] += 1
+            logger.error(f"Ошибка обработки голосового сообщения пользователя {job.telegram_id}: {e}")
+        finally:
+            if path:
+                try:
+                    os.unlink(path)
+                except OSError:
+                    pass
+            elapsed = time.monotonic() - started
+            self.stats["processing_seconds_total"] += elapsed
+            self.stats["processing_seconds_max"] = max(self.stats["processing_seconds_max"], elapsed)
+
+    async def close(self, timeout: float = 30.0) -> None:
+        """Дожидается обработки очереди (не дольше timeout) и останавливает worker'ы"""
+        if not self._tasks:
+            return
+        try:
+            await asyncio.wait_for(self._queue.join(), timeout)
+        except asyncio.TimeoutError:
+            logger.warning(f"При остановке не обработано {self._queue.qsize()} голосовых сообщений")
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    def get_stats(self) -> Dict[str, Any]:
+        stats = dict(self.stats)
+        stats["queue_depth"] = self._queue.qsize()
+        stats["in_progress"] = self._in_progress
+        finished = stats["processed"] + stats["failed"]
+        stats["processing_seconds_avg"] = round(stats["processing_seconds_total"] / finished, 3) if finished else 0.0
+        return stats
@@ -0,0 +1,287 @@
+"""
+Буфер отложенной записи сообщений бота в PostgreSQL.
+
+Сообщения копятся в памяти и сбрасываются пачками: раз в flush_interval
+секунд или при накоплении max_batch_rows строк. Клиенты всей пачки
+создаются одним upsert, сами сообщения пишутся через COPY. Агрегаты
+аналитики и уведомления CRM по пачке отправляются в той же транзакции
+(callback on_batch).
+
+Если пачка не записалась, она пишется по одной строке: строки, которые
+PostgreSQL отвергает из-за данных (ошибки классов 22 и 23 - недопустимый
+текст, нарушение ограничения, нет секции для времени сообщения), уходят в
+лог недоставленных (логгер write_buffer.dead_letter, JSON строки) и не
+блокируют остальной буфер. При остальных ошибках (БД недоступна) строки
+остаются в буфере до следующей попытки.
+"""
+
+import asyncio
+import json
+import logging
+from datetime import datetime
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Tuple
+
+from analytics import DailyDelta
+
+logger = logging.getLogger(__name__)
+dead_letter_logger = logging.getLogger(f"{__name__}.dead_letter")
+
+# Классы SQLSTATE, при которых строка не запишется и при повторе: 22 - ошибка данных, 23 - нарушение ограничения
+REJECTED_SQLSTATE_CLASSES = ('22', '23')
+
+# (seq, telegram_id, message_text, is_from_bot, timestamp, is_voice)
+BufferedRow = Tuple[int, int, str, bool, datetime, bool]
+
+UPSERT_CLIENTS_SQL = """
+    INSERT INTO client (telegram_id, created_at, updated_at)
+    SELECT t.telegram_id, t.ts, t.ts
+    FROM unnest($1::bigint[], $2::timestamp[]) AS t(telegram_id, ts)
+    ON CONFLICT (telegram_id) DO UPDATE SET updated_at = EXCLUDED.updated_at
+    RETURNING id, telegram_id, (xmax = 0) AS inserted
+"""
+
+
+class MessageWriteBuffer:
+    """Write-behind буфер для таблицы message с ограничением по памяти.
+
+    Когда БД не успевает, put() ждет освобождения места (backpressure) не
+    дольше put_timeout секунд и возвращает False - вызывающий код должен
+    записать сообщение напрямую.
+    """
+
+    def __init__(self, pool, flush_interval: float = 0.2, max_batch_rows: int = 500,
+                 max_pending_rows: int = 10000, put_timeout: float = 5.0,
+                 on_batch: Optional[Callable[..., Awaitable[None]]] = None, templates=None):
+        self.pool = pool
+        # TemplateCache (message_templates.py): сообщения из шаблонов пишутся ссылкой на шаблон
+        self.templates = templates
+        # on_batch(conn, batch, clients) - агрегаты аналитики и события CRM по записанной пачке
+        self.on_batch = on_batch
+        self.flush_interval = flush_interval
+        self.max_batch_rows = max_batch_rows
+        self.max_pending_rows = max(max_pending_rows, max_batch_rows)
+        self.put_timeout = put_timeout
+
+        self._rows: List[BufferedRow] = []
+        self._slots = asyncio.Semaphore(self.max_pending_rows)
+        self._wakeup = asyncio.Event()
+        self._committed = asyncio.Condition()
+        self._flush_lock = asyncio.Lock()
+        self._seq = 0
+        self._committed_seq = 0
+        self._last_seq_by_user: Dict[int, int] = {}
+        self._task: Optional[asyncio.Task] = None
+        self._closing = False
+
+        self.stats = {
+            "rows_buffered": 0,
+            "rows_written": 0,
+            "batches_written": 0,
+            "flush_errors": 0,
+            "rows_rejected": 0,
+            "backpressure_timeouts": 0,
+            "max_pending": 0
+        }
+
+    def start(self) -> None:
+        """Запускает фоновую задачу сброса буфера"""
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def put(self, telegram_id: int, message_text: str, is_from_bot: bool, is_voice: bool = False,
+                  timestamp: Optional[datetime] = None) -> bool:
+        """Ставит сообщение в очередь на запись. False - буфер переполнен"""
+        if self._closing:
+            return False
+
+        try:
+            await asyncio.wait_for(self._slots.acquire(), timeout=self.put_timeout)
+        except asyncio.TimeoutError:
+            self.stats["backpressure_timeouts"] += 1
+            logger.warning(f"Буфер записи переполнен ({len(self._rows)} строк), пишем сообщение напрямую")
+            return False
+
+        self._seq += 1
+        self._rows.append((self._seq, telegram_id, message_text, is_from_bot, timestamp or datetime.utcnow(), is_voice))
+        self._last_seq_by_user[telegram_id] = self._seq
+        self.stats["rows_buffered"] += 1
+        self.stats["max_pending"] = max(self.stats["max_pending"], len(self._rows))
+
+        if len(self._rows) >= self.max_batch_rows:
+            self._wakeup.set()
+        return True
+
+    def has_pending(self, telegram_id: int) -> bool:
+        """Есть ли у пользователя еще не записанные сообщения"""
+        return self._last_seq_by_user.get(telegram_id, 0) > self._committed_seq
+
+    async def sync(self, telegram_id: int, timeout: float = 5.0) -> None:
+        """Дожидается записи всех сообщений пользователя (read-your-writes).
+
+        Сброс запускается немедленно и заодно забирает строки остальных
+        пользователей, поэтому одновременные вызовы разделяют один COPY.
+        """
+        target = self._last_seq_by_user.get(telegram_id, 0)
+        if target <= self._committed_seq:
+            return
+
+        self._wakeup.set()
+        try:
+            async with self._committed:
+                await asyncio.wait_for(
+                    self._committed.wait_for(lambda: self._committed_seq >= target),
+                    timeout=timeout
+                )
+        except asyncio.TimeoutError:
+            logger.warning(f"Сообщения пользователя {telegram_id} еще не записаны в БД")
+
+    async def _run(self) -> None:
+        while not self._closing:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+
+            if not await self.flush():
+                # БД не отвечает - не долбим ее в цикле, строки остаются в буфере
+                await asyncio.sleep(min(5.0, self.flush_interval * 10))
+
+    async def flush(self) -> bool:
+        """Записывает все накопленные строки пачками. False - при ошибке БД"""
+        async with self._flush_lock:
+            while self._rows:
+                batch = self._rows[:self.max_batch_rows]
+                try:
+                    await self._write_batch(batch)
+                    done = len(batch)
+                    self.stats["rows_written"] += done
+                    self.stats["batches_written"] += 1
+                except Exception as e:
+                    self.stats["flush_errors"] += 1
+                    logger.error(f"Ошибка пакетной записи сообщений в БД ({len(batch)} строк): {e}")
+                    # Одна недопустимая строка не должна держать весь буфер
+                    done = await self._write_rows_separately(batch)
+
+                if done:
+                    del self._rows[:done]
+                    for _ in range(done):
+                        self._slots.release()
+                    async with self._committed:
+                        self._committed_seq = batch[done - 1][0]
+                        self._committed.notify_all()
+                if done < len(batch):
+                    return False
+
+            # Забываем пользователей, у которых все записано
+            self._last_seq_by_user = {
+                telegram_id: seq for telegram_id, seq in self._last_seq_by_user.items()
+                if seq > self._committed_seq
+            }
+            return True
+
+    async def _write_rows_separately(self, batch: List[BufferedRow]) -> int:
+        """Пишет пачку по одной строке, отвергнутые БД строки - в лог недоставленных.
+
+        Возвращает, сколько строк с начала пачки обработано: на первой ошибке
+        не из REJECTED_SQLSTATE_CLASSES запись останавливается.
+        """
+        for done, row in enumerate(batch):
+            try:
+                await self._write_batch([row])
+            except Exception as e:
+                if (getattr(e, 'sqlstate', None) or '')[:2] not in REJECTED_SQLSTATE_CLASSES:
+                    return done
+                self.stats["rows_rejected"] += 1
+                _, telegram_id, message_text, is_from_bot, timestamp, is_voice = row
+                dead_letter_logger.error(json.dumps({
+                    "telegram_id": telegram_id,
+                    "message_text": message_text,
+                    "is_from_bot": is_from_bot,
+                    "is_voice": is_voice,
+                    "timestamp": timestamp.isoformat(),
+                    "error": f"{getattr(e, 'sqlstate', '')} {e}"
+                }, ensure_ascii=False))
+            else:
+                self.stats["rows_written"] += 1
+        return len(batch)
+
+    async def _write_batch(self, batch: List[BufferedRow]) -> None:
+        latest: Dict[int, datetime] = {}
+        for _, telegram_id, _, _, timestamp, _ in batch:
+            latest[telegram_id] = max(timestamp, latest.get(telegram_id, timestamp))
+
+        async with self.pool.acquire() as conn:
+            columns = ['client_id', 'message_text', 'is_from_bot', 'timestamp']
+            texts = [(row[2],) for row in batch]
+            if self.templates:
+                columns += ['template_id', 'template_params']
+                texts = [await self.templates.row_values(conn, row[2]) for row in batch]
+
+            async with conn.transaction():
+                clients = await conn.fetch(UPSERT_CLIENTS_SQL, list(latest), list(latest.values()))
+                client_ids = {row['telegram_id']: row['id'] for row in clients}
+
+                await conn.copy_records_to_table(
+                    'message',
+                    records=[
+                        (client_ids[telegram_id], values[0], is_from_bot, timestamp) + tuple(values[1:])
+                        for (_, telegram_id, _, is_from_bot, timestamp, _), values in zip(batch, texts)
+                    ],
+                    columns=columns
+                )
+
+                if self.on_batch:
+                    await self.on_batch(conn, batch, clients)
+
+    @staticmethod
+    def batch_stats(batch: List[BufferedRow], clients) -> Tuple[DailyDelta, List[Tuple[int, datetime, bool]]]:
+        """Приращения счетчиков пачки и первые сообщения/ответы по клиентам.
+
+        Для времени первого ответа достаточно самого раннего сообщения клиента
+        и самого раннего ответа бота после него, остальные строки пачки не
+        передаются, чтобы не делать лишних запросов.
+        """
+        client_ids = {row['telegram_id']: row['id'] for row in clients}
+        new_clients = {row['telegram_id'] for row in clients if row['inserted']}
+        delta = DailyDelta()
+
+        first_in: Dict[int, datetime] = {}
+        first_out: Dict[int, datetime] = {}
+        for _, telegram_id, _, is_from_bot, timestamp, is_voice in batch:
+            delta.add_message(timestamp, is_from_bot, is_voice)
+            if telegram_id in new_clients:
+                new_clients.discard(telegram_id)
+                delta.add(timestamp, new_clients=1)
+            client_id = client_ids[telegram_id]
+            if not is_from_bot:
+                first_in.setdefault(client_id, timestamp)
+            elif client_id not in first_out and timestamp >= first_in.get(client_id, timestamp):
+                first_out[client_id] = timestamp
+
+        messages = [(client_id, timestamp, False) for client_id, timestamp in first_in.items()]
+        messages += [(client_id, timestamp, True) for client_id, timestamp in first_out.items()]
+        return delta, messages
+
+    async def close(self, max_attempts: int = 3) -> None:
+        """Останавливает фоновую задачу и полностью сбрасывает буфер"""
+        self._closing = True
+        if self._task:
+            # Не отменяем задачу: отмена посреди COPY могла бы привести к повторной записи
+            self._wakeup.set()
+            await self._task
+            self._task = None
+
+        for attempt in range(max_attempts):
+            if await self.flush():
+                break
+            await asyncio.sleep(1)
+
+        if self._rows:
+            logger.error(f"При остановке не удалось записать {len(self._rows)} сообщений")
+        logger.info(f"Статистика буфера записи: {self.get_stats()}")
+
+    def get_stats(self) -> Dict[str, Any]:
+        stats = dict(self.stats)
+        stats["pending"] = len(self._rows)
+        return stats